@@ -0,0 +1,101 @@
+"""意圖路由基準測試：新舊路由的準確度和每則訊息耗時
+
+用法：
+    python bench/bench_intent_router.py --repeat 2000
+
+新版路由有任何一句分錯就以非零狀態結束，可以當回歸測試用
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import intents
+
+# (訊息, 應該的意圖)
+CORPUS = [
+    ("加入行程 下星期三去看牙醫", "calendar"),
+    ("新增行程 7月1日 小明生日", "calendar"),
+    ("記住加入行程：星期六游泳", "calendar"),
+    ("今日午餐花了 $25", "expense"),
+    ("記帳 交通 12蚊", "expense"),
+    ("支出 超市 80", "expense"),
+    ("我花了很多時間做功課", "chat"),
+    ("花了一整天陪小朋友", "chat"),
+    ("要買牛奶同雞蛋", "shopping"),
+    ("記得買貓糧", "shopping"),
+    ("幫我加入清單 衛生紙", "shopping"),
+    ("購物 麵包兩條", "shopping"),
+    ("買咗新手機好開心", "chat"),
+    ("你覺得我應該買邊隻車", "chat"),
+    ("買樓要注意啲咩", "chat"),
+    ("記住我鍾意藍色", "memory_save"),
+    ("記錄：小美對花生敏感", "memory_save"),
+    ("給我新聞", "news"),
+    ("今日新聞有咩", "news"),
+    ("東京天氣點樣", "weather"),
+    ("香港同台北今日氣溫", "weather"),
+    ("明天會下雨嗎", "weather"),
+    ("Calgary 今個星期預報", "weather"),
+    ("最新匯率係幾多", "search"),
+    ("蘋果股價", "search"),
+    ("選舉結果點呀", "search"),
+    ("今天是星期幾", "chat"),
+    ("你好", "chat"),
+    ("講個笑話聽下", "chat"),
+    ("我叫小明", "chat"),
+]
+
+# 舊版 handle_message 的逐條子字串判斷，用來比較
+def legacy_route(text):
+    if any(kw in text for kw in ["記錄", "記住"]):
+        return "memory_save"
+    if "加入行程" in text or "新增行程" in text:
+        return "calendar"
+    if "買" in text or "購物" in text or "加入清單" in text:
+        return "shopping"
+    if "支出" in text or "花了" in text or "記帳" in text:
+        return "expense"
+    if any(kw in text for kw in ["發新聞", "今日新聞", "要新聞", "給我新聞", "看新聞"]):
+        return "news"
+    simple_patterns = ["今日是", "今天是", "星期幾", "你好", "在嗎", "在唔在", "是星期"]
+    if any(p in text for p in simple_patterns):
+        return "chat"
+    search_triggers = ["最新", "最近", "近期", "搜尋", "幾多錢", "價格", "股價", "匯率",
+                       "天氣", "溫度", "預報", "氣温", "誰是", "是誰", "哪裡", "在哪",
+                       "公投", "選舉", "政策", "法例", "新政", "消息", "新聞", "發生咗", "發生什麼"]
+    if not any(kw in text for kw in search_triggers):
+        return "chat"
+    if any(kw in text for kw in ["天氣", "氣溫", "溫度", "預報", "下雨", "下雪"]):
+        return "weather"
+    return "search"
+
+def accuracy(router):
+    wrong = [(text, expected, got) for text, expected in CORPUS if (got := router(text)) != expected]
+    return len(CORPUS) - len(wrong), wrong
+
+def time_per_message(router, repeat):
+    texts = [text for text, _ in CORPUS]
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for text in texts:
+            router(text)
+    return (time.perf_counter() - started) / (repeat * len(texts)) * 1e6
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=2000)
+    args = parser.parse_args()
+    routers = [("舊版", legacy_route), ("新版", lambda text: intents.route(text)["intent"])]
+    print(f"{'路由':<6} {'正確':>8} {'µs/訊息':>10}")
+    for name, router in routers:
+        correct, wrong = accuracy(router)
+        print(f"{name:<6} {correct:>4}/{len(CORPUS):<3} {time_per_message(router, args.repeat):>10.2f}")
+        for text, expected, got in wrong:
+            print(f"    {text!r}: 應為 {expected}，得到 {got}")
+    # 舊版本來就會分錯，只檢查新版
+    return 1 if wrong else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,358 @@
+"""離線壓力測試：用合成的 Update 驅動 handle_message 和 cmd_* 指令，外部服務全部換成本地替身
+
+Gemini 用可調延遲的假模型，Supabase 用記憶體內的假 client（MemoryDB 本身照舊），
+RSS、天氣、搜尋和商品頁由本地 HTTP 伺服器提供，Telegram Bot 只計數不連網。
+每個情境報告訊息/秒、p50/p99 延遲、事件循環被卡住的時間，以及各階段耗時。
+
+用法：
+    python bench/bench_load.py                                   # 全部情境
+    python bench/bench_load.py busy_group --messages 500 --rate 10
+    python bench/bench_load.py price_sweep --items 200 --host-spacing 1.0
+    python bench/bench_load.py news_burst --llm-latency 3 --json result.json
+    python bench/bench_load.py --real-limits                     # 保留正式環境的令牌桶設定
+"""
+import os
+import sys
+import io
+import json
+import time
+import random
+import asyncio
+import argparse
+import contextlib
+import tempfile
+import collections
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, ".."))
+
+SCENARIOS = ["busy_group", "news_burst", "price_sweep"]
+GROUP_CHAT_ID = -1001234567890
+# 和 main() 登記的名稱一樣，判斷出分支後會改名
+MESSAGE = "handle_message:ignored"
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("scenarios", nargs="*", help="要跑的情境：" + "、".join(SCENARIOS) + "，預設全部")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--messages", type=int, default=300, help="busy_group 的訊息數")
+    parser.add_argument("--rate", type=float, default=8.0, help="busy_group 每秒平均到達的訊息數")
+    parser.add_argument("--users", type=int, default=15, help="busy_group 群組成員數")
+    parser.add_argument("--news-users", type=int, default=30, help="news_burst 同時要新聞的人數")
+    parser.add_argument("--news-window", type=float, default=1.0, help="news_burst 的請求在幾秒內到達")
+    parser.add_argument("--items", type=int, default=200, help="price_sweep 的商品數")
+    parser.add_argument("--host-spacing", type=float, default=0.05,
+                        help="price_sweep 同一網站請求間隔（正式環境是 PRICE_HOST_SPACING，預設 1 秒）")
+    parser.add_argument("--sweep-traffic", type=float, default=2.0, help="price_sweep 期間每秒的私訊數，0 表示不發")
+    parser.add_argument("--memories", type=int, default=500, help="預先放進記憶庫的筆數")
+    parser.add_argument("--llm-latency", type=float, default=0.8, help="假 Gemini 每次呼叫的秒數")
+    parser.add_argument("--llm-first-chunk", type=float, default=0.3, help="串流第一段的秒數")
+    parser.add_argument("--llm-quota-errors", type=float, default=0.0, help="假 Gemini 回 429 的比例")
+    parser.add_argument("--db-latency", type=float, default=0.03, help="假 Supabase 每次查詢的秒數")
+    parser.add_argument("--http-latency", type=float, default=0.05, help="本地網站每個請求的秒數")
+    parser.add_argument("--page-kb", type=int, default=300, help="合成商品頁大小")
+    parser.add_argument("--telegram-latency", type=float, default=0.05, help="假 Bot 每次送出或編輯的秒數")
+    parser.add_argument("--real-limits", action="store_true", help="不放寬令牌桶和 GEMINI_RPM")
+    parser.add_argument("--json", help="結果另存成 JSON")
+    parser.add_argument("--verbose", action="store_true", help="顯示 bot 本身的輸出")
+    args = parser.parse_args()
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error("未知情境：" + "、".join(unknown))
+    args.scenarios = args.scenarios or SCENARIOS
+    # 之後會切換到暫存目錄
+    args.json = os.path.abspath(args.json) if args.json else None
+    return args
+
+def prepare_environment(args):
+    """main 在匯入時就讀環境變數和開資料庫，所以要先設好；快取和排程資料庫放在暫存目錄，每次都是冷啟動"""
+    workdir = tempfile.mkdtemp(prefix="anya-bench-")
+    os.environ.update({
+        "SUPABASE_URL": "http://127.0.0.1:9", "SUPABASE_KEY": "bench", "TELEGRAM_BOT_TOKEN": "1:bench",
+        "GEMINI_API_KEY": "bench", "MY_CHAT_ID": "1",
+        "CACHE_DB": os.path.join(workdir, "cache.db"), "SCHEDULER_DB": os.path.join(workdir, "scheduler.db"),
+        "WATCHLIST_DB": os.path.join(workdir, "watchlist.db"),
+    })
+    if not args.real_limits:
+        for name in ("RATE_USER_PER_MIN", "RATE_USER_BURST", "RATE_CHAT_PER_MIN", "RATE_CHAT_BURST", "GEMINI_RPM"):
+            os.environ.setdefault(name, "1000000")
+    os.chdir(workdir)
+    return workdir
+
+def install_fakes(args):
+    import google.generativeai as genai
+    # 啟動時選模型會列出模型，離線時直接用預設
+    genai.list_models = lambda *a, **k: iter([])
+    import httpx
+    import fakes
+    import http_client
+    import main
+
+    gemini = fakes.FakeGemini(latency=args.llm_latency, first_chunk=args.llm_first_chunk,
+                              quota_error_rate=args.llm_quota_errors)
+    main.chat_model.generate_content = gemini.generate_content
+    supabase = fakes.FakeSupabase(latency=args.db_latency)
+    supabase.seed_memories(args.memories)
+    main.memory_db.client = supabase
+    fixture = fakes.FixtureServer(latency=args.http_latency, page_kb=args.page_kb).start()
+    bot = fakes.FakeBot(latency=args.telegram_latency)
+    main.telegram_app = type("App", (), {"bot": bot})()
+
+    # 換上共用 client，所有外部請求改連本地 fixture；連線池設定和正式的一樣
+    limits = httpx.Limits(max_connections=http_client.HTTP_MAX_CONNECTIONS,
+                          max_keepalive_connections=http_client.HTTP_KEEPALIVE_PER_POOL, keepalive_expiry=60)
+    http_client._client = httpx.AsyncClient(headers=http_client.DEFAULT_HEADERS, timeout=http_client.HTTP_TIMEOUT,
+                                            follow_redirects=True,
+                                            transport=fakes.FixtureTransport(fixture.base_url, limits=limits))
+    return {"main": main, "gemini": gemini, "supabase": supabase, "fixture": fixture, "bot": bot,
+            "updates": fakes.UpdateFactory(bot)}
+
+class LoopMonitor:
+    """每 interval 秒醒一次，醒晚了多少就是事件循環被同步程式卡住的時間"""
+
+    def __init__(self, interval=0.005, threshold=0.05):
+        self.interval = interval
+        self.threshold = threshold
+        self.lags = []
+        self.task = None
+
+    async def run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, time.perf_counter() - started - self.interval))
+
+    def start(self):
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self):
+        self.task.cancel()
+        await asyncio.gather(self.task, return_exceptions=True)
+        return {"blocked_ms": sum(self.lags) * 1000, "max_ms": max(self.lags, default=0.0) * 1000,
+                "stalls": sum(1 for lag in self.lags if lag > self.threshold)}
+
+class Recorder:
+    """每個 update 包在一個 trace 裡，handler 判斷出的分支會成為 trace 名稱"""
+
+    def __init__(self, tracing):
+        self.tracing = tracing
+        self.traces = []
+        self.errors = collections.Counter()
+
+    async def drive(self, name, handler, update, context=None):
+        with self.tracing.trace(name) as trace:
+            try:
+                await handler(update, context)
+            except Exception as e:
+                self.errors[type(e).__name__] += 1
+        self.traces.append(trace)
+
+def snapshot(env):
+    return {
+        "gemini": env["gemini"].stats["calls"] + env["gemini"].stats["streams"],
+        "supabase": env["supabase"].calls,
+        "http": env["fixture"].requests,
+        "telegram_send": env["bot"].stats["send_message"],
+        "telegram_edit": env["bot"].stats["edit_message_text"],
+    }
+
+def summarize(env, name, recorder, elapsed, loop_stats, before, extra=None):
+    tracing = env["main"].tracing
+    handled = [t for t in recorder.traces if not t.name.endswith(":ignored")]
+    durations = [t.duration for t in handled]
+    after = snapshot(env)
+    stages = collections.defaultdict(list)
+    for t in recorder.traces:
+        for span_name, _, duration, depth, _ in t.spans:
+            # depth 0 是 handler 本身
+            if depth > 0 and duration is not None:
+                stages[span_name].append(duration)
+    total = sum(t.duration for t in recorder.traces) or 1.0
+    return {
+        "scenario": name,
+        "updates": len(recorder.traces),
+        "handled": len(handled),
+        "errors": dict(recorder.errors),
+        "elapsed_s": elapsed,
+        "throughput": len(recorder.traces) / elapsed if elapsed else 0.0,
+        "handled_throughput": len(handled) / elapsed if elapsed else 0.0,
+        "p50_ms": tracing.percentile(durations, 50) * 1000,
+        "p99_ms": tracing.percentile(durations, 99) * 1000,
+        "max_ms": max(durations, default=0.0) * 1000,
+        "branches": dict(collections.Counter(t.name for t in recorder.traces).most_common()),
+        "loop": loop_stats,
+        "calls": {k: after[k] - before[k] for k in after},
+        "stages": sorted(({"stage": n, "count": len(v), "p50_ms": tracing.percentile(v, 50) * 1000,
+                           "p99_ms": tracing.percentile(v, 99) * 1000, "share": sum(v) / total}
+                          for n, v in stages.items()), key=lambda r: r["share"], reverse=True),
+        **(extra or {}),
+    }
+
+async def measure(env, name, body):
+    """執行 body(recorder)，同時監察事件循環"""
+    recorder = Recorder(env["main"].tracing)
+    monitor = LoopMonitor()
+    before = snapshot(env)
+    monitor.start()
+    started = time.perf_counter()
+    extra = await body(recorder)
+    elapsed = time.perf_counter() - started
+    return summarize(env, name, recorder, elapsed, await monitor.stop(), before, extra)
+
+def handlers(main):
+    wrap = main.instrument_handler
+    routes = {name: wrap(name, getattr(main, name)) for name in
+              ("cmd_memory", "cmd_news", "cmd_calendar", "cmd_shopping", "cmd_expenses", "cmd_summary")}
+    routes[MESSAGE] = wrap(MESSAGE, main.handle_message)
+    return routes
+
+# 群組訊息：(權重, 文字或指令)；沒有「安尼亞」的閒聊會被忽略
+GROUP_MIX = [
+    (45, "今晚食咩好"), (45, "哈哈哈"), (30, "我返到屋企啦"),
+    (25, "安尼亞 講個笑話聽下"), (20, "安尼亞 你覺得我應該買邊隻車"), (15, "安尼亞 我今日好攰"),
+    (8, "安尼亞 東京同台北天氣"), (6, "安尼亞 Calgary 天氣"),
+    (8, "安尼亞 最新匯率係幾多"),
+    (6, "安尼亞 要買牛奶同雞蛋"), (5, "安尼亞 今日午餐花了 $25"), (4, "安尼亞 加入行程 下星期三去看牙醫"),
+    (4, "安尼亞 記住小美對花生敏感"),
+    (3, "LONG"),
+    (3, "/shopping"), (3, "/calendar"), (2, "/expenses"), (2, "/memory"), (2, "/summary"),
+]
+LONG_MESSAGE = "今日開會講咗好多嘢，" * 60
+
+async def busy_group(env, args):
+    main = env["main"]
+    routes = handlers(main)
+    updates = env["updates"]
+    weights, texts = zip(*GROUP_MIX)
+
+    async def body(recorder):
+        tasks = []
+        for _ in range(args.messages):
+            text = random.choices(texts, weights)[0]
+            user_id = random.randint(1, args.users)
+            kwargs = {"user_id": user_id, "first_name": "成員" + str(user_id), "chat_id": GROUP_CHAT_ID, "chat_type": "supergroup"}
+            if text.startswith("/"):
+                update, context = updates.command(text, reply_to=LONG_MESSAGE if text == "/summary" else None, **kwargs)
+                name = "cmd_" + text[1:]
+                coro = recorder.drive(name, routes[name], update, context)
+            else:
+                update = updates.text(LONG_MESSAGE if text == "LONG" else text, **kwargs)
+                coro = recorder.drive(MESSAGE, routes[MESSAGE], update)
+            # 和 concurrent_updates(True) 一樣，每個 update 一個 task
+            tasks.append(asyncio.create_task(coro))
+            await asyncio.sleep(random.expovariate(args.rate))
+        await asyncio.gather(*tasks)
+
+    return await measure(env, "busy_group", body)
+
+async def news_burst(env, args):
+    """當日新聞還沒建好時，一群人同時用 /news 或「給我新聞」要新聞"""
+    main = env["main"]
+    routes = handlers(main)
+    updates = env["updates"]
+    main.news_digest.update(date=None)
+    main.feed_state.clear()
+
+    async def body(recorder):
+        tasks = []
+        for i in range(args.news_users):
+            if i % 2:
+                update, context = updates.command("/news", user_id=100 + i)
+                tasks.append(asyncio.create_task(recorder.drive("cmd_news", routes["cmd_news"], update, context)))
+            else:
+                update = updates.text("給我新聞", user_id=100 + i)
+                tasks.append(asyncio.create_task(recorder.drive(MESSAGE, routes[MESSAGE], update)))
+            await asyncio.sleep(args.news_window / args.news_users)
+        await asyncio.gather(*tasks)
+
+    return await measure(env, "news_burst", body)
+
+async def price_sweep(env, args):
+    """一次檢查 args.items 件商品，同時有少量私訊，看掃描會不會拖慢對話"""
+    main = env["main"]
+    fixture = env["fixture"]
+    routes = handlers(main)
+    updates = env["updates"]
+    hosts = [("www.amazon.ca", "/dp/B0{:08d}"), ("www.bestbuy.ca", "/en-ca/product/{:08d}"),
+             ("www.canadiantire.ca", "/en/pdp/{:08d}")]
+    main.watch_list.clear()
+    for i in range(args.items):
+        host, path = hosts[i % len(hosts)]
+        path = path.format(i)
+        main.watch_list["https://" + host + path] = {"title": "Item " + str(i), "current_price": fixture.product_price(path),
+                                                    "target_price": None}
+    main.PRICE_HOST_SPACING = args.host_spacing
+    check_prices = main.traced_job("check_prices", main.check_prices)
+
+    async def sweep_job(update, context):
+        await check_prices()
+
+    async def body(recorder):
+        sweep = asyncio.create_task(recorder.drive("job:check_prices", sweep_job, None))
+        tasks = []
+        while args.sweep_traffic and not sweep.done():
+            update = updates.text(random.choice(["講個笑話聽下", "記住我鍾意藍色", "Edmonton 天氣"]), user_id=random.randint(1, 5))
+            tasks.append(asyncio.create_task(recorder.drive(MESSAGE, routes[MESSAGE], update)))
+            await asyncio.wait([sweep], timeout=random.expovariate(args.sweep_traffic))
+        await sweep
+        await asyncio.gather(*tasks)
+        stats = main.price_sweep_stats
+        return {"sweep": {"items": stats["last_items"], "duration_s": stats["last_duration"],
+                          "items_per_s": stats["last_items"] / stats["last_duration"] if stats["last_duration"] else 0.0,
+                          "host_spacing": args.host_spacing}}
+
+    return await measure(env, "price_sweep", body)
+
+def report(result):
+    print("== " + result["scenario"] + " ==")
+    print(f"update {result['updates']} 個（處理 {result['handled']}，錯誤 {sum(result['errors'].values())}），"
+          f"用時 {result['elapsed_s']:.1f} s，{result['throughput']:.1f} msg/s（處理 {result['handled_throughput']:.1f}/s）")
+    print(f"延遲 p50 {result['p50_ms']:.0f} ms  p99 {result['p99_ms']:.0f} ms  max {result['max_ms']:.0f} ms")
+    loop = result["loop"]
+    print(f"事件循環卡住：合計 {loop['blocked_ms']:.0f} ms，最長 {loop['max_ms']:.0f} ms，超過 50 ms {loop['stalls']} 次")
+    calls = result["calls"]
+    print(f"外部呼叫：Gemini {calls['gemini']}，Supabase {calls['supabase']}，HTTP {calls['http']}，"
+          f"Telegram 送出 {calls['telegram_send']} / 編輯 {calls['telegram_edit']}")
+    if "sweep" in result:
+        sweep = result["sweep"]
+        print(f"價格掃描：{sweep['items']} 件，{sweep['duration_s']:.1f} s，{sweep['items_per_s']:.1f} 件/s"
+              f"（同網站間隔 {sweep['host_spacing']} s）")
+    print("分支：" + "，".join(f"{name} {count}" for name, count in result["branches"].items()))
+    print(f"{'stage':<32} {'count':>6} {'p50 ms':>9} {'p99 ms':>9} {'share':>7}")
+    for r in result["stages"][:10]:
+        print(f"{r['stage']:<32} {r['count']:>6} {r['p50_ms']:>9.1f} {r['p99_ms']:>9.1f} {r['share'] * 100:>6.1f}%")
+    print()
+
+async def run(env, args):
+    main = env["main"]
+    results = []
+    try:
+        # 和 on_startup 一樣，先建好記憶索引
+        await main.refresh_memory_index()
+        for name in args.scenarios:
+            with contextlib.redirect_stdout(sys.stdout if args.verbose else io.StringIO()):
+                result = await globals()[name](env, args)
+            report(result)
+            results.append(result)
+    finally:
+        await main.http_client.aclose()
+        main.llm_executor.shutdown(wait=False)
+    return results
+
+def main():
+    args = parse_args()
+    random.seed(args.seed)
+    workdir = prepare_environment(args)
+    env = install_fakes(args)
+    print(f"工作目錄 {workdir}，Gemini {args.llm_latency}s，Supabase {args.db_latency}s，HTTP {args.http_latency}s，"
+          f"Telegram {args.telegram_latency}s" + ("，正式令牌桶" if args.real_limits else "，令牌桶已放寬") + "\n")
+    try:
+        results = asyncio.run(run(env, args))
+    finally:
+        env["fixture"].stop()
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
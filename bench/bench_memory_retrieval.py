@@ -0,0 +1,58 @@
+"""記憶檢索基準測試：建立索引和查詢 top-k 的時間
+
+用法：
+    python bench/bench_memory_retrieval.py --sizes 1000 10000 50000
+"""
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from retrieval import MemoryIndex
+
+NAMES = ["爸爸", "媽媽", "小明", "小美", "嫲嫲", "公公", "Tom", "Amy"]
+VERBS = ["喜歡", "討厭", "今天去了", "每天早上", "想買", "住在", "怕", "記住要"]
+OBJECTS = ["壽司", "拉麵", "游泳", "Costco", "West Edmonton Mall", "打疫苗", "鋼琴課", "牙醫", "雪糕", "咖啡",
+           "籃球", "Calgary", "生日派對", "垃圾回收", "貓糧", "藍色", "恐龍", "數學功課", "露營", "火鍋"]
+CATEGORIES = ["人物", "喜好", "設定", "事件", "一般"]
+QUERIES = ["媽媽喜歡吃什麼", "小明今天有鋼琴課嗎", "爸爸怕什麼", "安尼亞 幫我記住貓糧", "週末去露營好不好",
+           "Amy 的生日派對", "今天天氣怎樣", "誰喜歡火鍋"]
+
+def synthetic_rows(n, seed=1):
+    rnd = random.Random(seed)
+    rows = []
+    for i in range(n):
+        content = rnd.choice(VERBS) + rnd.choice(OBJECTS) + "，" + rnd.choice(VERBS) + rnd.choice(OBJECTS)
+        rows.append({"id": i + 1, "category": rnd.choice(CATEGORIES), "content": content, "sender_name": rnd.choice(NAMES)})
+    return rows
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000])
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+    categories = {"人物", "喜好", "設定", "事件"}
+    print(f"{'記憶數':>8} {'建立 ms':>10} {'p50 ms':>8} {'p99 ms':>8}")
+    for size in args.sizes:
+        rows = synthetic_rows(size)
+        started = time.perf_counter()
+        index = MemoryIndex()
+        for r in rows:
+            index.add(r["id"], r["sender_name"] + " " + r["content"], r)
+        build_ms = (time.perf_counter() - started) * 1000
+        timings = []
+        for _ in range(args.repeat):
+            for q in QUERIES:
+                started = time.perf_counter()
+                index.search(q, k=8, budget=1500, accept=lambda r: r["category"] in categories)
+                timings.append((time.perf_counter() - started) * 1000)
+        print(f"{size:>8} {build_ms:>10.0f} {percentile(timings, 50):>8.2f} {percentile(timings, 99):>8.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""價格抓取基準測試：比較舊的整頁正則與串流提前停止的讀取量和時間
+
+用法：
+    python bench/bench_price_extract.py                  # 用合成的網頁
+    python bench/bench_price_extract.py --fixtures DIR   # 用存下來的網頁，檔名開頭是網址，例如 www.amazon.ca__B0xxx.html
+"""
+import os
+import re
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import prices
+
+LEGACY_PATTERNS = {
+    "amazon": [r'class="a-price-whole">([\d,]+)', r'"priceAmount":([\d.]+)',
+               r'id="priceblock_ourprice"[^>]*>\$?([\d,\.]+)', r'"price":\s*([\d.]+)'],
+    "bestbuy": [r'"salePrice":([\d.]+)', r'"regularPrice":([\d.]+)',
+                r'data-automation="product-price"[^>]*>\$?([\d,\.]+)'],
+    "canadiantire": [r'"offering-price"[^>]*>\$?([\d,\.]+)', r'"price":{"value":([\d.]+)', r'data-price="([\d.]+)"'],
+}
+LEGACY_GENERIC = [r'\$([\d,]+\.\d{2})', r'"price":([\d.]+)', r'"currentPrice":([\d.]+)', r'"salePrice":([\d.]+)']
+
+def legacy_extract(page, url):
+    """舊版 fetch_price 的做法：整頁解碼後逐條未編譯正則搜尋"""
+    html = page.decode("utf-8", errors="replace")
+    name = prices.extractor_for(url).name
+    for p in LEGACY_PATTERNS.get(name, []) + LEGACY_GENERIC:
+        m = re.search(p, html)
+        if m:
+            return float(m.group(1).replace(",", "")), len(page)
+    return None, len(page)
+
+def stream_extract(page, url):
+    chunks = (page[i:i + prices.PRICE_CHUNK_SIZE] for i in range(0, len(page), prices.PRICE_CHUNK_SIZE))
+    snapshot, bytes_read = prices.scan_stream(chunks, url)
+    return snapshot["price"], bytes_read
+
+def synthetic_pages():
+    """產生大小接近真實的零售商網頁，價格放在靠前的位置"""
+    filler = ('<div class="a-section"><span>Customers also bought</span>'
+              '<script>var x = {"widget": "carousel", "items": [1, 2, 3]};</script></div>\n')
+    def page(head, price_html, size):
+        body = head + filler * 2000 + price_html
+        return (body + filler * (size // len(filler))).encode("utf-8")
+    return [
+        ("https://www.amazon.ca/dp/B0TEST", page("<html><head><title>Widget | Amazon.ca</title></head>",
+                                                  '<span class="a-price-whole">49<span>', 3 * 1024 * 1024)),
+        ("https://www.bestbuy.ca/en-ca/product/123", page("<html><head><title>TV | Best Buy Canada</title></head>",
+                                                           '<script>{"salePrice":899.99}</script>', 1024 * 1024)),
+        ("https://www.canadiantire.ca/en/pdp/456", page("<html><head><title>Drill | Canadian Tire</title></head>",
+                                                         '<span class="offering-price">$129.99</span>', 1536 * 1024)),
+        ("https://shop.example.com/item", page("<html><head><title>Item</title></head>",
+                                               '<span>$19.99</span>', 512 * 1024)),
+    ]
+
+def fixture_pages(directory):
+    pages = []
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith(".html"):
+            continue
+        host = name.split("__")[0]
+        with open(os.path.join(directory, name), "rb") as f:
+            pages.append(("https://" + host + "/" + name, f.read()))
+    return pages
+
+def bench(fn, page, url, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        price, bytes_read = fn(page, url)
+    return price, bytes_read, (time.perf_counter() - started) / repeat * 1000
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--fixtures", help="存下來的網頁目錄")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    pages = fixture_pages(args.fixtures) if args.fixtures else synthetic_pages()
+    print(f"{'url':<45} {'方法':<8} {'價格':>10} {'讀取 KB':>10} {'ms':>8}")
+    for url, page in pages:
+        for label, fn in (("legacy", legacy_extract), ("stream", stream_extract)):
+            price, bytes_read, ms = bench(fn, page, url, args.repeat)
+            print(f"{url[:45]:<45} {label:<8} {str(price):>10} {bytes_read / 1024:>10.0f} {ms:>8.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,405 @@
+"""壓力測試用的本地替身：Gemini、Supabase、Telegram Bot 和外部網站都不用連網
+
+bench_load.py 用它們替換 main 裡的外部依賴，其餘程式碼照正式環境執行
+"""
+import re
+import json
+import time
+import random
+import asyncio
+import datetime
+import itertools
+import threading
+import urllib.parse
+import email.utils
+from types import SimpleNamespace
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import httpx
+import google.api_core.exceptions
+from telegram import Chat, Message, Update, User
+
+def jittered(latency, jitter):
+    return max(0.0, latency * random.uniform(1 - jitter, 1 + jitter))
+
+# Gemini
+class FakeChunk:
+    def __init__(self, text):
+        self.text = text
+
+class FakeGemini:
+    """代替 GenerativeModel.generate_content：按設定的延遲睡眠（在 llm_executor 線程內），
+    按 generation_config 回傳結構化抽取、新聞翻譯或一般對話的內容"""
+
+    def __init__(self, latency=0.8, first_chunk=0.3, chunks=6, jitter=0.2, quota_error_rate=0.0):
+        self.latency = latency
+        self.first_chunk = first_chunk
+        self.chunks = chunks
+        self.jitter = jitter
+        self.quota_error_rate = quota_error_rate
+        self.lock = threading.Lock()
+        self.stats = {"calls": 0, "streams": 0, "quota_errors": 0}
+
+    def count(self, key):
+        with self.lock:
+            self.stats[key] += 1
+
+    def generate_content(self, contents, stream=False, request_options=None, generation_config=None):
+        self.count("streams" if stream else "calls")
+        if self.quota_error_rate and random.random() < self.quota_error_rate:
+            self.count("quota_errors")
+            time.sleep(jittered(0.05, self.jitter))
+            raise google.api_core.exceptions.ResourceExhausted("fake quota exceeded")
+        prompt = contents if isinstance(contents, str) else " ".join(c for c in contents if isinstance(c, str))
+        if stream:
+            return self.stream(prompt)
+        time.sleep(jittered(self.latency, self.jitter))
+        return FakeChunk(self.reply(prompt, generation_config or {}))
+
+    def stream(self, prompt):
+        time.sleep(jittered(self.first_chunk, self.jitter))
+        step = max(0.0, self.latency - self.first_chunk) / max(1, self.chunks - 1)
+        for i in range(self.chunks):
+            if i:
+                time.sleep(jittered(step, self.jitter))
+            yield FakeChunk("安尼亞覺得這個問題很有趣，" * 3)
+
+    def reply(self, prompt, config):
+        if "response_schema" in config:
+            return json.dumps(self.extract(prompt), ensure_ascii=False)
+        if config.get("response_mime_type") == "application/json":
+            # 新聞翻譯：prompt 最後一行是文章 JSON 陣列，原樣加上標記回傳
+            items = json.loads(prompt.rsplit("\n", 1)[-1])
+            return json.dumps([{"id": i["id"], "title": "譯：" + i["title"], "description": "譯：" + i["description"]}
+                               for i in items], ensure_ascii=False)
+        if "摘要" in prompt:
+            return "1. 重點一\n2. 重點二\n3. 重點三"
+        return "安尼亞知道了！" * 5
+
+    def extract(self, prompt):
+        m = re.search(r"訊息可能包含：(.+)", prompt)
+        fields = m.group(1).split("、") if m else ["memory"]
+        tomorrow = (datetime.date.today() + datetime.timedelta(days=1)).isoformat()
+        return {
+            "event": {"title": "看牙醫", "category": "醫生預約", "date": tomorrow, "reminder_days": 1} if "event" in fields else None,
+            "shopping": [{"item": "牛奶", "quantity": "2"}, {"item": "雞蛋", "quantity": "1"}] if "shopping" in fields else [],
+            "expense": {"amount": 25, "category": "食物", "description": "午餐"} if "expense" in fields else None,
+            "memory": {"content": "小美對花生敏感", "category": "人物"} if "memory" in fields else None,
+        }
+
+# Supabase
+class FakeQuery:
+    def __init__(self, db, table):
+        self.db = db
+        self.table = table
+        self.op = "select"
+        self.payload = None
+        self.filters = []
+        self.order_by = None
+        self.bounds = None
+
+    def select(self, columns="*"):
+        self.op = "select"
+        return self
+
+    def insert(self, rows):
+        self.op, self.payload = "insert", rows
+        return self
+
+    def upsert(self, rows):
+        self.op, self.payload = "upsert", rows
+        return self
+
+    def update(self, values):
+        self.op, self.payload = "update", values
+        return self
+
+    def delete(self):
+        self.op = "delete"
+        return self
+
+    def eq(self, column, value):
+        self.filters.append(lambda r: r.get(column) == value)
+        return self
+
+    def neq(self, column, value):
+        self.filters.append(lambda r: r.get(column) != value)
+        return self
+
+    def gt(self, column, value):
+        self.filters.append(lambda r: r.get(column) is not None and r.get(column) > value)
+        return self
+
+    def gte(self, column, value):
+        self.filters.append(lambda r: r.get(column) is not None and r.get(column) >= value)
+        return self
+
+    def lte(self, column, value):
+        self.filters.append(lambda r: r.get(column) is not None and r.get(column) <= value)
+        return self
+
+    def in_(self, column, values):
+        values = set(values)
+        self.filters.append(lambda r: r.get(column) in values)
+        return self
+
+    def ilike(self, column, pattern):
+        needle = pattern.strip("%").lower()
+        self.filters.append(lambda r: needle in str(r.get(column, "")).lower())
+        return self
+
+    def order(self, column, desc=False):
+        self.order_by = (column, desc)
+        return self
+
+    def range(self, start, end):
+        self.bounds = (start, end)
+        return self
+
+    def execute(self):
+        return SimpleNamespace(data=self.db.run(self))
+
+class FakeSupabase:
+    """記憶體內的 Supabase client，支援 MemoryDB 用到的查詢；每次 execute 同步睡 latency 秒，
+    和真的 supabase-py 一樣會卡住呼叫它的線程"""
+
+    DEFAULTS = {"shopping": {"done": False}}
+    KEYS = {"preferences": "key"}
+
+    def __init__(self, latency=0.03, jitter=0.2):
+        self.latency = latency
+        self.jitter = jitter
+        self.lock = threading.Lock()
+        self.tables = {}
+        self.ids = itertools.count(1)
+        self.calls = 0
+
+    def table(self, name):
+        return FakeQuery(self, name)
+
+    def run(self, query):
+        time.sleep(jittered(self.latency, self.jitter))
+        with self.lock:
+            self.calls += 1
+            rows = self.tables.setdefault(query.table, [])
+            if query.op in ("insert", "upsert"):
+                return self.write(query.table, rows, query.payload, query.op == "upsert")
+            matched = [r for r in rows if all(f(r) for f in query.filters)]
+            if query.op == "update":
+                for r in matched:
+                    r.update(query.payload)
+                return [dict(r) for r in matched]
+            if query.op == "delete":
+                ids = {id(r) for r in matched}
+                rows[:] = [r for r in rows if id(r) not in ids]
+                return [dict(r) for r in matched]
+            if query.order_by:
+                column, desc = query.order_by
+                matched.sort(key=lambda r: (r.get(column) is None, r.get(column)), reverse=desc)
+            if query.bounds:
+                matched = matched[query.bounds[0]:query.bounds[1] + 1]
+            return [dict(r) for r in matched]
+
+    def write(self, table, rows, payload, upsert):
+        key = self.KEYS.get(table)
+        written = []
+        for new in payload if isinstance(payload, list) else [payload]:
+            existing = next((r for r in rows if key and r.get(key) == new.get(key)), None) if upsert else None
+            if existing is not None:
+                existing.update(new)
+                written.append(dict(existing))
+                continue
+            row = dict(self.DEFAULTS.get(table, {}), id=next(self.ids),
+                       created_at=datetime.datetime.now().isoformat(), **new)
+            rows.append(row)
+            written.append(dict(row))
+        return written
+
+    def seed_memories(self, count):
+        rows = [{"category": random.choice(["人物", "喜好", "事件", "一般"]), "sender_name": random.choice(["爸爸", "媽媽", "小明"]),
+                 "content": "第 " + str(i) + " 條記憶：" + random.choice(["鍾意藍色", "對花生敏感", "星期六游泳", "住喺 Edmonton"])}
+                for i in range(count)]
+        with self.lock:
+            self.write("memory_v2", self.tables.setdefault("memory_v2", []), rows, False)
+
+# 外部網站
+FIXTURE_FILLER = ('<div class="a-section"><span>Customers also bought</span>'
+                  '<script>var x = {"widget": "carousel", "items": [1, 2, 3]};</script></div>\n')
+
+class FixtureServer:
+    """本地 HTTP 伺服器，路徑的第一段是原本的網站，例如 /www.cbc.ca/cmlink/rss-canada；
+    RSS、天氣、搜尋和商品頁都是合成的，每個請求先睡 latency 秒模擬網路延遲"""
+
+    def __init__(self, latency=0.05, jitter=0.2, page_kb=300, price_drop_rate=0.1):
+        self.latency = latency
+        self.jitter = jitter
+        self.page_kb = page_kb
+        self.price_drop_rate = price_drop_rate
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.bytes_sent = 0
+        self.server = None
+
+    def start(self):
+        fixture = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                time.sleep(jittered(fixture.latency, fixture.jitter))
+                host, _, rest = self.path.lstrip("/").partition("/")
+                url = urllib.parse.urlsplit("/" + rest)
+                status, content_type, body = fixture.respond(host, url.path, dict(urllib.parse.parse_qsl(url.query)))
+                with fixture.lock:
+                    fixture.requests += 1
+                    fixture.bytes_sent += len(body)
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                try:
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    # 價格掃描找到價格就提早關閉連線
+                    pass
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    @property
+    def base_url(self):
+        return "http://127.0.0.1:" + str(self.server.server_address[1])
+
+    def respond(self, host, path, query):
+        if host == "www.cbc.ca":
+            return 200, "application/rss+xml", self.rss(path.rsplit("/", 1)[-1], 20)
+        if host == "news.google.com":
+            return 200, "application/rss+xml", self.rss(query.get("q", "search"), 5)
+        if host == "api.duckduckgo.com":
+            body = {"AbstractText": query.get("q", "") + " 的摘要", "RelatedTopics": [{"Text": "相關結果 " + str(i)} for i in range(3)]}
+            return 200, "application/json", json.dumps(body, ensure_ascii=False).encode()
+        if host == "geocoding-api.open-meteo.com":
+            name = query.get("name", "Edmonton")
+            seed = sum(map(ord, name))
+            body = {"results": [{"name": name.title(), "country": "Canada", "latitude": 40 + seed % 20, "longitude": -100 - seed % 30}]}
+            return 200, "application/json", json.dumps(body).encode()
+        if host == "api.open-meteo.com":
+            count = len(query.get("latitude", "0").split(","))
+            current = {"temperature_2m": 12.5, "relative_humidity_2m": 60, "wind_speed_10m": 15,
+                       "weather_code": 3, "apparent_temperature": 10.1}
+            body = [{"current": current} for _ in range(count)]
+            return 200, "application/json", json.dumps(body if count > 1 else body[0]).encode()
+        if host.endswith(("amazon.ca", "bestbuy.ca", "canadiantire.ca")):
+            return 200, "text/html; charset=utf-8", self.product_page(host, path)
+        return 404, "text/plain", b"not found"
+
+    def rss(self, feed, count):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        items = []
+        for i in range(count):
+            pub = email.utils.format_datetime(now - datetime.timedelta(hours=i))
+            items.append(f"<item><title>{feed} headline {i}</title><link>https://www.cbc.ca/news/{feed}-{i}</link>"
+                         f"<description>&lt;p&gt;Story {i} about {feed}.&lt;/p&gt;</description><pubDate>{pub}</pubDate></item>")
+        return ('<?xml version="1.0" encoding="UTF-8"?><rss version="2.0"><channel><title>' + feed + "</title>"
+                + "".join(items) + "</channel></rss>").encode()
+
+    def product_price(self, path):
+        return 20 + sum(map(ord, path)) % 500
+
+    def product_page(self, host, path):
+        seed = sum(map(ord, path))
+        price = self.product_price(path)
+        if random.random() < self.price_drop_rate:
+            price -= 5
+        if "amazon" in host:
+            price_html = f'<span class="a-price-whole">{price}<span>'
+        elif "bestbuy" in host:
+            price_html = '<script>{"salePrice":' + str(price) + '.99}</script>'
+        else:
+            price_html = f'<span class="offering-price">${price}.99</span>'
+        head = f'<html><head><title>Item {seed}</title><link rel="canonical" href="https://{host}{path}"></head><body>'
+        filler = FIXTURE_FILLER * (self.page_kb * 1024 // len(FIXTURE_FILLER) // 2)
+        return (head + filler + price_html + filler + "</body></html>").encode()
+
+class FixtureTransport(httpx.AsyncBaseTransport):
+    """把所有對外請求轉到 FixtureServer，原本的網站放在路徑第一段"""
+
+    def __init__(self, base_url, **kwargs):
+        self.base = httpx.URL(base_url)
+        self.inner = httpx.AsyncHTTPTransport(**kwargs)
+
+    async def handle_async_request(self, request):
+        url = request.url
+        request.url = self.base.copy_with(raw_path=b"/" + url.host.encode() + url.raw_path)
+        request.headers["Host"] = self.base.netloc.decode()
+        return await self.inner.handle_async_request(request)
+
+    async def aclose(self):
+        await self.inner.aclose()
+
+# Telegram
+class FakeBot:
+    """代替 telegram.Bot：不連 Telegram，只計數並按 latency 非同步等待；回傳真的 Message 物件"""
+
+    def __init__(self, latency=0.05, jitter=0.2):
+        self.latency = latency
+        self.jitter = jitter
+        self.message_ids = itertools.count(1000)
+        self.stats = {"send_message": 0, "edit_message_text": 0}
+        self.me = User(id=42, first_name="安尼亞", is_bot=True, username="anya_bot")
+
+    async def wait(self):
+        await asyncio.sleep(jittered(self.latency, self.jitter))
+
+    def message(self, chat_id, text):
+        chat = Chat(id=int(chat_id), type=Chat.PRIVATE)
+        message = Message(message_id=next(self.message_ids), date=datetime.datetime.now(datetime.timezone.utc),
+                          chat=chat, from_user=self.me, text=text)
+        message.set_bot(self)
+        return message
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.stats["send_message"] += 1
+        await self.wait()
+        return self.message(chat_id, text)
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        self.stats["edit_message_text"] += 1
+        await self.wait()
+        return self.message(chat_id, text)
+
+class UpdateFactory:
+    """產生合成的 Update（真的 telegram 物件），reply_text 等會經過 FakeBot"""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+
+    def text(self, text, user_id=1, first_name="爸爸", chat_id=None, chat_type=Chat.PRIVATE, reply_to=None):
+        user = User(id=user_id, first_name=first_name, is_bot=False)
+        chat = Chat(id=chat_id if chat_id is not None else user_id, type=chat_type)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        reply_to_message = Message(message_id=next(self.message_ids), date=now, chat=chat, text=reply_to) if reply_to else None
+        message = Message(message_id=next(self.message_ids), date=now, chat=chat, from_user=user, text=text,
+                          reply_to_message=reply_to_message)
+        update = Update(update_id=next(self.update_ids), message=message)
+        update.set_bot(self.bot)
+        message.set_bot(self.bot)
+        return update
+
+    def command(self, text, **kwargs):
+        """/指令 參數...，回傳 (update, context)"""
+        update = self.text(text, **kwargs)
+        return update, SimpleNamespace(args=text.split()[1:], bot=self.bot)
@@ -0,0 +1,147 @@
+import datetime
+
+EVENT_CATEGORIES = ["家庭活動", "醫生預約", "垃圾回收", "上課提醒", "生日"]
+EXPENSE_CATEGORIES = ["食物", "交通", "娛樂", "醫療", "購物", "其他"]
+MEMORY_CATEGORIES = ["人物", "喜好", "事件", "設定", "一般"]
+
+# 模型按這個結構回傳 JSON；訊息沒提到的部分回傳 null 或空陣列
+EXTRACTION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "event": {
+            "type": "object",
+            "nullable": True,
+            "properties": {
+                "title": {"type": "string"},
+                "category": {"type": "string", "enum": EVENT_CATEGORIES},
+                "date": {"type": "string", "description": "YYYY-MM-DD"},
+                "reminder_days": {"type": "integer"},
+            },
+            "required": ["title", "category", "date"],
+        },
+        "shopping": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "item": {"type": "string"},
+                    "quantity": {"type": "string"},
+                },
+                "required": ["item"],
+            },
+        },
+        "expense": {
+            "type": "object",
+            "nullable": True,
+            "properties": {
+                "amount": {"type": "number"},
+                "category": {"type": "string", "enum": EXPENSE_CATEGORIES},
+                "description": {"type": "string"},
+            },
+            "required": ["amount", "category", "description"],
+        },
+        "memory": {
+            "type": "object",
+            "nullable": True,
+            "properties": {
+                "content": {"type": "string"},
+                "category": {"type": "string", "enum": MEMORY_CATEGORIES},
+            },
+            "required": ["content", "category"],
+        },
+    },
+    "required": ["event", "shopping", "expense", "memory"],
+}
+GENERATION_CONFIG = {"response_mime_type": "application/json", "response_schema": EXTRACTION_SCHEMA}
+MAX_REMINDER_DAYS = 30
+# 路由意圖對應的欄位
+INTENT_FIELDS = {"calendar": "event", "shopping": "shopping", "expense": "expense", "memory_save": "memory"}
+
+def build_prompt(text, today, intents=()):
+    """intents 是路由找到的意圖，只作提示，模型仍可找出其他部分"""
+    fields = [INTENT_FIELDS[i] for i in intents if i in INTENT_FIELDS]
+    prompt = "從以下訊息一次提取所有資料，沒有提到的部分回傳 null 或空陣列，不要猜測：\n"
+    prompt += "- event：要加入的行程，date 用 YYYY-MM-DD，reminder_days 是提前幾天提醒（預設 1）\n"
+    prompt += "- shopping：要買的物品，quantity 沒提到就填 1\n"
+    prompt += "- expense：已花的錢，amount 只填數字\n"
+    prompt += "- memory：用戶明確要求記住的事，content 用一句話寫清楚\n"
+    if fields:
+        prompt += "訊息可能包含：" + "、".join(fields) + "\n"
+    prompt += "今天日期：" + today.isoformat() + "\n訊息：" + text
+    return prompt
+
+def clean_text(value):
+    return value.strip() if isinstance(value, str) else ""
+
+def validate_event(data):
+    if not isinstance(data, dict):
+        return None
+    title = clean_text(data.get("title"))
+    try:
+        event_date = datetime.date.fromisoformat(clean_text(data.get("date")))
+    except ValueError:
+        return None
+    if not title:
+        return None
+    category = data.get("category") if data.get("category") in EVENT_CATEGORIES else "家庭活動"
+    reminder_days = data.get("reminder_days")
+    if not isinstance(reminder_days, int) or isinstance(reminder_days, bool):
+        reminder_days = 1
+    reminder_days = min(max(reminder_days, 0), MAX_REMINDER_DAYS)
+    return {"title": title, "category": category, "date": event_date.isoformat(), "reminder_days": reminder_days}
+
+def validate_shopping(data):
+    if not isinstance(data, list):
+        return []
+    items = []
+    seen = set()
+    for d in data:
+        if not isinstance(d, dict):
+            continue
+        item = clean_text(d.get("item"))
+        if not item or item in seen:
+            continue
+        seen.add(item)
+        quantity = d.get("quantity")
+        quantity = str(quantity).strip() if isinstance(quantity, (str, int, float)) and str(quantity).strip() else "1"
+        items.append({"item": item, "quantity": quantity})
+    return items
+
+def validate_expense(data):
+    if not isinstance(data, dict):
+        return None
+    amount = data.get("amount")
+    if isinstance(amount, str):
+        try:
+            amount = float(amount.replace("$", "").replace(",", "").strip())
+        except ValueError:
+            return None
+    if not isinstance(amount, (int, float)) or isinstance(amount, bool) or amount <= 0:
+        return None
+    if amount == int(amount):
+        amount = int(amount)
+    category = data.get("category") if data.get("category") in EXPENSE_CATEGORIES else "其他"
+    return {"amount": amount, "category": category, "description": clean_text(data.get("description")) or category}
+
+def validate_memory(data):
+    if not isinstance(data, dict):
+        return None
+    content = clean_text(data.get("content"))
+    if not content:
+        return None
+    category = data.get("category") if data.get("category") in MEMORY_CATEGORIES else "一般"
+    return {"content": content, "category": category}
+
+def validate(data):
+    """檢查模型回傳的資料，不合格的部分丟棄；回傳 {"event", "shopping", "expense", "memory"}"""
+    if not isinstance(data, dict):
+        data = {}
+    return {
+        "event": validate_event(data.get("event")),
+        "shopping": validate_shopping(data.get("shopping")),
+        "expense": validate_expense(data.get("expense")),
+        "memory": validate_memory(data.get("memory")),
+    }
+
+def is_empty(actions):
+    return not any(actions.values())
@@ -0,0 +1,89 @@
+import os
+import time
+import random
+import asyncio
+import contextlib
+import urllib.parse
+import httpx
+import metrics
+
+HTTP_TIMEOUT = float(os.environ.get("HTTP_TIMEOUT", "10"))
+HTTP_RETRIES = int(os.environ.get("HTTP_RETRIES", "2"))
+HTTP_BACKOFF = float(os.environ.get("HTTP_BACKOFF", "0.5"))
+HTTP_MAX_CONNECTIONS = int(os.environ.get("HTTP_MAX_CONNECTIONS", "50"))
+HTTP_KEEPALIVE_PER_POOL = int(os.environ.get("HTTP_KEEPALIVE_PER_POOL", "20"))
+
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
+DEFAULT_HEADERS = {"User-Agent": USER_AGENT, "Accept-Language": "en-CA,en;q=0.9"}
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+REQUEST_SECONDS = metrics.Histogram("http_client_request_seconds", "Outbound HTTP latency (headers received) per attempt",
+                                    ["host", "outcome"])
+
+def outcome(status_code):
+    return str(status_code // 100) + "xx"
+
+def observe(url, started, result):
+    REQUEST_SECONDS.observe(time.perf_counter() - started, host=urllib.parse.urlsplit(url).hostname or "", outcome=result)
+
+# 全部請求共用一個 client（連線池綁定 Application 的事件循環）
+_client = None
+
+def get_client():
+    """取得共用的 AsyncClient；同一網站的連線會保持並重用"""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            headers=DEFAULT_HEADERS,
+            timeout=HTTP_TIMEOUT,
+            follow_redirects=True,
+            limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS,
+                                max_keepalive_connections=HTTP_KEEPALIVE_PER_POOL,
+                                keepalive_expiry=60),
+        )
+    return _client
+
+async def backoff(attempt):
+    await asyncio.sleep(HTTP_BACKOFF * (2 ** attempt) * random.uniform(0.5, 1.5))
+
+async def get(url, params=None, headers=None, timeout=None, retries=None):
+    """GET 請求；連線錯誤、逾時和 429/5xx 會按指數退避重試"""
+    client = get_client()
+    retries = HTTP_RETRIES if retries is None else retries
+    for attempt in range(retries + 1):
+        started = time.perf_counter()
+        try:
+            res = await client.get(url, params=params, headers=headers, timeout=timeout or HTTP_TIMEOUT)
+            observe(url, started, outcome(res.status_code))
+            if res.status_code in RETRY_STATUS and attempt < retries:
+                await backoff(attempt)
+                continue
+            return res
+        except httpx.TransportError as e:
+            observe(url, started, type(e).__name__)
+            if attempt >= retries:
+                raise
+            await backoff(attempt)
+
+@contextlib.asynccontextmanager
+async def stream(url, headers=None, timeout=None):
+    """串流 GET，不重試；離開 with 就關閉回應，未讀完的部分不再下載"""
+    client = get_client()
+    started = time.perf_counter()
+    try:
+        async with client.stream("GET", url, headers=headers, timeout=timeout or HTTP_TIMEOUT) as res:
+            observe(url, started, outcome(res.status_code))
+            # 之後讀內容時的錯誤不再計入
+            started = None
+            yield res
+    except httpx.TransportError as e:
+        if started is not None:
+            observe(url, started, type(e).__name__)
+        raise
+
+async def aclose():
+    """關閉共用的 client"""
+    global _client
+    client, _client = _client, None
+    if client is not None:
+        await client.aclose()
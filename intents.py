@@ -0,0 +1,148 @@
+import re
+
+# 各意圖的關鍵字，按優先次序排列：同一訊息命中多個意圖時取排最前的
+INTENT_KEYWORDS = [
+    ("calendar", ["加入行程", "新增行程"]),
+    ("expense", ["支出", "花了", "記帳"]),
+    ("shopping", ["購物", "加入清單", "購物清單", "要買", "記得買", "幫我買", "幫手買", "去買", "買埋", "買啲"]),
+    ("memory_save", ["記錄", "記住"]),
+    ("news", ["發新聞", "今日新聞", "要新聞", "給我新聞", "看新聞"]),
+    ("weather", ["天氣", "氣溫", "氣温", "溫度", "預報", "下雨", "下雪"]),
+    ("search", ["最新", "最近", "近期", "搜尋",
+                "幾多錢", "價格", "股價", "匯率",
+                "天氣", "溫度", "預報", "氣温",
+                "誰是", "是誰", "哪裡", "在哪",
+                "公投", "選舉", "政策", "法例", "新政",
+                "消息", "新聞", "發生咗", "發生什麼"]),
+]
+INTENT_PRIORITY = [name for name, _ in INTENT_KEYWORDS] + ["chat"]
+# 「花了」常見於「花了很多時間」，要同時有金額才算記帳
+AMOUNT_REQUIRED = {"花了"}
+AMOUNT_PATTERN = re.compile(r"[\d$＄元蚊塊]")
+# 打招呼和問日期不用搜尋
+NO_SEARCH_KEYWORDS = ["今日是", "今天是", "星期幾", "你好", "在嗎", "在唔在", "是星期"]
+IMPORTANT_KEYWORDS = ["我叫", "我是", "我喜歡", "我討厭", "我住", "記住", "設定",
+                      "他叫", "她叫", "家人", "今天", "發生", "記錄", "早上", "每天", "自動", "要求"]
+# 記憶分類，按優先次序
+CATEGORY_KEYWORDS = [
+    ("人物", ["我叫", "我是", "他叫", "她叫", "家人"]),
+    ("喜好", ["我喜歡", "我討厭", "我愛", "我怕"]),
+    ("事件", ["今天", "昨天", "發生"]),
+    ("設定", ["設定", "偏好", "習慣", "記錄", "早上", "每天", "自動"]),
+]
+CITY_NAMES = {
+    "香港": "Hong Kong", "東京": "Tokyo", "大阪": "Osaka",
+    "上海": "Shanghai", "北京": "Beijing", "台北": "Taipei",
+    "首爾": "Seoul", "新加坡": "Singapore", "曼谷": "Bangkok",
+    "倫敦": "London", "巴黎": "Paris", "紐約": "New York",
+    "洛杉磯": "Los Angeles", "溫哥華": "Vancouver",
+    "多倫多": "Toronto", "卡加利": "Calgary", "愛城": "Edmonton",
+    "蒙特利爾": "Montreal", "渥太華": "Ottawa",
+}
+ENGLISH_CITY = re.compile(r"[A-Z][a-z]+(?:\s+[A-Z][a-z]+)*")
+
+class KeywordMatcher:
+    """Aho-Corasick 多關鍵字比對：掃一次文字就找出所有命中的關鍵字標籤"""
+
+    def __init__(self, keywords):
+        """keywords 是 {關鍵字: [標籤]}"""
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [()]
+        for keyword, labels in keywords.items():
+            state = 0
+            for ch in keyword:
+                nxt = self.goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto[state][ch] = nxt
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append(())
+                state = nxt
+            self.out[state] = self.out[state] + tuple((keyword, label) for label in labels)
+        # 廣度優先建立失敗連結，並把失敗鏈上的輸出合併，比對時不用再沿鏈查找
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for ch, nxt in self.goto[state].items():
+                queue.append(nxt)
+                f = self.fail[state]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(ch, 0) if self.goto[f].get(ch, 0) != nxt else 0
+                self.out[nxt] = self.out[nxt] + self.out[self.fail[nxt]]
+
+    def find(self, text):
+        """回傳 [(結束位置, 關鍵字, 標籤)]"""
+        goto = self.goto
+        fail = self.fail
+        out = self.out
+        matches = []
+        state = 0
+        for i, ch in enumerate(text):
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state]:
+                for keyword, label in out[state]:
+                    matches.append((i, keyword, label))
+        return matches
+
+def build_matcher():
+    keywords = {}
+    def add(keyword, label):
+        keywords.setdefault(keyword, []).append(label)
+    for intent, words in INTENT_KEYWORDS:
+        for w in words:
+            add(w, ("intent", intent))
+    for w in NO_SEARCH_KEYWORDS:
+        add(w, ("no_search", None))
+    for w in IMPORTANT_KEYWORDS:
+        add(w, ("important", None))
+    for category, words in CATEGORY_KEYWORDS:
+        for w in words:
+            add(w, ("category", category))
+    for zh, en in CITY_NAMES.items():
+        add(zh, ("city", en))
+    return KeywordMatcher(keywords)
+
+matcher = build_matcher()
+CATEGORY_ORDER = [c for c, _ in CATEGORY_KEYWORDS]
+
+def route(text):
+    """一次掃描判斷訊息的所有意圖，回傳
+    {"intent": 主要意圖, "intents": 全部命中意圖（按優先次序）, "cities": 城市,
+     "search": 是否需要搜尋, "weather": 是否問天氣, "important": 是否值得記住, "category": 記憶分類}"""
+    intents = set()
+    categories = set()
+    cities = []
+    no_search = False
+    important = False
+    for _, keyword, (kind, value) in matcher.find(text):
+        if kind == "intent":
+            if keyword in AMOUNT_REQUIRED and not AMOUNT_PATTERN.search(text):
+                continue
+            intents.add(value)
+        elif kind == "city":
+            if value not in cities:
+                cities.append(value)
+        elif kind == "category":
+            categories.add(value)
+        elif kind == "important":
+            important = True
+        elif kind == "no_search":
+            no_search = True
+    if no_search:
+        intents.discard("search")
+    if not cities and "weather" in intents:
+        cities = list(dict.fromkeys(ENGLISH_CITY.findall(text)))
+    ordered = [name for name in INTENT_PRIORITY if name in intents]
+    return {
+        "intent": ordered[0] if ordered else "chat",
+        "intents": ordered,
+        "cities": cities,
+        "search": "search" in intents,
+        "weather": "weather" in intents,
+        "important": important,
+        "category": next((c for c in CATEGORY_ORDER if c in categories), "一般"),
+    }
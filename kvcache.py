@@ -0,0 +1,73 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+
+CACHE_DB = os.environ.get("CACHE_DB", "cache.db")
+
+class PersistentCache:
+    """SQLite 鍵值快取，重啟後仍在；可設 TTL，超過 max_entries 就刪掉最久沒用的"""
+
+    def __init__(self, namespace, ttl=None, max_entries=None, path=None):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.conn = sqlite3.connect(path or CACHE_DB, check_same_thread=False, isolation_level=None)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS cache (namespace TEXT, key TEXT, value TEXT, "
+                              "created REAL, used REAL, PRIMARY KEY (namespace, key))")
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys):
+        """回傳找得到且未過期的 {key: value}"""
+        keys = list(keys)
+        if not keys:
+            return {}
+        now = time.time()
+        found = {}
+        with self.lock:
+            for i in range(0, len(keys), 500):
+                batch = keys[i:i + 500]
+                rows = self.conn.execute(
+                    "SELECT key, value, created FROM cache WHERE namespace = ? AND key IN (" + ",".join("?" * len(batch)) + ")",
+                    [self.namespace] + batch).fetchall()
+                for key, value, created in rows:
+                    if self.ttl is None or now - created < self.ttl:
+                        found[key] = json.loads(value)
+            if found:
+                self.conn.executemany("UPDATE cache SET used = ? WHERE namespace = ? AND key = ?",
+                                      [(now, self.namespace, k) for k in found])
+        return found
+
+    def set(self, key, value):
+        self.set_many({key: value})
+
+    def set_many(self, items):
+        if not items:
+            return
+        now = time.time()
+        rows = [(self.namespace, k, json.dumps(v, ensure_ascii=False), now, now) for k, v in items.items()]
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                self.conn.executemany("INSERT OR REPLACE INTO cache (namespace, key, value, created, used) VALUES (?, ?, ?, ?, ?)", rows)
+                self._evict(now)
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def _evict(self, now):
+        if self.ttl is not None:
+            self.conn.execute("DELETE FROM cache WHERE namespace = ? AND created < ?", (self.namespace, now - self.ttl))
+        if self.max_entries is not None:
+            self.conn.execute(
+                "DELETE FROM cache WHERE namespace = ? AND key NOT IN "
+                "(SELECT key FROM cache WHERE namespace = ? ORDER BY used DESC LIMIT ?)",
+                (self.namespace, self.namespace, self.max_entries))
@@ -0,0 +1,117 @@
+import time
+import heapq
+import random
+import asyncio
+import itertools
+import contextlib
+
+# 數字越小越優先
+PRIORITY_CHAT = 0
+PRIORITY_MEDIA = 1
+PRIORITY_SUMMARY = 2
+PRIORITY_NEWS = 3
+PRIORITY_BACKGROUND = 4
+PRIORITY_NAMES = {
+    PRIORITY_CHAT: "chat",
+    PRIORITY_MEDIA: "media",
+    PRIORITY_SUMMARY: "summary",
+    PRIORITY_NEWS: "news",
+    PRIORITY_BACKGROUND: "background",
+}
+
+class LLMQueue:
+    """模型呼叫的優先佇列：同時最多 concurrency 個，空出位置時先給優先度高的；
+    配額錯誤按指數退避加隨機抖動重試，過了期限就放棄。
+    只在 Application 的事件循環內使用，不需要鎖"""
+
+    def __init__(self, concurrency, limiter=None, retry_on=(), max_retries=4, backoff=2.0, max_backoff=60.0):
+        self.concurrency = concurrency
+        self.limiter = limiter
+        self.retry_on = tuple(retry_on)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.active = 0
+        self.waiters = []
+        self.seq = itertools.count()
+        self.stats = {"queued": 0, "retries": 0, "expired": 0, "gave_up": 0}
+
+    def waiting(self):
+        """每個優先度在排隊的數量"""
+        counts = {}
+        for priority, _, _, state in self.waiters:
+            if state[0] == "waiting":
+                name = PRIORITY_NAMES.get(priority, priority)
+                counts[name] = counts.get(name, 0) + 1
+        return counts
+
+    async def _acquire(self, priority, deadline):
+        while self.waiters and self.waiters[0][3][0] != "waiting":
+            heapq.heappop(self.waiters)
+        if self.active < self.concurrency and not self.waiters:
+            self.active += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        # 位置可能剛給了這個等候者，它就逾時或被取消；state 記下來，這時要把位置讓給下一個
+        state = ["waiting"]
+        heapq.heappush(self.waiters, (priority, next(self.seq), future, state))
+        self.stats["queued"] += 1
+        try:
+            await asyncio.wait_for(future, max(0.0, deadline - time.monotonic()))
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            granted = state[0] == "granted"
+            state[0] = "cancelled"
+            if granted:
+                self._release()
+            self.stats["expired"] += 1
+            raise
+
+    def _release(self):
+        while self.waiters:
+            _, _, future, state = heapq.heappop(self.waiters)
+            if state[0] != "waiting" or future.done():
+                continue
+            future.set_result(None)
+            state[0] = "granted"
+            return
+        self.active -= 1
+
+    @contextlib.asynccontextmanager
+    async def slot(self, priority, deadline):
+        """排隊取得一個執行位置和一個全域令牌；到期前拿不到拋 asyncio.TimeoutError"""
+        await self._acquire(priority, deadline)
+        try:
+            if self.limiter is not None:
+                await self.limiter.acquire_llm(max_wait=deadline - time.monotonic())
+            yield
+        finally:
+            self._release()
+
+    def retry_delay(self, attempt, deadline):
+        """配額錯誤後要等多久再試；不應再試就回傳 None"""
+        if self.limiter is not None:
+            self.limiter.on_quota_exceeded()
+        delay = min(self.max_backoff, self.backoff * (2 ** attempt)) * random.uniform(0.5, 1.5)
+        if attempt >= self.max_retries or time.monotonic() + delay >= deadline:
+            self.stats["gave_up"] += 1
+            return None
+        self.stats["retries"] += 1
+        return delay
+
+    async def run(self, priority, call, deadline):
+        """call(剩餘秒數) 是協程函式；排隊執行，配額錯誤退避重試，到期拋 asyncio.TimeoutError"""
+        attempt = 0
+        while True:
+            try:
+                async with self.slot(priority, deadline):
+                    result = await call(deadline - time.monotonic())
+            except self.retry_on:
+                delay = self.retry_delay(attempt, deadline)
+                if delay is None:
+                    raise
+                attempt += 1
+                await asyncio.sleep(delay)
+                continue
+            if self.limiter is not None:
+                self.limiter.on_success()
+            return result
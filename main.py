@@ -1,19 +1,61 @@
 import os
+import time
+import web
+
+# 先開健康檢查端口，平台探測不用等下面載入 SDK、選模型和建立資料庫連線
+STARTUP_BEGAN = time.perf_counter()
+if __name__ == "__main__":
+    web.start(int(os.environ.get("PORT", 8080)))
+startup_phases = [("health_server", time.perf_counter() - STARTUP_BEGAN)]
+startup_mark = time.perf_counter()
+
+def startup_phase(name):
+    """記錄上一個階段到現在的耗時"""
+    global startup_mark
+    now = time.perf_counter()
+    startup_phases.append((name, now - startup_mark))
+    startup_mark = now
+
+def startup_report():
+    total = time.perf_counter() - STARTUP_BEGAN
+    return "啟動耗時：" + "，".join(f"{name} {seconds * 1000:.0f}ms" for name, seconds in startup_phases) + f"，共 {total * 1000:.0f}ms"
+
 import threading
 import asyncio
-import requests
+import collections
+import functools
+import contextvars
 import re
+import random
 import json
-import xml.etree.ElementTree as ET
-from http.server import HTTPServer, BaseHTTPRequestHandler
+import hashlib
+import hmac
+import contextlib
+import urllib.parse
 import google.generativeai as genai
 import google.api_core.exceptions
-from telegram import Update, Bot
+from telegram import Update
+from telegram.error import BadRequest, NetworkError
 from telegram.ext import ApplicationBuilder, MessageHandler, CommandHandler, filters, ContextTypes
 from memory import MemoryDB
+from watchlist import WatchlistStore
+import prices
+import intents
+import extraction
+import http_client
+import metrics
+import tracing
+from profiler import SamplingProfiler, MIN_INTERVAL
+from kvcache import PersistentCache
+from prompt_budget import PromptBudget, estimate_tokens
+from streaming import StreamingReply
+from ratelimit import RateLimiter
+from scheduler import Scheduler
+from llm_queue import LLMQueue, PRIORITY_NAMES, PRIORITY_CHAT, PRIORITY_MEDIA, PRIORITY_SUMMARY, PRIORITY_NEWS, PRIORITY_BACKGROUND
 import datetime
-import PIL.Image
 import io
+from concurrent.futures import ThreadPoolExecutor
+startup_phase("imports")
 
 TELEGRAM_BOT_TOKEN = os.environ["TELEGRAM_BOT_TOKEN"]
 GEMINI_API_KEY = os.environ["GEMINI_API_KEY"]
@@ -22,27 +64,52 @@ TRIGGER_KEYWORD = "安尼亞"
 
 genai.configure(api_key=GEMINI_API_KEY)
 
+# 選用的模型存在磁碟快取，啟動時直接用；過了 MODEL_CACHE_TTL 或沒有快取就在背景重新查詢
+PREFERRED_MODELS = ["models/gemini-2.5-flash", "models/gemini-1.5-flash-latest",
+                    "models/gemini-1.5-flash", "models/gemini-1.0-pro"]
+# 沒有快取（例如每次重新部署磁碟都是空的）時先用最偏好的模型，查詢完成前的訊息也能用
+DEFAULT_MODEL = os.environ.get("GEMINI_MODEL", PREFERRED_MODELS[0])
+MODEL_CACHE_TTL = float(os.environ.get("MODEL_CACHE_TTL", str(24 * 3600)))
+model_cache = PersistentCache("model_selection")
+
 def get_stable_model():
+    """向 API 查詢可用模型並按偏好挑選；查詢失敗回傳 None"""
     try:
-        available = []
-        for m in genai.list_models():
-            if 'generateContent' in m.supported_generation_methods:
-                available.append(m.name)
-                print(f"可用模型: {m.name}")
-        for preferred in ['models/gemini-2.5-flash', 'models/gemini-1.5-flash-latest',
-                          'models/gemini-1.5-flash', 'models/gemini-1.0-pro']:
-            if preferred in available:
-                print(f"使用: {preferred}")
-                return preferred
-        if available:
-            print(f"使用第一個可用: {available[0]}")
-            return available[0]
+        available = [m.name for m in genai.list_models() if "generateContent" in m.supported_generation_methods]
     except Exception as e:
         print(f"查找失敗: {e}")
-    return 'models/gemini-1.5-flash'
+        return None
+    print(f"可用模型 {len(available)} 個")
+    for preferred in PREFERRED_MODELS:
+        if preferred in available:
+            return preferred
+    return available[0] if available else None
+
+def load_model_name():
+    """回傳 (模型名稱, 是否需要重新查詢)"""
+    cached = model_cache.get("model")
+    if cached and cached.get("name"):
+        return cached["name"], time.time() - cached.get("checked", 0) > MODEL_CACHE_TTL
+    return DEFAULT_MODEL, True
+
+def use_model(name):
+    global MODEL_NAME, chat_model
+    MODEL_NAME = name
+    chat_model = genai.GenerativeModel(model_name=name)
+    print(f"使用: {name}")
+
+async def refresh_model():
+    name = await asyncio.get_running_loop().run_in_executor(None, get_stable_model)
+    if name is None:
+        return
+    model_cache.set("model", {"name": name, "checked": time.time()})
+    if name != MODEL_NAME:
+        use_model(name)
 
-MODEL_NAME = get_stable_model()
-chat_model = genai.GenerativeModel(model_name=MODEL_NAME)
+cached_model, model_stale = load_model_name()
+model_refresh_task = None
+use_model(cached_model)
+startup_phase("model")
 
 import importlib.metadata
 try:
@@ -51,203 +118,374 @@ try:
 except Exception:
     pass
 
-
-
 memory_db = MemoryDB()
-last_reply = {}
-
-
-def web_search(query):
-    headers = {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"}
+startup_phase("memory_db")
+
+# 限流：每位用戶、每個群組和整體模型配額各一個令牌桶；超出時排隊，要等太久才拒絕
+rate_limiter = RateLimiter(
+    user_per_min=float(os.environ.get("RATE_USER_PER_MIN", "6")),
+    user_burst=int(os.environ.get("RATE_USER_BURST", "3")),
+    chat_per_min=float(os.environ.get("RATE_CHAT_PER_MIN", "20")),
+    chat_burst=int(os.environ.get("RATE_CHAT_BURST", "5")),
+    llm_per_min=float(os.environ.get("GEMINI_RPM", "15")),
+    max_entries=int(os.environ.get("RATE_MAX_ENTRIES", "10000")),
+    max_wait=float(os.environ.get("RATE_MAX_WAIT", "120")),
+)
+RATE_NOTICE_AFTER = float(os.environ.get("RATE_NOTICE_AFTER", "3"))
+
+# Gemini SDK 是同步的，放到專用線程池執行，避免一個慢回覆卡住所有對話
+LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", "4"))
+LLM_TIMEOUT = float(os.environ.get("LLM_TIMEOUT", "60"))
+llm_executor = ThreadPoolExecutor(max_workers=LLM_MAX_CONCURRENCY, thread_name_prefix="llm")
+
+# 所有模型呼叫經同一個優先佇列：對話 > 圖片/語音 > 摘要 > 新聞 > 背景整理；配額錯誤時低優先的工作延後
+llm_queue = LLMQueue(
+    concurrency=LLM_MAX_CONCURRENCY,
+    limiter=rate_limiter,
+    retry_on=(google.api_core.exceptions.ResourceExhausted,),
+    max_retries=int(os.environ.get("LLM_MAX_RETRIES", "4")),
+    backoff=float(os.environ.get("LLM_BACKOFF", "2")),
+    max_backoff=float(os.environ.get("LLM_MAX_BACKOFF", "60")),
+)
+# 各優先度從排隊到完成的期限（秒），包括重試
+LLM_DEADLINES = {
+    PRIORITY_CHAT: float(os.environ.get("LLM_CHAT_DEADLINE", "90")),
+    PRIORITY_MEDIA: float(os.environ.get("LLM_MEDIA_DEADLINE", "120")),
+    PRIORITY_SUMMARY: float(os.environ.get("LLM_SUMMARY_DEADLINE", "180")),
+    PRIORITY_NEWS: float(os.environ.get("LLM_NEWS_DEADLINE", "600")),
+    PRIORITY_BACKGROUND: float(os.environ.get("LLM_BACKGROUND_DEADLINE", "1800")),
+}
+
+# 對話回覆邊生成邊顯示；Telegram 編輯訊息有頻率限制，群組更嚴
+STREAM_REPLIES = os.environ.get("STREAM_REPLIES", "1") == "1"
+STREAM_EDIT_INTERVAL = float(os.environ.get("STREAM_EDIT_INTERVAL", "1.0"))
+STREAM_GROUP_EDIT_INTERVAL = float(os.environ.get("STREAM_GROUP_EDIT_INTERVAL", "3.0"))
+
+# 系統提示只放和訊息相關的記憶：本地檢索索引隨 add_memory 更新，
+# 每 MEMORY_INDEX_SYNC_INTERVAL 秒在背景讀入其他進程新增的記憶，
+# 每 MEMORY_INDEX_REBUILD_INTERVAL 秒整個重建（同步不到其他進程的修改和刪除）
+MEMORY_INDEX_SYNC_INTERVAL = float(os.environ.get("MEMORY_INDEX_SYNC_INTERVAL", "300"))
+MEMORY_INDEX_REBUILD_INTERVAL = float(os.environ.get("MEMORY_INDEX_REBUILD_INTERVAL", str(6 * 3600)))
+MEMORY_TOP_K = int(os.environ.get("MEMORY_TOP_K", "8"))
+MEMORY_BUDGET_CHARS = int(os.environ.get("MEMORY_BUDGET_CHARS", "1500"))
+MEMORY_RECENT_EVENTS = int(os.environ.get("MEMORY_RECENT_EVENTS", "3"))
+
+# 對話提示的 token 預算：超出時先截短搜尋結果，再截短記憶，最後才截短用戶訊息
+chat_prompt_budget = PromptBudget(
+    int(os.environ.get("PROMPT_TOKEN_BUDGET", "4000")),
+    caps={
+        "memory": int(os.environ.get("PROMPT_MEMORY_TOKENS", "1000")),
+        "search": int(os.environ.get("PROMPT_SEARCH_TOKENS", "1500")),
+        "user": int(os.environ.get("PROMPT_USER_TOKENS", "1500")),
+    },
+    trim_order=["search", "memory", "user"],
+)
+
+# 定期整理記憶：事件只保留最新幾條原文，每人喜好太多就合成摘要
+MEMORY_COMPACT_INTERVAL = float(os.environ.get("MEMORY_COMPACT_INTERVAL", str(24 * 3600)))
+MEMORY_KEEP_EVENTS = int(os.environ.get("MEMORY_KEEP_EVENTS", "30"))
+MEMORY_MAX_PREFS_PER_PERSON = int(os.environ.get("MEMORY_MAX_PREFS_PER_PERSON", "15"))
+# 每次摘要送給模型的記憶上限（token），太多會超過 LLM_TIMEOUT
+MEMORY_SUMMARY_TOKENS = int(os.environ.get("MEMORY_SUMMARY_TOKENS", "4000"))
+
+# 啟動後由 on_startup 設定；背景工作用它的 Bot 發訊息
+telegram_app = None
+SHUTDOWN_GRACE = float(os.environ.get("SHUTDOWN_GRACE", "10"))
+
+def shared_bot():
+    return telegram_app.bot
+
+# 排程：下次執行時間放在最小堆，睡到到期才醒；上次執行時間存檔，重啟後錯過的在 *_CATCH_UP 秒內會補跑
+scheduler = Scheduler()
+REMINDER_HOUR = int(os.environ.get("REMINDER_HOUR", "8"))
+REMINDER_CATCH_UP = float(os.environ.get("REMINDER_CATCH_UP", str(12 * 3600)))
+REMINDER_LOOKAHEAD_DAYS = int(os.environ.get("REMINDER_LOOKAHEAD_DAYS", "400"))
+NEWS_HOUR = int(os.environ.get("NEWS_HOUR", "9"))
+NEWS_CATCH_UP = float(os.environ.get("NEWS_CATCH_UP", str(3 * 3600)))
+PRICE_CHECK_INTERVAL = float(os.environ.get("PRICE_CHECK_INTERVAL", "3600"))
+
+
+HTML_TAG = re.compile(r"<[^>]+>")
+
+# 搜尋結果快取（正規化後的問題 -> 結果），以及各搜尋來源的命中率和延遲
+SEARCH_CACHE_TTL = float(os.environ.get("SEARCH_CACHE_TTL", "900"))
+SEARCH_CACHE_SIZE = int(os.environ.get("SEARCH_CACHE_SIZE", "256"))
+SEARCH_MODE = os.environ.get("SEARCH_MODE", "hedged")  # hedged：兩個來源同時查；sequential：先 DuckDuckGo 再 Google News
+SEARCH_DEADLINE = float(os.environ.get("SEARCH_DEADLINE", "8"))
+search_cache = collections.OrderedDict()
+search_stats = {}
+
+def normalize_query(query):
+    query = query.replace(TRIGGER_KEYWORD, "").lower()
+    query = re.sub(r"[\s，,。.？?！!、]+", " ", query)
+    return query.strip()
+
+async def search_duckduckgo(encoded):
+    url = "https://api.duckduckgo.com/?q=" + encoded + "&format=json&no_html=1&skip_disambig=1"
+    res = await http_client.get(url, timeout=SEARCH_DEADLINE, retries=0)
+    data = res.json()
+    results = []
+    if data.get("AbstractText"):
+        results.append(data["AbstractText"])
+    for r in data.get("RelatedTopics", [])[:4]:
+        if isinstance(r, dict) and r.get("Text"):
+            results.append(r["Text"])
+    return "\n\n".join(results[:5]) if results else None
+
+async def search_google_news(encoded):
+    url = "https://news.google.com/rss/search?q=" + encoded + "&hl=zh-TW&gl=CA&ceid=CA:zh-Hant"
+    res = await http_client.get(url, timeout=SEARCH_DEADLINE, retries=0)
+    import xml.etree.ElementTree as ET
+    root = ET.fromstring(res.content)
+    items = root.findall(".//item")
+    results = []
+    for item in items[:5]:
+        title = item.findtext("title") or ""
+        desc = HTML_TAG.sub("", item.findtext("description") or "").strip()
+        if title:
+            results.append(title + ": " + desc)
+    return "\n\n".join(results) if results else None
+
+SEARCH_PROVIDERS = [("DuckDuckGo", search_duckduckgo), ("Google News RSS", search_google_news)]
+
+async def run_search_provider(name, provider, encoded):
+    """執行一個搜尋來源並記錄 calls / hits / errors / 延遲"""
+    stats = search_stats.setdefault(name, {"calls": 0, "hits": 0, "errors": 0, "cancelled": 0, "latency_total": 0.0})
+    stats["calls"] += 1
+    started = time.monotonic()
     try:
-        encoded = requests.utils.quote(query)
-        url = "https://api.duckduckgo.com/?q=" + encoded + "&format=json&no_html=1&skip_disambig=1"
-        res = requests.get(url, headers=headers, timeout=8)
-        data = res.json()
-        results = []
-        if data.get("AbstractText"):
-            results.append(data["AbstractText"])
-        for r in data.get("RelatedTopics", [])[:4]:
-            if isinstance(r, dict) and r.get("Text"):
-                results.append(r["Text"])
-        if results:
-            print("DuckDuckGo 搜尋成功")
-            return "\n\n".join(results[:5])
+        result = await provider(encoded)
+    except asyncio.CancelledError:
+        stats["cancelled"] += 1
+        raise
     except Exception as e:
-        print("DuckDuckGo 失敗: " + str(e))
+        stats["errors"] += 1
+        stats["latency_total"] += time.monotonic() - started
+        print(name + " 失敗: " + str(e))
+        return None
+    stats["latency_total"] += time.monotonic() - started
+    if result:
+        stats["hits"] += 1
+        print(name + " 搜尋成功")
+    return result
+
+async def hedged_search(encoded):
+    """所有來源同時查，回傳第一個有內容的結果，其餘取消"""
+    tasks = [asyncio.create_task(run_search_provider(name, provider, encoded)) for name, provider in SEARCH_PROVIDERS]
     try:
-        encoded = requests.utils.quote(query)
-        url = "https://news.google.com/rss/search?q=" + encoded + "&hl=zh-TW&gl=CA&ceid=CA:zh-Hant"
-        res = requests.get(url, headers=headers, timeout=8)
-        root = ET.fromstring(res.content)
-        items = root.findall(".//item")
-        results = []
-        for item in items[:5]:
-            title = item.findtext("title") or ""
-            desc = re.sub(r"<[^>]+>", "", item.findtext("description") or "").strip()
-            if title:
-                results.append(title + ": " + desc)
-        if results:
-            print("Google News RSS 搜尋成功")
-            return "\n\n".join(results)
-    except Exception as e:
-        print("Google News RSS 失敗: " + str(e))
-    return None
-
-def get_weather(city="Edmonton"):
-    """用 Open-Meteo + Geocoding API 抓取全球任何城市天氣"""
+        for next_done in asyncio.as_completed(tasks, timeout=SEARCH_DEADLINE):
+            try:
+                result = await next_done
+            except asyncio.TimeoutError:
+                break
+            if result:
+                return result
+        return None
+    finally:
+        for task in tasks:
+            task.cancel()
+
+async def sequential_search(encoded):
+    """逐個來源查，整體不超過 SEARCH_DEADLINE"""
+    async def run_all():
+        for name, provider in SEARCH_PROVIDERS:
+            result = await run_search_provider(name, provider, encoded)
+            if result:
+                return result
+        return None
     try:
-        # 先用 geocoding API 查城市座標
-        geo_url = "https://geocoding-api.open-meteo.com/v1/search?name=" + requests.utils.quote(city) + "&count=1&language=en&format=json"
-        geo_res = requests.get(geo_url, timeout=8)
+        return await asyncio.wait_for(run_all(), SEARCH_DEADLINE)
+    except asyncio.TimeoutError:
+        return None
+
+@tracing.traced("web_search")
+async def web_search(query):
+    key = normalize_query(query)
+    cached = search_cache.get(key)
+    if cached and time.monotonic() - cached[0] < SEARCH_CACHE_TTL:
+        search_cache.move_to_end(key)
+        return cached[1]
+    encoded = urllib.parse.quote(query)
+    if SEARCH_MODE == "sequential":
+        result = await sequential_search(encoded)
+    else:
+        result = await hedged_search(encoded)
+    if result:
+        search_cache[key] = (time.monotonic(), result)
+        search_cache.move_to_end(key)
+        while len(search_cache) > SEARCH_CACHE_SIZE:
+            search_cache.popitem(last=False)
+    return result
+
+WEATHER_CODES = {
+    0: "晴天", 1: "大致晴朗", 2: "間多雲", 3: "陰天",
+    45: "有霧", 48: "霧凇",
+    51: "毛毛雨", 53: "中度毛毛雨", 55: "大毛毛雨",
+    61: "小雨", 63: "中雨", 65: "大雨",
+    71: "小雪", 73: "中雪", 75: "大雪", 77: "雪粒",
+    80: "陣雨", 81: "中度陣雨", 82: "大陣雨",
+    85: "陣雪", 86: "大陣雪",
+    95: "雷暴", 96: "雷暴伴冰雹", 99: "大雷暴"
+}
+# 城市座標不會變，存到磁碟；查不到的名稱（多數是路由誤判的大寫字）短期記住，不用每次再查；天氣只快取幾分鐘
+WEATHER_TTL = float(os.environ.get("WEATHER_TTL", "600"))
+GEOCODE_MISS_TTL = float(os.environ.get("GEOCODE_MISS_TTL", "3600"))
+geocode_cache = PersistentCache("geocode", max_entries=2000)
+geocode_misses = PersistentCache("geocode_miss", ttl=GEOCODE_MISS_TTL, max_entries=2000)
+forecast_cache = PersistentCache("forecast", ttl=WEATHER_TTL, max_entries=500)
+
+async def geocode(city):
+    """城市名 -> {name, country, latitude, longitude}，查過的直接用快取"""
+    key = city.strip().lower()
+    place = geocode_cache.get(key)
+    if place is None:
+        if geocode_misses.get(key):
+            return None
+        geo_url = "https://geocoding-api.open-meteo.com/v1/search?name=" + urllib.parse.quote(city) + "&count=1&language=en&format=json"
+        geo_res = await http_client.get(geo_url, timeout=8)
         geo_data = geo_res.json()
         if not geo_data.get("results"):
+            geocode_misses.set(key, True)
             return None
         result_city = geo_data["results"][0]
-        lat = result_city["latitude"]
-        lon = result_city["longitude"]
-        city_name = result_city["name"]
-        country = result_city.get("country", "")
-        # 抓天氣
-        weather_url = "https://api.open-meteo.com/v1/forecast?latitude=" + str(lat) + "&longitude=" + str(lon) + "&current=temperature_2m,relative_humidity_2m,wind_speed_10m,weather_code,apparent_temperature&wind_speed_unit=kmh&timezone=auto"
-        weather_res = requests.get(weather_url, timeout=8)
-        weather_data = weather_res.json()
-        current = weather_data["current"]
-        temp = current["temperature_2m"]
-        feels_like = current["apparent_temperature"]
-        humidity = current["relative_humidity_2m"]
-        wind = current["wind_speed_10m"]
-        code = current["weather_code"]
-        weather_desc = {
-            0: "晴天", 1: "大致晴朗", 2: "間多雲", 3: "陰天",
-            45: "有霧", 48: "霧凇",
-            51: "毛毛雨", 53: "中度毛毛雨", 55: "大毛毛雨",
-            61: "小雨", 63: "中雨", 65: "大雨",
-            71: "小雪", 73: "中雪", 75: "大雪", 77: "雪粒",
-            80: "陣雨", 81: "中度陣雨", 82: "大陣雨",
-            85: "陣雪", 86: "大陣雪",
-            95: "雷暴", 96: "雷暴伴冰雹", 99: "大雷暴"
+        place = {
+            "name": result_city["name"],
+            "country": result_city.get("country", ""),
+            "latitude": result_city["latitude"],
+            "longitude": result_city["longitude"]
         }
-        desc = weather_desc.get(code, "未知")
-        result = city_name + "，" + country + " 現時天氣\n"
-        result += "天氣：" + desc + "\n"
-        result += "氣溫：" + str(temp) + "°C（體感 " + str(feels_like) + "°C）\n"
-        result += "濕度：" + str(humidity) + "%\n"
-        result += "風速：" + str(wind) + " km/h"
-        return result
+        geocode_cache.set(key, place)
+    return place
+
+async def fetch_current_weather(places):
+    """一個請求抓多個地點的現時天氣，快取內未過期的不再請求"""
+    coords = {f"{p['latitude']},{p['longitude']}": (p["latitude"], p["longitude"]) for p in places}
+    currents = forecast_cache.get_many(coords)
+    missing = [key for key in coords if key not in currents]
+    if missing:
+        weather_url = ("https://api.open-meteo.com/v1/forecast?latitude=" + ",".join(str(coords[k][0]) for k in missing)
+                       + "&longitude=" + ",".join(str(coords[k][1]) for k in missing)
+                       + "&current=temperature_2m,relative_humidity_2m,wind_speed_10m,weather_code,apparent_temperature&wind_speed_unit=kmh&timezone=auto")
+        weather_res = await http_client.get(weather_url, timeout=8)
+        weather_data = weather_res.json()
+        # 一個地點回傳物件，多個地點回傳陣列
+        if isinstance(weather_data, dict):
+            weather_data = [weather_data]
+        fetched = {key: data["current"] for key, data in zip(missing, weather_data)}
+        forecast_cache.set_many(fetched)
+        currents.update(fetched)
+    return [currents[f"{p['latitude']},{p['longitude']}"] for p in places]
+
+def format_weather(place, current):
+    desc = WEATHER_CODES.get(current["weather_code"], "未知")
+    result = place["name"] + "，" + place["country"] + " 現時天氣\n"
+    result += "天氣：" + desc + "\n"
+    result += "氣溫：" + str(current["temperature_2m"]) + "°C（體感 " + str(current["apparent_temperature"]) + "°C）\n"
+    result += "濕度：" + str(current["relative_humidity_2m"]) + "%\n"
+    result += "風速：" + str(current["wind_speed_10m"]) + " km/h"
+    return result
+
+@tracing.traced("get_weather_many")
+async def get_weather_many(cities):
+    """多個城市的天氣，回傳和 cities 同順序的清單，查不到的是 None"""
+    try:
+        places = await asyncio.gather(*(geocode(c) for c in cities), return_exceptions=True)
+        found = [p for p in places if isinstance(p, dict)]
+        if not found:
+            return [None] * len(cities)
+        currents = dict(zip((id(p) for p in found), await fetch_current_weather(found)))
+        return [format_weather(p, currents[id(p)]) if isinstance(p, dict) else None for p in places]
     except Exception as e:
         print("天氣抓取失敗: " + str(e))
-        return None
-
-def needs_search(text):
-    simple_patterns = ["今日是", "今天是", "星期幾", "你好", "在嗎", "在唔在", "是星期"]
-    if any(p in text for p in simple_patterns):
-        return False
-    search_triggers = [
-        "最新", "最近", "近期", "搜尋",
-        "幾多錢", "價格", "股價", "匯率",
-        "天氣", "溫度", "預報", "氣温",
-        "誰是", "是誰", "哪裡", "在哪",
-        "公投", "選舉", "政策", "法例", "新政",
-        "消息", "新聞", "發生咗", "發生什麼"
-    ]
-    return any(kw in text for kw in search_triggers)
+        return [None] * len(cities)
 
+watchlist_store = WatchlistStore(os.environ.get("WATCHLIST_DB", "watchlist.db"))
 
 def load_watchlist():
-    """從檔案載入監控清單"""
+    """從資料庫載入監控清單"""
     try:
-        if os.path.exists("watchlist.json"):
-            with open("watchlist.json", "r", encoding="utf-8") as f:
-                return json.load(f)
-    except:
-        pass
+        return watchlist_store.load()
+    except Exception as e:
+        print("載入監控清單失敗: " + str(e))
     return {}
 
-def save_watchlist(watchlist):
-    """儲存監控清單到檔案"""
+def save_watchlist(watchlist, urls):
+    """儲存監控清單中 urls 這幾件（已從清單刪除的會被刪掉），全部在一個交易內完成"""
     try:
-        with open("watchlist.json", "w", encoding="utf-8") as f:
-            json.dump(watchlist, f, ensure_ascii=False, indent=2)
+        watchlist_store.save(watchlist, urls)
     except Exception as e:
         print("儲存監控清單失敗: " + str(e))
 
-def fetch_price(url):
-    """抓取網頁價格"""
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
-        "Accept-Language": "en-CA,en;q=0.9"
-    }
+@tracing.traced("fetch_product")
+async def fetch_product(url):
+    """下載一次商品頁，回傳快照：價格、標題、幣別、存貨、正規網址；找到價格和頁首資料就停止下載"""
     try:
-        res = requests.get(url, headers=headers, timeout=15)
-        html = res.text
-        # Amazon
-        if "amazon.ca" in url or "amazon.com" in url:
-            patterns = [
-                r'class="a-price-whole">([\d,]+)',
-                r'"priceAmount":([\d.]+)',
-                r'id="priceblock_ourprice"[^>]*>\$?([\d,\.]+)',
-                r'"price":\s*([\d.]+)',
-            ]
-            for p in patterns:
-                m = re.search(p, html)
-                if m:
-                    return float(m.group(1).replace(",", ""))
-        # Best Buy
-        elif "bestbuy.ca" in url:
-            patterns = [
-                r'"salePrice":([\d.]+)',
-                r'"regularPrice":([\d.]+)',
-                r'data-automation="product-price"[^>]*>\$?([\d,\.]+)',
-            ]
-            for p in patterns:
-                m = re.search(p, html)
-                if m:
-                    return float(m.group(1).replace(",", ""))
-        # Canadian Tire
-        elif "canadiantire.ca" in url:
-            patterns = [
-                r'"offering-price"[^>]*>\$?([\d,\.]+)',
-                r'"price":{"value":([\d.]+)',
-                r'data-price="([\d.]+)"',
-            ]
-            for p in patterns:
-                m = re.search(p, html)
-                if m:
-                    return float(m.group(1).replace(",", ""))
-        # 通用價格抓取
-        patterns = [
-            r'\$([\d,]+\.\d{2})',
-            r'"price":([\d.]+)',
-            r'"currentPrice":([\d.]+)',
-            r'"salePrice":([\d.]+)',
-        ]
-        for p in patterns:
-            m = re.search(p, html)
-            if m:
-                return float(m.group(1).replace(",", ""))
+        async with http_client.stream(url, timeout=15) as res:
+            # 驗證碼頁和錯誤頁的標題不是商品名稱，不能拿來更新資料
+            if not res.is_success:
+                print("抓取商品失敗: HTTP " + str(res.status_code) + " " + url)
+                return None
+            snapshot, _ = await prices.scan_stream_async(res.aiter_bytes(prices.PRICE_CHUNK_SIZE),
+                                                         url, encoding=res.encoding)
+            return snapshot
     except Exception as e:
-        print("抓取價格失敗: " + str(e))
+        print("抓取商品失敗: " + str(e))
     return None
 
-def get_page_title(url):
-    """抓取網頁標題"""
-    headers = {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"}
-    try:
-        res = requests.get(url, headers=headers, timeout=10)
-        m = re.search(r"<title>([^<]+)</title>", res.text)
-        if m:
-            title = m.group(1).strip()
-            # 清理標題
-            for suffix in [" | Amazon.ca", " - Best Buy", " | Best Buy Canada", " | Canadian Tire", " - Canadian Tire"]:
-                title = title.replace(suffix, "")
-            return title[:60]
-    except:
-        pass
-    return url[:50]
+def find_watched(canonical):
+    """用正規網址找清單中已有的同一件商品"""
+    for url, item in watch_list.items():
+        if url == canonical or prices.canonical_url(url) == canonical:
+            return url
+    return None
 
 # 全域監控清單
 watch_list = load_watchlist()
+startup_phase("watchlist")
+
+# 價格檢查並發設定：全域上限 + 每個網站的上限，同一網站請求之間保持間隔（加隨機抖動）
+PRICE_SWEEP_CONCURRENCY = int(os.environ.get("PRICE_SWEEP_CONCURRENCY", "8"))
+PRICE_HOST_SPACING = float(os.environ.get("PRICE_HOST_SPACING", "1.0"))
+PRICE_HOST_LIMITS = {"amazon.ca": 2, "bestbuy.ca": 2, "canadiantire.ca": 2}
+PRICE_HOST_DEFAULT_LIMIT = 2
+price_sweep_stats = {"last_duration": None, "last_items": 0, "last_finished": None}
+
+def price_host(url):
+    """把網址歸類到零售商，例如 www.amazon.ca -> amazon.ca"""
+    host = (urllib.parse.urlsplit(url).hostname or "").lower()
+    for known in PRICE_HOST_LIMITS:
+        if host == known or host.endswith("." + known):
+            return known
+    return host
+
+@tracing.traced("sweep_prices")
+async def sweep_prices(urls):
+    """並發抓取一批商品快照，回傳 {url: 快照}，抓取失敗的是 None"""
+    loop = asyncio.get_running_loop()
+    global_limit = asyncio.Semaphore(PRICE_SWEEP_CONCURRENCY)
+    host_limits = {}
+    host_next_start = {}
+    started = time.monotonic()
+
+    async def fetch_one(url):
+        host = price_host(url)
+        if host not in host_limits:
+            host_limits[host] = asyncio.Semaphore(PRICE_HOST_LIMITS.get(host, PRICE_HOST_DEFAULT_LIMIT))
+        async with host_limits[host]:
+            now = loop.time()
+            start_at = max(now, host_next_start.get(host, now))
+            host_next_start[host] = start_at + PRICE_HOST_SPACING * random.uniform(0.5, 1.5)
+            if start_at > now:
+                await asyncio.sleep(start_at - now)
+            async with global_limit:
+                return url, await fetch_product(url)
+
+    results = dict(await asyncio.gather(*(fetch_one(url) for url in urls)))
+    duration = time.monotonic() - started
+    PRICE_SWEEP_SECONDS.observe(duration)
+    price_sweep_stats.update(last_duration=duration, last_items=len(urls), last_finished=datetime.datetime.now())
+    print("價格檢查完成：" + str(len(urls)) + " 件商品，用時 " + f"{duration:.1f}" + " 秒")
+    return results
 
 async def cmd_watch(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """新增監控商品 /watch URL [目標價格]"""
@@ -262,18 +500,31 @@ async def cmd_watch(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except:
             pass
     await update.message.reply_text("正在抓取商品資料，請稍等...")
-    title = get_page_title(url)
-    current_price = fetch_price(url)
-    if current_price is None:
+    snapshot = await fetch_product(url)
+    if snapshot is None or snapshot["price"] is None:
         await update.message.reply_text("無法抓取價格，請確認網址是否正確。\n支援：Amazon.ca、Best Buy、Canadian Tire")
         return
+    current_price = snapshot["price"]
+    title = snapshot["title"] or url[:50]
+    existing = find_watched(snapshot["canonical_url"])
+    if existing:
+        item = watch_list[existing]
+        item.update(title=title, current_price=current_price)
+        if target_price:
+            item["target_price"] = target_price
+        save_watchlist(watch_list, [existing])
+        await update.message.reply_text("這件商品已在監控清單：\n" + title + "\n目前價格：$" + str(current_price))
+        return
+    url = snapshot["canonical_url"]
     watch_list[url] = {
         "title": title,
         "current_price": current_price,
         "target_price": target_price,
-        "last_price": current_price
+        "last_price": current_price,
+        "currency": snapshot["currency"],
+        "availability": snapshot["availability"]
     }
-    save_watchlist(watch_list)
+    save_watchlist(watch_list, [url])
     msg = "已開始監控：\n" + title + "\n目前價格：$" + str(current_price)
     if target_price:
         msg += "\n目標價格：$" + str(target_price)
@@ -313,7 +564,7 @@ async def cmd_unwatch(update: Update, context: ContextTypes.DEFAULT_TYPE):
             url = keys[idx]
             title = watch_list[url]["title"]
             del watch_list[url]
-            save_watchlist(watch_list)
+            save_watchlist(watch_list, [url])
             await update.message.reply_text("已停止監控：" + title)
         else:
             await update.message.reply_text("編號不存在")
@@ -321,77 +572,360 @@ async def cmd_unwatch(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("用法：/unwatch 編號")
 
 async def check_prices():
-    """定時檢查價格"""
-    bot = Bot(token=TELEGRAM_BOT_TOKEN)
-    while True:
-        await asyncio.sleep(3600)  # 每小時檢查一次
-        if not watch_list:
-            continue
-        for url, item in list(watch_list.items()):
-            try:
-                new_price = fetch_price(url)
-                if new_price is None:
-                    continue
-                old_price = item["current_price"]
-                target_price = item.get("target_price")
-                notify = False
-                msg = ""
-                if target_price and new_price <= target_price:
-                    notify = True
-                    msg = "目標價格達到！\n" + item["title"] + "\n價格：$" + str(new_price) + "（目標：$" + str(target_price) + "）\n" + url
-                elif new_price < old_price:
-                    notify = True
-                    saved = round(old_price - new_price, 2)
-                    msg = "價格下跌！\n" + item["title"] + "\n$" + str(old_price) + " → $" + str(new_price) + "（省 $" + str(saved) + "）\n" + url
-                if notify:
-                    await bot.send_message(chat_id=MY_CHAT_ID, text=msg)
-                watch_list[url]["current_price"] = new_price
-                save_watchlist(watch_list)
-            except Exception as e:
-                print("檢查價格失敗: " + str(e))
-
-def get_category(text):
-    if any(kw in text for kw in ["我叫", "我是", "他叫", "她叫", "家人"]):
-        return "人物"
-    elif any(kw in text for kw in ["我喜歡", "我討厭", "我愛", "我怕"]):
-        return "喜好"
-    elif any(kw in text for kw in ["今天", "昨天", "發生"]):
-        return "事件"
-    elif any(kw in text for kw in ["設定", "偏好", "習慣", "記錄", "早上", "每天", "自動"]):
-        return "設定"
-    else:
-        return "一般"
+    """檢查一次所有監控商品的價格，由排程每小時執行"""
+    if not watch_list:
+        return
+    snapshots = await sweep_prices(list(watch_list.keys()))
+    changed = []
+    for url, snapshot in snapshots.items():
+        try:
+            item = watch_list.get(url)
+            if snapshot is None or item is None:
+                continue
+            new_price = snapshot["price"]
+            if new_price is None:
+                continue
+            # 順便更新標題和存貨，不用另外下載；沒找到價格的頁面可能是驗證碼頁，不更新
+            refreshed = {k: snapshot[k] for k in ("title", "currency", "availability") if snapshot[k] and snapshot[k] != item.get(k)}
+            if refreshed:
+                item.update(refreshed)
+                changed.append(url)
+            old_price = item["current_price"]
+            target_price = item.get("target_price")
+            notify = False
+            msg = ""
+            if target_price and new_price <= target_price:
+                notify = True
+                msg = "目標價格達到！\n" + item["title"] + "\n價格：$" + str(new_price) + "（目標：$" + str(target_price) + "）\n" + url
+            elif new_price < old_price:
+                notify = True
+                saved = round(old_price - new_price, 2)
+                msg = "價格下跌！\n" + item["title"] + "\n$" + str(old_price) + " → $" + str(new_price) + "（省 $" + str(saved) + "）\n" + url
+            if notify:
+                await shared_bot().send_message(chat_id=MY_CHAT_ID, text=msg)
+            if new_price != old_price:
+                item["current_price"] = new_price
+                if url not in changed:
+                    changed.append(url)
+        except Exception as e:
+            print("檢查價格失敗: " + str(e))
+    if changed:
+        save_watchlist(watch_list, changed)
+
+# 指標：/metrics 以 Prometheus 文字格式輸出
+HANDLER_SECONDS = metrics.Histogram("bot_handler_seconds", "Telegram handler latency by handler and message branch", ["handler"])
+HANDLER_ERRORS = metrics.Counter("bot_handler_errors_total", "Exceptions escaping Telegram handlers", ["handler"])
+LLM_SECONDS = metrics.Histogram("gemini_call_seconds", "Gemini latency per attempt (streams: until the last chunk)", ["priority", "mode"])
+LLM_FIRST_CHUNK_SECONDS = metrics.Histogram("gemini_first_chunk_seconds", "Time to first streamed chunk", ["priority"])
+LLM_ERRORS = metrics.Counter("gemini_errors_total", "Gemini call errors by exception type", ["priority", "type"])
+SUPABASE_SECONDS = metrics.Histogram("supabase_call_seconds", "MemoryDB method latency; each call is one Supabase round trip except paged reads", ["method"])
+PRICE_SWEEP_SECONDS = metrics.Histogram("price_sweep_seconds", "Duration of a full watch-list price sweep",
+                                        buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1800))
+# 只計會連 Supabase 的方法；檢索在本地索引進行
+SUPABASE_METHODS = [
+    name for name in dir(MemoryDB)
+    if not name.startswith("_") and callable(getattr(MemoryDB, name))
+    and name not in ("search_memories", "recent_memories", "rebuild_index", "sync_index")
+]
+metrics.instrument_methods(memory_db, SUPABASE_SECONDS, SUPABASE_METHODS)
+for name in SUPABASE_METHODS:
+    setattr(memory_db, name, tracing.traced("supabase." + name)(getattr(memory_db, name)))
+# 目前處理中的 handler 名稱；handle_message 判斷出分支後改成具體分支
+handler_label = contextvars.ContextVar("handler_label", default=None)
+
+def instrument_handler(name, func):
+    @functools.wraps(func)
+    async def wrapper(update, context):
+        label = {"name": name}
+        token = handler_label.set(label)
+        started = time.perf_counter()
+        try:
+            with tracing.trace(name):
+                return await func(update, context)
+        except Exception:
+            HANDLER_ERRORS.inc(handler=label["name"])
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, handler=label["name"])
+            handler_label.reset(token)
+    return wrapper
+
+def set_handler_branch(branch):
+    label = handler_label.get()
+    if label is not None:
+        label["name"] = "handle_message:" + branch
+        tracing.rename(label["name"])
+
+def llm_error(priority, e):
+    LLM_ERRORS.inc(priority=PRIORITY_NAMES[priority], type=type(e).__name__)
+
+@metrics.register_collector
+def collect_queue_metrics():
+    waiting = llm_queue.waiting()
+    return [
+        ("llm_queue_waiting", "gauge", "LLM jobs waiting for a slot",
+         [({"priority": name}, waiting.get(name, 0)) for name in PRIORITY_NAMES.values()]),
+        ("llm_queue_active", "gauge", "LLM slots in use", [({}, llm_queue.active)]),
+        ("llm_queue_events_total", "counter", "LLM queue events",
+         [({"event": k}, v) for k, v in llm_queue.stats.items()]),
+        ("ratelimit_requests_total", "counter", "Rate limiter admission decisions",
+         [({"decision": k}, v) for k, v in rate_limiter.stats.items()]),
+        ("ratelimit_buckets", "gauge", "Tracked token buckets",
+         [({"kind": "user"}, len(rate_limiter.users)), ({"kind": "chat"}, len(rate_limiter.chats))]),
+        ("ratelimit_llm_per_minute", "gauge", "Current adaptive global Gemini rate", [({}, rate_limiter.llm.rate * 60)]),
+        ("scheduler_jobs", "gauge", "Scheduled jobs", [({"state": "scheduled"}, len(scheduler.jobs)),
+                                                       ({"state": "running"}, len(scheduler.running))]),
+        ("scheduler_runs_total", "counter", "Scheduler job outcomes", [({"outcome": k}, v) for k, v in scheduler.stats.items()]),
+        ("search_cache_entries", "gauge", "Cached web search results", [({}, len(search_cache))]),
+        ("search_provider_calls_total", "counter", "Web search calls per provider",
+         [({"provider": name}, s["calls"]) for name, s in search_stats.items()]),
+        ("search_provider_hits_total", "counter", "Web search calls that returned results",
+         [({"provider": name}, s["hits"]) for name, s in search_stats.items()]),
+        ("search_provider_errors_total", "counter", "Web search calls that failed",
+         [({"provider": name}, s["errors"]) for name, s in search_stats.items()]),
+        ("search_provider_cancelled_total", "counter", "Web search calls cancelled after another provider answered",
+         [({"provider": name}, s["cancelled"]) for name, s in search_stats.items()]),
+        ("search_provider_latency_seconds_sum", "counter", "Total latency of completed web search calls",
+         [({"provider": name}, s["latency_total"]) for name, s in search_stats.items()]),
+        ("watchlist_items", "gauge", "Watched products", [({}, len(watch_list))]),
+    ]
 
-def is_important(text):
-    keywords = ["我叫", "我是", "我喜歡", "我討厭", "我住", "記住", "設定",
-                "他叫", "她叫", "家人", "今天", "發生", "記錄", "早上", "每天", "自動", "要求"]
-    return any(kw in text for kw in keywords)
+web.routes["/metrics"] = lambda query: (200, "text/plain; version=0.0.4; charset=utf-8", metrics.render().encode())
 
-def check_rate_limit(user_id, chat_type):
-    now = datetime.datetime.now()
-    if chat_type in ["group", "supergroup"]:
-        if user_id in last_reply:
-            diff = (now - last_reply[user_id]).seconds
-            if diff < 30:
-                return False
-    last_reply[user_id] = now
+# /debug/* 要帶 ?token=DEBUG_TOKEN；沒設定 DEBUG_TOKEN 就不開放
+DEBUG_TOKEN = os.environ.get("DEBUG_TOKEN", "")
+profiler = SamplingProfiler(interval=float(os.environ.get("PROFILER_INTERVAL", "0.01")))
+
+def debug_route(func):
+    def route(query):
+        # compare_digest 遇到非 ASCII 字串會拋錯，先轉成 bytes
+        token = query.get("token", "").encode()
+        if not DEBUG_TOKEN or not hmac.compare_digest(token, DEBUG_TOKEN.encode()):
+            return 403, "text/plain", b"forbidden"
+        try:
+            return func(query)
+        except ValueError as e:
+            return 400, "text/plain; charset=utf-8", ("參數錯誤：" + str(e) + "\n").encode()
+    return route
+
+def query_number(query, name, default, low, high, cast=float):
+    """讀取數字參數並限制在 low..high；不是有限數字拋 ValueError"""
+    raw = query.get(name)
+    if not raw:
+        return default
+    try:
+        value = cast(raw)
+    except ValueError:
+        raise ValueError(name + " 必須是數字") from None
+    if value != value or value in (float("inf"), float("-inf")):
+        raise ValueError(name + " 必須是數字")
+    return min(high, max(low, value))
+
+def traces_page(query):
+    """?n=最慢幾個 &name=trace 名稱前綴 &format=json"""
+    n = query_number(query, "n", 20, 1, tracing.TRACE_BUFFER_SIZE, int)
+    prefix = query.get("name")
+    if query.get("format") == "json":
+        body = json.dumps({"stages": tracing.stage_breakdown(prefix),
+                           "slowest": [t.to_dict() for t in tracing.slowest(n, prefix)]}, ensure_ascii=False)
+        return 200, "application/json; charset=utf-8", body.encode()
+    return 200, "text/plain; charset=utf-8", tracing.render_text(n, prefix).encode()
+
+def profile_page(query):
+    """?action=start&interval=0.005&seconds=60 開始取樣，?action=stop 停止，不帶 action 看目前結果"""
+    action = query.get("action")
+    if action == "start":
+        seconds = query_number(query, "seconds", None, 1, 3600)
+        interval = query_number(query, "interval", None, MIN_INTERVAL, 1)
+        if not profiler.start(interval=interval, duration=seconds):
+            return 409, "text/plain; charset=utf-8", "分析器已在取樣中\n".encode()
+    elif action == "stop":
+        profiler.stop()
+    top = query_number(query, "top", 30, 1, 500, int)
+    return 200, "text/plain; charset=utf-8", profiler.report(top).encode()
+
+web.routes["/debug/traces"] = debug_route(traces_page)
+web.routes["/debug/profile"] = debug_route(profile_page)
+
+@tracing.traced("admit")
+async def admit_message(message, user_id, chat_type):
+    """按用戶和群組的令牌桶排隊，要等一陣子就先通知；要等太久回覆忙碌並回傳 False。
+    全域模型配額由 llm_queue 在每次呼叫模型前取令牌"""
+    chat_id = message.chat.id if chat_type in ["group", "supergroup"] else None
+    wait = rate_limiter.admit(user_id, chat_id)
+    if wait is None:
+        await message.reply_text(LLM_BUSY_REPLY)
+        return False
+    if wait > RATE_NOTICE_AFTER:
+        await message.reply_text("安尼亞正忙，排隊中，大約 " + str(int(wait) + 1) + " 秒後回覆")
+    if wait > 0:
+        await asyncio.sleep(wait)
     return True
 
+@tracing.traced("gemini.generate")
+async def gemini_generate(contents, timeout=None, generation_config=None, priority=PRIORITY_CHAT, deadline=None):
+    """經優先佇列在 LLM 線程池執行 generate_content；每次嘗試最多 timeout 秒，配額錯誤退避重試，
+    過了 deadline（預設按優先度）拋出 asyncio.TimeoutError"""
+    timeout = timeout or LLM_TIMEOUT
+    deadline = deadline or time.monotonic() + LLM_DEADLINES[priority]
+    loop = asyncio.get_running_loop()
+
+    async def attempt(remaining):
+        attempt_timeout = min(timeout, remaining)
+        call = functools.partial(chat_model.generate_content, contents, generation_config=generation_config,
+                                 request_options={"timeout": attempt_timeout})
+        started = time.perf_counter()
+        try:
+            with tracing.span("gemini.call"):
+                return await asyncio.wait_for(loop.run_in_executor(llm_executor, call), timeout=attempt_timeout)
+        except Exception as e:
+            llm_error(priority, e)
+            raise
+        finally:
+            LLM_SECONDS.observe(time.perf_counter() - started, priority=PRIORITY_NAMES[priority], mode="generate")
+
+    return await llm_queue.run(priority, attempt, deadline)
 
-def gemini_chat(prompt):
+LLM_BUSY_REPLY = "安尼亞太忙了，請等60秒再試"
+LLM_TIMEOUT_REPLY = "安尼亞想太久了，請稍後再試"
+LLM_ERROR_PREFIX = "錯誤："
+
+async def gemini_chat(prompt, timeout=None, priority=PRIORITY_CHAT):
     try:
-        response = chat_model.generate_content(prompt)
+        response = await gemini_generate(prompt, timeout, priority=priority)
         return response.text
     except google.api_core.exceptions.ResourceExhausted:
-        return "安尼亞太忙了，請等60秒再試"
+        return LLM_BUSY_REPLY
+    except asyncio.TimeoutError:
+        return LLM_TIMEOUT_REPLY
+    except Exception as e:
+        return LLM_ERROR_PREFIX + str(e)
+
+async def gemini_stream(contents, timeout=None, priority=PRIORITY_CHAT, deadline=None):
+    """串流生成，逐塊 yield 文字；SDK 的同步迭代在 LLM 線程池執行，整個串流期間佔用佇列位置。
+    第一塊之前遇到配額錯誤會退避重試，超時拋出 asyncio.TimeoutError"""
+    timeout = timeout or LLM_TIMEOUT
+    deadline = deadline or time.monotonic() + LLM_DEADLINES[priority]
+    loop = asyncio.get_running_loop()
+    attempt = 0
+    while True:
+        async with llm_queue.slot(priority, deadline):
+            queue = asyncio.Queue()
+            stop = threading.Event()
+            attempt_timeout = min(timeout, deadline - time.monotonic())
+
+            def put(item, queue=queue, stop=stop):
+                try:
+                    loop.call_soon_threadsafe(queue.put_nowait, item)
+                except RuntimeError:
+                    stop.set()
+
+            def produce(put=put, stop=stop, attempt_timeout=attempt_timeout):
+                try:
+                    response = chat_model.generate_content(contents, stream=True, request_options={"timeout": attempt_timeout})
+                    for chunk in response:
+                        if stop.is_set():
+                            return
+                        try:
+                            text = chunk.text
+                        except ValueError:
+                            # 沒有文字的片段（例如只有結束原因）
+                            continue
+                        if text:
+                            put(text)
+                    put(None)
+                except Exception as e:
+                    put(e)
+
+            loop.run_in_executor(llm_executor, produce)
+            ends = loop.time() + attempt_timeout
+            started = time.perf_counter()
+            try:
+                with tracing.span("gemini.first_chunk"):
+                    item = await asyncio.wait_for(queue.get(), ends - loop.time())
+                LLM_FIRST_CHUNK_SECONDS.observe(time.perf_counter() - started, priority=PRIORITY_NAMES[priority])
+                if isinstance(item, google.api_core.exceptions.ResourceExhausted):
+                    llm_error(priority, item)
+                else:
+                    while item is not None:
+                        if isinstance(item, Exception):
+                            raise item
+                        yield item
+                        item = await asyncio.wait_for(queue.get(), ends - loop.time())
+                    rate_limiter.on_success()
+                    return
+            except Exception as e:
+                llm_error(priority, e)
+                raise
+            finally:
+                stop.set()
+                LLM_SECONDS.observe(time.perf_counter() - started, priority=PRIORITY_NAMES[priority], mode="stream")
+        delay = llm_queue.retry_delay(attempt, deadline)
+        if delay is None:
+            raise item
+        attempt += 1
+        await asyncio.sleep(delay)
+
+@tracing.traced("gemini.stream")
+async def stream_reply(message, prompt, chat_type):
+    """邊生成邊更新回覆訊息，回傳完整回覆"""
+    interval = STREAM_GROUP_EDIT_INTERVAL if chat_type in ["group", "supergroup"] else STREAM_EDIT_INTERVAL
+    reply = StreamingReply(message, interval=interval)
+    await reply.start()
+    error = None
+    try:
+        # 更新訊息失敗時 aclosing 會關掉串流，生成線程跟著停止
+        async with contextlib.aclosing(gemini_stream(prompt)) as stream:
+            async for chunk in stream:
+                try:
+                    await reply.append(chunk)
+                except (BadRequest, NetworkError) as e:
+                    # 回覆訊息被刪除或連不上 Telegram，不是模型的錯，不用再生成
+                    print("更新串流回覆失敗: " + str(e))
+                    return reply.text
+    except google.api_core.exceptions.ResourceExhausted:
+        error = LLM_BUSY_REPLY
+    except asyncio.TimeoutError:
+        error = LLM_TIMEOUT_REPLY
     except Exception as e:
-        return "錯誤：" + str(e)
+        error = LLM_ERROR_PREFIX + str(e)
+    try:
+        if error:
+            await reply.append(("\n\n" if reply.text.strip() else "") + error)
+        return await reply.finish()
+    except (BadRequest, NetworkError) as e:
+        print("更新串流回覆失敗: " + str(e))
+        return reply.text
+
+@tracing.traced("build_memory_sections")
+def build_memory_sections(user_text):
+    """挑出和訊息最相關的記憶，按分類排好；近期事件固定附上最新幾條"""
+    categories = ["人物", "喜好", "設定", "事件"]
+    relevant = memory_db.search_memories(user_text or "", categories, k=MEMORY_TOP_K, budget=MEMORY_BUDGET_CHARS)
+    sections = {c: [] for c in categories}
+    picked = set()
+    for r in relevant:
+        sections[r["category"]].append(r)
+        picked.add(r["id"])
+    for r in memory_db.recent_memories("事件", MEMORY_RECENT_EVENTS):
+        if r["id"] not in picked:
+            sections["事件"].append(r)
+    人物 = [f"{r['sender_name']}: {r['content']}" for r in sections["人物"]]
+    喜好 = [f"{r['sender_name']}: {r['content']}" for r in sections["喜好"]]
+    設定 = [f"{r['sender_name']}: {r['content']}" for r in sections["設定"]]
+    事件 = [f"{r['sender_name']}: {r['content']}" for r in sorted(sections["事件"], key=lambda r: r["id"])]
+    text = ""
+    if 人物:
+        text += "【人物資料】\n" + "\n".join(人物) + "\n\n"
+    if 喜好:
+        text += "【喜好】\n" + "\n".join(喜好) + "\n\n"
+    if 設定:
+        text += "【設定】\n" + "\n".join(設定) + "\n\n"
+    if 事件:
+        text += "【近期事件】\n" + "\n".join(事件) + "\n\n"
+    return text
 
 def build_system_prompt():
-    人物 = memory_db.get_by_category("人物")
-    喜好 = memory_db.get_by_category("喜好")
-    設定 = memory_db.get_by_category("設定")
-    事件 = memory_db.get_by_category("事件")
     now = datetime.datetime.now()
     weekdays = ["星期一", "星期二", "星期三", "星期四", "星期五", "星期六", "星期日"]
     today_str = now.strftime("%Y年%m月%d日") + " " + weekdays[now.weekday()]
@@ -402,101 +936,346 @@ def build_system_prompt():
     prompt += "回答時絕對不可以使用 * ** ## 等符號。\n"
     prompt += "只有用戶說「發新聞」、「今日新聞」等明確要求時，才用新聞系統發送CBC新聞。\n"
     prompt += "回答要簡短直接。\n\n"
-    if 人物:
-        prompt += "【人物資料】\n" + "\n".join(人物) + "\n\n"
-    if 喜好:
-        prompt += "【喜好】\n" + "\n".join(喜好) + "\n\n"
-    if 設定:
-        prompt += "【設定】\n" + "\n".join(設定) + "\n\n"
-    if 事件:
-        prompt += "【近期事件】\n" + "\n".join(事件[-5:]) + "\n\n"
     return prompt
 
-def parse_rss_today(url, count=5):
+@tracing.traced("build_chat_prompt")
+def build_chat_prompt(user_text, sender_name, search_results=None):
+    """組合對話提示，各段落套用 token 預算並記錄大小"""
+    texts, sizes = chat_prompt_budget.fit([
+        ("system", build_system_prompt()),
+        ("memory", build_memory_sections(user_text)),
+        ("search", search_results or ""),
+        ("user", user_text),
+    ])
+    prompt = texts["system"] + texts["memory"]
+    if texts["search"]:
+        prompt += "\n\n以下是最新搜尋結果，請根據這些資料回答：\n" + texts["search"] + "\n\n" + sender_name + " 問：" + texts["user"]
+    else:
+        prompt += "\n\n" + sender_name + " 說：" + texts["user"]
+    print("提示大小（token 估算）：" + "，".join(name + "=" + str(size) for name, size in sizes.items())
+          + "，總計=" + str(sum(sizes.values())))
+    return prompt
+
+# 行程、購物、記帳用一次結構化抽取處理，同一訊息有幾樣也只呼叫模型一次
+STRUCTURED_INTENTS = {"calendar", "shopping", "expense"}
+EXTRACTION_FAILED_REPLIES = {
+    "calendar": "無法識別行程格式",
+    "shopping": "無法識別購物項目",
+    "expense": "無法識別支出格式",
+}
+
+@tracing.traced("extract_actions")
+async def extract_actions(user_text, intents=()):
+    """按 schema 抽取訊息中的行程、購物、支出和記憶，回傳驗證後的結果"""
+    prompt = extraction.build_prompt(user_text, datetime.date.today(), intents)
+    response = await gemini_generate(prompt, generation_config=extraction.GENERATION_CONFIG)
+    return extraction.validate(json.loads(response.text))
+
+@tracing.traced("apply_actions")
+def apply_actions(actions, sender_name):
+    """把抽取結果寫入資料庫，回傳確認訊息的每一行"""
+    lines = []
+    event = actions["event"]
+    if event:
+        row = memory_db.add_event(title=event["title"], category=event["category"], event_date=event["date"],
+                                  reminder_days=event["reminder_days"], created_by=sender_name)
+        schedule_event_reminder(row)
+        lines.append("已加入行程：" + event["date"] + " " + event["title"])
+    if actions["shopping"]:
+        memory_db.add_shopping_many(actions["shopping"], sender_name)
+        lines.append("已加入購物清單：" + "、".join(i["item"] for i in actions["shopping"]))
+    expense = actions["expense"]
+    if expense:
+        memory_db.add_expense(expense["amount"], expense["category"], expense["description"], sender_name)
+        lines.append("已記帳：" + expense["category"] + " $" + str(expense["amount"]) + " - " + expense["description"])
+    if actions["memory"]:
+        memory_db.add_memory(actions["memory"]["content"], category=actions["memory"]["category"], sender_name=sender_name)
+        lines.append("已記錄！")
+    return lines
+
+def memory_line(r):
+    return f"{r['sender_name']}: {r['content']}"
+
+def chunk_memories(rows, max_tokens=MEMORY_SUMMARY_TOKENS):
+    """按估算的 token 數把記憶分批，每批各做一次摘要"""
+    chunk, size = [], 0
+    for r in rows:
+        tokens = estimate_tokens(memory_line(r)) + 1
+        if chunk and size + tokens > max_tokens:
+            yield chunk
+            chunk, size = [], 0
+        chunk.append(r)
+        size += tokens
+    if chunk:
+        yield chunk
+
+async def summarize_memories(rows, instruction):
+    text = "\n".join(memory_line(r) for r in rows)
+    response = await gemini_generate(instruction + "，不用**或##符號：\n\n" + text, priority=PRIORITY_BACKGROUND)
+    return response.text.strip()
+
+async def replace_with_summary(rows, summary, category, sender_name):
+    """先寫入摘要再刪除原本的記憶；Supabase 是同步呼叫，放到線程池"""
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, functools.partial(memory_db.add_memory, summary, category=category, sender_name=sender_name))
+    await loop.run_in_executor(None, memory_db.delete_memories, [r["id"] for r in rows])
+
+@tracing.traced("compact_memories")
+async def compact_memories():
+    """舊事件合成摘要、重複喜好去掉或合成摘要，讓記憶庫不會無限增長；一批一批摘要和刪除"""
+    loop = asyncio.get_running_loop()
+    events = await loop.run_in_executor(None, memory_db.get_all_rows, "事件")
+    old_events = events[:-MEMORY_KEEP_EVENTS] if len(events) > MEMORY_KEEP_EVENTS else []
+    for chunk in chunk_memories(old_events):
+        if len(chunk) < 2:
+            continue
+        summary = await summarize_memories(chunk, "請用繁體中文把以下家庭事件整理成簡短摘要，保留人名、日期和重要細節")
+        # 模型回傳空白就不動原本的記憶
+        if summary:
+            await replace_with_summary(chunk, "（事件摘要）" + summary, "事件", "安尼亞")
+            print("已整理事件：" + str(len(chunk)) + " 條")
+    by_person = {}
+    for r in await loop.run_in_executor(None, memory_db.get_all_rows, "喜好"):
+        by_person.setdefault(r["sender_name"], []).append(r)
+    for sender, rows in by_person.items():
+        # 完全相同的喜好只留最新一條
+        seen = set()
+        duplicates = []
+        for r in reversed(rows):
+            key = " ".join(r["content"].split())
+            if key in seen:
+                duplicates.append(r["id"])
+            seen.add(key)
+        await loop.run_in_executor(None, memory_db.delete_memories, duplicates)
+        duplicates = set(duplicates)
+        remaining = [r for r in rows if r["id"] not in duplicates]
+        if len(remaining) <= MEMORY_MAX_PREFS_PER_PERSON:
+            continue
+        for chunk in chunk_memories(remaining):
+            if len(chunk) < 2:
+                continue
+            summary = await summarize_memories(chunk, "請用繁體中文把以下同一個人的喜好整理成一段簡短摘要，合併重複和相近的內容")
+            if summary:
+                await replace_with_summary(chunk, "（喜好摘要）" + summary, "喜好", sender)
+                print("已整理 " + sender + " 的喜好：" + str(len(chunk)) + " 條")
+
+# 每個 RSS 的 ETag / Last-Modified 和上次讀到的項目，沒更新時伺服器回 304 就直接重用
+feed_state = {}
+
+def article_keys(article):
+    """去重用的鍵：正規化後的標題和連結"""
+    title = " ".join(article["title"].lower().split())
+    link = article.get("link", "").strip().split("?")[0].rstrip("/")
+    return title, link
+
+def is_published_today(pub_date, today):
     try:
-        headers = {"User-Agent": "Mozilla/5.0"}
-        res = requests.get(url, headers=headers, timeout=10)
-        root = ET.fromstring(res.content)
-        items = root.findall(".//item")
-        today = datetime.date.today()
-        articles = []
-        for item in items:
-            title = item.findtext("title") or ""
-            desc = item.findtext("description") or ""
-            desc = re.sub(r"<[^>]+>", "", desc).strip()
-            pub_date = item.findtext("pubDate") or ""
-            # 嘗試解析日期，只保留今日新聞
-            is_today = False
-            try:
-                import email.utils
-                parsed = email.utils.parsedate_to_datetime(pub_date)
-                is_today = parsed.date() == today
-            except Exception:
-                is_today = True  # 無法解析日期就保留
-            if is_today and title:
-                link = item.findtext("link") or ""
-                articles.append({"title": title, "description": desc, "link": link})
-            if len(articles) >= count:
-                break
-        # 如果今日新聞不足，補充最新幾條
-        if len(articles) < 3:
-            for item in items:
-                title = item.findtext("title") or ""
-                desc = item.findtext("description") or ""
-                desc = re.sub(r"<[^>]+>", "", desc).strip()
-                link = item.findtext("link") or ""
-                if title and {"title": title, "description": desc, "link": link} not in articles:
-                    articles.append({"title": title, "description": desc, "link": link})
-                if len(articles) >= count:
+        import email.utils
+        return email.utils.parsedate_to_datetime(pub_date).date() == today
+    except Exception:
+        return None  # 無法解析日期
+
+class ArticleSelector:
+    """逐條接收 RSS 項目，優先選今日新聞；今日新聞不足 3 條就用最新幾條補上"""
+
+    def __init__(self, count):
+        self.count = count
+        self.today = datetime.date.today()
+        self.articles = []
+        self.latest = []
+        self.seen_titles = set()
+        self.seen_links = set()
+
+    def _add(self, item):
+        title, link = article_keys(item)
+        if title in self.seen_titles or (link and link in self.seen_links):
+            return
+        self.seen_titles.add(title)
+        if link:
+            self.seen_links.add(link)
+        self.articles.append({"title": item["title"], "description": item["description"], "link": item["link"]})
+
+    def add(self, item):
+        """回傳 True 表示已經夠了，不用再讀"""
+        if not item["title"]:
+            return False
+        if len(self.latest) < self.count * 2:
+            self.latest.append(item)
+        today = is_published_today(item["pub_date"], self.today)
+        if today is not False:
+            self._add(item)
+            return len(self.articles) >= self.count
+        # RSS 由新到舊排列，見到舊新聞又已有足夠補充項目就可以停
+        return len(self.latest) >= self.count * 2
+
+    def result(self):
+        if len(self.articles) < 3:
+            for item in self.latest:
+                if len(self.articles) >= self.count:
+                    break
+                self._add(item)
+        return self.articles[:self.count]
+
+@tracing.traced("parse_rss_today")
+async def parse_rss_today(url, count=5):
+    try:
+        state = feed_state.get(url)
+        headers = {}
+        if state:
+            if state["etag"]:
+                headers["If-None-Match"] = state["etag"]
+            if state["last_modified"]:
+                headers["If-Modified-Since"] = state["last_modified"]
+        selector = ArticleSelector(count)
+        async with http_client.stream(url, headers=headers, timeout=10) as res:
+            if res.status_code == 304 and state:
+                for item in state["items"]:
+                    if selector.add(item):
+                        break
+                return selector.result()
+            res.raise_for_status()
+            # 邊下載邊解析，夠了就停止下載
+            import xml.etree.ElementTree as ET
+            parser = ET.XMLPullParser(events=("end",))
+            items = []
+            done = False
+            async for chunk in res.aiter_bytes():
+                parser.feed(chunk)
+                for _, elem in parser.read_events():
+                    if elem.tag != "item":
+                        continue
+                    item = {
+                        "title": elem.findtext("title") or "",
+                        "description": HTML_TAG.sub("", elem.findtext("description") or "").strip(),
+                        "link": elem.findtext("link") or "",
+                        "pub_date": elem.findtext("pubDate") or ""
+                    }
+                    elem.clear()
+                    items.append(item)
+                    if selector.add(item):
+                        done = True
+                        break
+                if done:
                     break
-        return articles[:count]
+            feed_state[url] = {"etag": res.headers.get("ETag"), "last_modified": res.headers.get("Last-Modified"), "items": items}
+        return selector.result()
     except Exception as e:
         print("RSS 錯誤: " + str(e))
         return []
 
-def format_news(articles, section_name):
+# 每篇新聞的翻譯按內容雜湊快取，重啟後仍在；只有新文章才送 Gemini
+NEWS_TRANSLATION_TTL = float(os.environ.get("NEWS_TRANSLATION_TTL", str(3 * 24 * 3600)))
+translation_cache = PersistentCache("news_translation", ttl=NEWS_TRANSLATION_TTL, max_entries=2000)
+
+def article_key(article):
+    return hashlib.sha256((article["title"] + "\n" + article["description"]).encode("utf-8")).hexdigest()
+
+@tracing.traced("translate_articles")
+async def translate_articles(articles):
+    """回傳每篇的 {"title", "description"} 譯文，模型漏掉的是 None"""
+    keys = [article_key(a) for a in articles]
+    translations = translation_cache.get_many(keys)
+    pending = {}
+    for key, article in zip(keys, articles):
+        if key not in translations:
+            pending[key] = article
+    if pending:
+        items = [{"id": str(i), "title": a["title"], "description": a["description"]} for i, a in enumerate(pending.values())]
+        prompt = "請將以下 JSON 陣列中每條新聞的 title 和 description 直接翻譯成繁體中文。\n"
+        prompt += "規則：只翻譯原文，不添加任何原文沒有的內容，不用**或##符號，id 保持不變。\n"
+        prompt += '回傳 JSON 陣列：[{"id": "...", "title": "...", "description": "..."}]\n\n'
+        prompt += json.dumps(items, ensure_ascii=False)
+        response = await gemini_generate(prompt, generation_config={"response_mime_type": "application/json"}, priority=PRIORITY_NEWS)
+        data = json.loads(response.text)
+        by_id = {str(d.get("id")): d for d in data if isinstance(d, dict)} if isinstance(data, list) else {}
+        translated = {}
+        for i, key in enumerate(pending):
+            d = by_id.get(str(i))
+            if d and d.get("title"):
+                translated[key] = {"title": d["title"].strip(), "description": (d.get("description") or "").strip()}
+        translation_cache.set_many(translated)
+        translations.update(translated)
+    return [translations.get(key) for key in keys]
+
+async def format_news(articles, section_name):
+    """翻譯一個新聞段落，回傳 (文字, 是否成功)"""
     if not articles:
-        return section_name + "\n\n暫時無法獲取新聞"
-    # 直接翻譯，不擴展
-    news_text = ""
-    for i, a in enumerate(articles, 1):
-        news_text += str(i) + ". " + a["title"] + "\n" + a["description"] + "\n\n"
-    prompt = "請將以下新聞直接翻譯成繁體中文，每條新聞之間空一行。\n"
-    prompt += "規則：只翻譯原文，不添加任何原文沒有的內容，不用**或##符號。\n\n"
-    prompt += news_text
-    translated = gemini_chat(prompt)
-    # 把連結加回翻譯後的新聞
-    lines = translated.strip().split("\n\n")
+        return section_name + "\n\n暫時無法獲取新聞", False
+    try:
+        translations = await translate_articles(articles)
+    except google.api_core.exceptions.ResourceExhausted:
+        return section_name + "\n\n" + LLM_BUSY_REPLY, False
+    except asyncio.TimeoutError:
+        return section_name + "\n\n" + LLM_TIMEOUT_REPLY, False
+    except Exception as e:
+        return section_name + "\n\n" + LLM_ERROR_PREFIX + str(e), False
+    ok = True
     result = section_name + "\n\n"
-    for i, article in enumerate(articles):
-        if i < len(lines):
-            result += lines[i].strip()
+    for i, (article, translation) in enumerate(zip(articles, translations), 1):
+        if translation is None:
+            # 模型漏掉的保留原文，這次結果不放進當日快取
+            ok = False
+            translation = article
+        result += str(i) + ". " + translation["title"]
+        if translation["description"]:
+            result += "\n" + translation["description"]
         if article.get("link"):
             result += "\n" + article["link"]
         result += "\n\n"
-    return result.strip()
-
-def fetch_real_news():
+    return result.strip(), ok
+
+@tracing.traced("news_build", root=True)
+async def fetch_real_news():
+    """同時抓三個 RSS、同時翻譯兩個段落，回傳 (加拿大, Alberta, 是否全部成功)"""
+    today_str = datetime.date.today().strftime("%Y年%m月%d日")
+    # Calgary 只在 Edmonton 不夠時才用，但一起抓可以省一輪等待
+    canada_articles, alberta_articles, extra = await asyncio.gather(
+        parse_rss_today("https://www.cbc.ca/cmlink/rss-canada", 5),
+        parse_rss_today("https://www.cbc.ca/cmlink/rss-canada-edmonton", 5),
+        parse_rss_today("https://www.cbc.ca/cmlink/rss-canada-calgary", 5),
+    )
+    if len(alberta_articles) < 3:
+        seen = {article_keys(a)[0] for a in alberta_articles}
+        for a in extra:
+            if article_keys(a)[0] not in seen:
+                seen.add(article_keys(a)[0])
+                alberta_articles.append(a)
+            if len(alberta_articles) >= 5:
+                break
+    (canada_news, canada_ok), (alberta_news, alberta_ok) = await asyncio.gather(
+        format_news(canada_articles, "加拿大重點新聞（" + today_str + "）"),
+        format_news(alberta_articles, "Alberta / Edmonton 新聞（" + today_str + "）"),
+    )
+    return canada_news, alberta_news, canada_ok and alberta_ok
+
+# 當日新聞快取：成功建好的新聞整天重用，/news 和「今日新聞」不用再等翻譯
+NEWS_PREWARM_MINUTES = int(os.environ.get("NEWS_PREWARM_MINUTES", "5"))
+news_digest = {"date": None, "canada": "", "alberta": ""}
+news_task = None  # 正在建立新聞的 task，避免同時重複建立
+
+def news_ready():
+    return news_digest["date"] == datetime.date.today()
+
+@tracing.traced("get_news_digest")
+async def get_news_digest():
+    if news_ready():
+        return news_digest["canada"], news_digest["alberta"]
+    global news_task
+    if news_task is None or news_task.done():
+        # 共用的 task 不能沿用第一個請求的 trace（那個 trace 可能早就結束），在空的 context 裡開自己的 trace
+        news_task = asyncio.create_task(fetch_real_news(), context=contextvars.Context())
     try:
-        today_str = datetime.date.today().strftime("%Y年%m月%d日")
-        canada_articles = parse_rss_today("https://www.cbc.ca/cmlink/rss-canada", 5)
-        alberta_articles = parse_rss_today("https://www.cbc.ca/cmlink/rss-canada-edmonton", 5)
-        if len(alberta_articles) < 3:
-            extra = parse_rss_today("https://www.cbc.ca/cmlink/rss-canada-calgary", 5)
-            seen = [a["title"] for a in alberta_articles]
-            for a in extra:
-                if a["title"] not in seen:
-                    alberta_articles.append(a)
-                if len(alberta_articles) >= 5:
-                    break
-        canada_news = format_news(canada_articles, "加拿大重點新聞（" + today_str + "）")
-        alberta_news = format_news(alberta_articles, "Alberta / Edmonton 新聞（" + today_str + "）")
-        return canada_news, alberta_news
+        with tracing.span("news_wait"):
+            canada_news, alberta_news, ok = await asyncio.shield(news_task)
     except Exception as e:
         return "新聞獲取失敗：" + str(e), ""
+    if ok:
+        news_digest.update(date=datetime.date.today(), canada=canada_news, alberta=alberta_news)
+    return canada_news, alberta_news
 
+@tracing.traced("send_news")
 async def send_news(target, bot=None):
-    canada_news, alberta_news = fetch_real_news()
+    canada_news, alberta_news = await get_news_digest()
 
     async def send_chunk(text):
         parts = []
@@ -530,7 +1309,8 @@ async def cmd_forget(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("所有記憶已清除")
 
 async def cmd_news(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("正在獲取最新真實新聞，請稍等約30秒...")
+    if not news_ready():
+        await update.message.reply_text("正在獲取最新真實新聞，請稍等...")
     await send_news(update.message)
 
 async def cmd_calendar(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -579,16 +1359,17 @@ async def cmd_summary(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         await update.message.reply_text("請回覆一條訊息並輸入 /summary")
         return
-    result = gemini_chat("請用繁體中文將以下內容摘要成3-5點重點，每點一行，不用**符號：\n\n" + text_to_summarize)
+    result = await gemini_chat("請用繁體中文將以下內容摘要成3-5點重點，每點一行，不用**符號：\n\n" + text_to_summarize, priority=PRIORITY_SUMMARY)
     await update.message.reply_text("摘要：\n\n" + result)
 
 async def cmd_models(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    def list_names():
+        # list_models 是同步的分頁迭代，每頁一次網路請求
+        return [m.name for m in genai.list_models() if "generateContent" in m.supported_generation_methods]
+
     try:
-        models = genai.list_models()
-        text = "可用模型：\n"
-        for m in models:
-            if "generateContent" in m.supported_generation_methods:
-                text += "- " + m.name + "\n"
+        names = await asyncio.get_running_loop().run_in_executor(None, list_names)
+        text = "可用模型：\n" + "".join("- " + name + "\n" for name in names)
         await update.message.reply_text(text[:4000])
     except Exception as e:
         await update.message.reply_text("錯誤：" + str(e))
@@ -605,7 +1386,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # 自動摘要長訊息
     if message.text and len(message.text) > 500:
         if chat_type in ["group", "supergroup"]:
-            result = gemini_chat("請用繁體中文將以下內容摘要成3-5點重點，每點一行，不用**符號：\n\n" + message.text)
+            set_handler_branch("summary")
+            result = await gemini_chat("請用繁體中文將以下內容摘要成3-5點重點，每點一行，不用**符號：\n\n" + message.text, priority=PRIORITY_SUMMARY)
             await message.reply_text("自動摘要：\n\n" + result)
             return
 
@@ -614,17 +1396,21 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if chat_type in ["group", "supergroup"]:
             if not message.caption or TRIGGER_KEYWORD not in message.caption:
                 return
-        if not check_rate_limit(user_id, chat_type):
+        set_handler_branch("photo")
+        if not await admit_message(message, user_id, chat_type):
             return
         try:
             photo_file = await message.photo[-1].get_file()
             photo_bytes = bytes(await photo_file.download_as_bytearray())
+            import PIL.Image
             img = PIL.Image.open(io.BytesIO(photo_bytes))
             caption = message.caption or "請描述這張圖片"
-            response = chat_model.generate_content([caption + "，必須用繁體中文回答，不可用簡體中文，不可用**或##符號", img])
+            response = await gemini_generate([caption + "，必須用繁體中文回答，不可用簡體中文，不可用**或##符號", img], priority=PRIORITY_MEDIA)
             await message.reply_text(response.text)
         except google.api_core.exceptions.ResourceExhausted:
-            await message.reply_text("安尼亞太忙了，請等60秒再試")
+            await message.reply_text(LLM_BUSY_REPLY)
+        except asyncio.TimeoutError:
+            await message.reply_text("圖片辨識超時，請稍後再試")
         except Exception as e:
             await message.reply_text("圖片辨識失敗：" + str(e))
         return
@@ -634,7 +1420,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if chat_type in ["group", "supergroup"]:
             if not message.caption or TRIGGER_KEYWORD not in message.caption:
                 return
-        if not check_rate_limit(user_id, chat_type):
+        set_handler_branch("voice")
+        if not await admit_message(message, user_id, chat_type):
             return
         try:
             voice_file = await message.voice.get_file()
@@ -643,8 +1430,10 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 f.write(voice_bytes)
             with open("/tmp/voice.ogg", "rb") as f:
                 audio_data = f.read()
-            response = chat_model.generate_content([{"mime_type": "audio/ogg", "data": audio_data}, "請將這段語音轉錄成繁體中文文字"])
+            response = await gemini_generate([{"mime_type": "audio/ogg", "data": audio_data}, "請將這段語音轉錄成繁體中文文字"], priority=PRIORITY_MEDIA)
             await message.reply_text("你說：" + response.text)
+        except asyncio.TimeoutError:
+            await message.reply_text("語音辨識超時，請稍後再試")
         except Exception as e:
             await message.reply_text("語音辨識失敗：" + str(e))
         return
@@ -657,189 +1446,209 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if TRIGGER_KEYWORD not in user_text:
                 return
 
-        if not check_rate_limit(user_id, chat_type):
+        set_handler_branch("text")
+        if not await admit_message(message, user_id, chat_type):
             return
 
         if user_text.startswith("設定:"):
             parts = user_text[3:].split("=")
             if len(parts) == 2:
+                set_handler_branch("preference")
                 memory_db.set_preference(parts[0].strip(), parts[1].strip())
                 await message.reply_text("已記住偏好：" + parts[0].strip() + " = " + parts[1].strip())
                 return
 
-        if any(kw in user_text for kw in ["記錄", "記住"]):
-            memory_db.add_memory(user_text, category=get_category(user_text), sender_name=sender_name)
-            await message.reply_text("已記錄！")
-            return
+        # 一次掃描找出所有意圖，按優先次序處理
+        with tracing.span("route"):
+            route = intents.route(user_text)
+        intent = route["intent"]
+        set_handler_branch(intent)
 
-        if "加入行程" in user_text or "新增行程" in user_text:
-            prompt = "從以下訊息提取行程資料，只回傳 JSON，不要其他文字：\n"
-            prompt += '{"title": "標題", "category": "分類(家庭活動/醫生預約/垃圾回收/上課提醒/生日)", "date": "YYYY-MM-DD", "reminder_days": 1}\n'
-            prompt += "訊息：" + user_text + "\n今天日期：" + str(datetime.date.today())
-            result = gemini_chat(prompt)
+        if intent in STRUCTURED_INTENTS:
             try:
-                result = re.sub(r"```json|```", "", result).strip()
-                data = json.loads(result)
-                memory_db.add_event(title=data["title"], category=data["category"], event_date=data["date"], reminder_days=data.get("reminder_days", 1), created_by=sender_name)
-                await message.reply_text("已加入行程：" + data["date"] + " " + data["title"])
-            except Exception:
-                await message.reply_text("無法識別行程格式")
-            return
-
-        if "買" in user_text or "購物" in user_text or "加入清單" in user_text:
-            prompt = "從以下訊息提取購物項目，只回傳 JSON，不要其他文字：\n"
-            prompt += '{"items": [{"item": "物品名稱", "quantity": "數量"}]}\n訊息：' + user_text
-            result = gemini_chat(prompt)
+                actions = await extract_actions(user_text, route["intents"])
+            except google.api_core.exceptions.ResourceExhausted:
+                await message.reply_text(LLM_BUSY_REPLY)
+                return
+            except asyncio.TimeoutError:
+                await message.reply_text(LLM_TIMEOUT_REPLY)
+                return
+            except Exception as e:
+                print("結構化抽取失敗: " + str(e))
+                actions = None
+            if not actions or extraction.is_empty(actions):
+                await message.reply_text(EXTRACTION_FAILED_REPLIES[intent])
+                return
             try:
-                result = re.sub(r"```json|```", "", result).strip()
-                data = json.loads(result)
-                for item in data["items"]:
-                    memory_db.add_shopping(item["item"], item.get("quantity", "1"), sender_name)
-                items_text = "、".join([i["item"] for i in data["items"]])
-                await message.reply_text("已加入購物清單：" + items_text)
-            except Exception:
-                await message.reply_text("無法識別購物項目")
+                lines = apply_actions(actions, sender_name)
+            except Exception as e:
+                await message.reply_text("儲存失敗：" + str(e))
+                return
+            await message.reply_text("\n".join(lines))
             return
 
-        if "支出" in user_text or "花了" in user_text or "記帳" in user_text:
-            prompt = "從以下訊息提取支出資料，只回傳 JSON，不要其他文字：\n"
-            prompt += '{"amount": 金額數字, "category": "分類(食物/交通/娛樂/醫療/購物/其他)", "description": "描述"}\n訊息：' + user_text
-            result = gemini_chat(prompt)
-            try:
-                result = re.sub(r"```json|```", "", result).strip()
-                data = json.loads(result)
-                memory_db.add_expense(data["amount"], data["category"], data["description"], sender_name)
-                await message.reply_text("已記帳：" + data["category"] + " $" + str(data["amount"]) + " - " + data["description"])
-            except Exception:
-                await message.reply_text("無法識別支出格式")
+        if intent == "memory_save":
+            memory_db.add_memory(user_text, category=route["category"], sender_name=sender_name)
+            await message.reply_text("已記錄！")
             return
 
-        if any(kw in user_text for kw in ["發新聞", "今日新聞", "要新聞", "給我新聞", "看新聞"]):
-            await message.reply_text("正在獲取最新真實新聞，請稍等約30秒...")
+        if intent == "news":
+            if not news_ready():
+                await message.reply_text("正在獲取最新真實新聞，請稍等...")
             await send_news(message)
             return
 
         # 一般對話
-        system_prompt = build_system_prompt()
-        use_web_search = needs_search(user_text)
-
-        if use_web_search:
+        search_results = None
+        if intent == "weather":
+            # 天氣查詢直接用天氣 API，城市名由路由一併找出；可以一次問多個城市
             await message.reply_text("🔍 正在搜尋最新資料...")
-            # 天氣查詢直接用天氣 API
-            weather_keywords = ["天氣", "氣溫", "溫度", "預報", "下雨", "下雪"]
-            if any(kw in user_text for kw in weather_keywords):
-                # 直接從問題提取城市名，不用 Gemini
-                city = "Edmonton"
-                city_map = {
-                    "香港": "Hong Kong", "東京": "Tokyo", "大阪": "Osaka",
-                    "上海": "Shanghai", "北京": "Beijing", "台北": "Taipei",
-                    "首爾": "Seoul", "新加坡": "Singapore", "曼谷": "Bangkok",
-                    "倫敦": "London", "巴黎": "Paris", "紐約": "New York",
-                    "洛杉磯": "Los Angeles", "溫哥華": "Vancouver",
-                    "多倫多": "Toronto", "卡加利": "Calgary", "愛城": "Edmonton",
-                    "蒙特利爾": "Montreal", "渥太華": "Ottawa",
-                }
-                for zh, en in city_map.items():
-                    if zh in user_text:
-                        city = en
-                        break
-                # 英文城市名直接提取
-                import re as re2
-                eng_match = re2.search(r"[A-Z][a-z]+(?:\s+[A-Z][a-z]+)*", user_text)
-                if eng_match and city == "Edmonton":
-                    city = eng_match.group(0)
-                weather_data = get_weather(city)
-                if weather_data:
-                    await message.reply_text(weather_data)
-                    return
-                else:
-                    full_prompt = system_prompt + "\n\n" + sender_name + " 說：" + user_text
-            else:
-                search_results = web_search(user_text)
-                if search_results:
-                    full_prompt = system_prompt + "\n\n以下是最新搜尋結果，請根據這些資料回答：\n" + search_results + "\n\n" + sender_name + " 問：" + user_text
-                else:
-                    full_prompt = system_prompt + "\n\n" + sender_name + " 說：" + user_text
+            cities = route["cities"][:5] or ["Edmonton"]
+            weather_data = [w for w in await get_weather_many(cities) if w]
+            if weather_data:
+                await message.reply_text("\n\n".join(weather_data))
+                return
+        elif intent == "search":
+            await message.reply_text("🔍 正在搜尋最新資料...")
+            search_results = await web_search(user_text)
+
+        full_prompt = build_chat_prompt(user_text, sender_name, search_results)
+
+        if STREAM_REPLIES:
+            await stream_reply(message, full_prompt, chat_type)
         else:
-            full_prompt = system_prompt + "\n\n" + sender_name + " 說：" + user_text
+            await message.reply_text(await gemini_chat(full_prompt))
+
+        if route["important"]:
+            memory_db.add_memory(user_text, category=route["category"], sender_name=sender_name)
+
+async def send_weekly_reminders():
+    events = memory_db.get_upcoming_events(7)
+    if events:
+        text = "本週提醒：\n\n"
+        for e in events:
+            text += e["event_date"] + " [" + e["category"] + "] " + e["title"] + "\n"
+        await shared_bot().send_message(chat_id=MY_CHAT_ID, text=text)
+
+async def send_event_reminder(event):
+    days = (datetime.date.fromisoformat(event["event_date"]) - datetime.date.today()).days
+    when = "今天" if days <= 0 else "明天" if days == 1 else str(days) + " 天後"
+    text = "提醒：" + when + "（" + event["event_date"] + "）[" + event["category"] + "] " + event["title"]
+    await shared_bot().send_message(chat_id=MY_CHAT_ID, text=text)
+
+def schedule_event_reminder(event):
+    """按 reminder_days 在活動前幾天的 REMINDER_HOUR 點提醒一次；回傳工作名稱，沒有排程回傳 None"""
+    if not event or not event.get("event_date"):
+        return None
+    try:
+        event_date = datetime.date.fromisoformat(event["event_date"])
+    except ValueError:
+        return None
+    if event_date < datetime.date.today():
+        return None
+    days = event.get("reminder_days")
+    days = 1 if days is None else int(days)
+    remind_at = datetime.datetime.combine(event_date - datetime.timedelta(days=days), datetime.time(REMINDER_HOUR))
+    # 提醒時間已過但活動還沒到（例如晚上才加明天的活動），馬上提醒
+    remind_at = max(remind_at, datetime.datetime.now())
+    # 名稱包含日期和提前天數，活動改期後排新的提醒，同一活動的舊提醒取消
+    prefix = "event:" + str(event.get("id")) + ":"
+    name = prefix + event["event_date"] + ":" + str(days)
+    scheduler.cancel_prefix(prefix, keep=[name])
+    scheduler.once(name, remind_at.timestamp(), traced_job("event_reminder", functools.partial(send_event_reminder, event)),
+                   catch_up=REMINDER_CATCH_UP)
+    return name
+
+def schedule_event_reminders():
+    """啟動時按資料庫排所有提醒；已刪除或改期的活動，舊提醒會被取消"""
+    names = {schedule_event_reminder(event) for event in memory_db.get_upcoming_events(REMINDER_LOOKAHEAD_DAYS)}
+    scheduler.cancel_prefix("event:", keep=names)
+
+async def prewarm_news():
+    # 提早幾分鐘在背景建好新聞，九點一到直接發送
+    await get_news_digest()
 
-        reply = gemini_chat(full_prompt)
+async def send_daily_news():
+    bot = shared_bot()
+    await bot.send_message(chat_id=MY_CHAT_ID, text="早晨新聞來了！" if news_ready() else "早晨新聞來了，請稍等...")
+    await send_news(None, bot=bot)
 
-        if is_important(user_text):
-            memory_db.add_memory(user_text, category=get_category(user_text), sender_name=sender_name)
+async def refresh_memory_index():
+    # 整個 memory_v2 分頁讀取是同步的，放到線程；重建期間對話繼續用舊索引
+    await asyncio.get_running_loop().run_in_executor(None, memory_db.rebuild_index)
 
-        await message.reply_text(reply)
+async def sync_memory_index():
+    await asyncio.get_running_loop().run_in_executor(None, memory_db.sync_index)
 
-async def check_reminders():
-    bot = Bot(token=TELEGRAM_BOT_TOKEN)
-    sent_today = False
-    while True:
-        now = datetime.datetime.now()
-        if now.hour == 8 and now.minute == 0 and not sent_today:
-            events = memory_db.get_upcoming_events(7)
-            if events:
-                text = "本週提醒：\n\n"
-                for e in events:
-                    text += e["event_date"] + " [" + e["category"] + "] " + e["title"] + "\n"
-                await bot.send_message(chat_id=MY_CHAT_ID, text=text)
-            sent_today = True
-        if now.hour != 8:
-            sent_today = False
-        await asyncio.sleep(60)
+memory_index_task = None
 
-async def send_daily_news():
-    bot = Bot(token=TELEGRAM_BOT_TOKEN)
-    sent_today = False
-    while True:
-        now = datetime.datetime.now()
-        if now.hour == 9 and now.minute == 0 and not sent_today:
-            await bot.send_message(chat_id=MY_CHAT_ID, text="早晨新聞來了，請稍等約30秒...")
-            await send_news(None, bot=bot)
-            sent_today = True
-        if now.hour != 9:
-            sent_today = False
-        await asyncio.sleep(60)
-
-class Handler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        self.send_response(200)
-        self.send_header("Content-type", "text/plain")
-        self.end_headers()
-        self.wfile.write(b"Anya Bot is running")
-    def do_HEAD(self):
-        self.send_response(200)
-        self.send_header("Content-type", "text/plain")
-        self.end_headers()
-    def log_message(self, format, *args):
-        pass
-
-def run_web():
-    port = int(os.environ.get("PORT", 8080))
-    server = HTTPServer(("0.0.0.0", port), Handler)
-    server.serve_forever()
-
-async def background_tasks():
-    await asyncio.gather(
-        send_daily_news(),
-        check_reminders(),
-        check_prices()
-    )
+async def build_memory_index():
+    """啟動時在背景建立索引，不擋住 polling；建好前檢索回傳空結果"""
+    try:
+        await refresh_memory_index()
+    except Exception as e:
+        print("建立記憶索引失敗: " + str(e))
+    startup_phase("memory_index")
+
+def traced_job(name, func):
+    # 背景工作不經過 handler，自己開一個 trace
+    return tracing.traced("job:" + name, root=True)(func)
+
+def schedule_jobs():
+    news_at = datetime.datetime.combine(datetime.date.today(), datetime.time(NEWS_HOUR))
+    scheduler.daily("weekly_reminders", datetime.time(REMINDER_HOUR), traced_job("weekly_reminders", send_weekly_reminders),
+                    catch_up=REMINDER_CATCH_UP)
+    scheduler.daily("prewarm_news", (news_at - datetime.timedelta(minutes=NEWS_PREWARM_MINUTES)).time(),
+                    traced_job("prewarm_news", prewarm_news), catch_up=NEWS_PREWARM_MINUTES * 60)
+    scheduler.daily("daily_news", news_at.time(), traced_job("daily_news", send_daily_news), catch_up=NEWS_CATCH_UP)
+    scheduler.every("check_prices", PRICE_CHECK_INTERVAL, traced_job("check_prices", check_prices))
+    scheduler.every("compact_memories", MEMORY_COMPACT_INTERVAL, traced_job("compact_memories", compact_memories))
+    scheduler.every("sync_memory_index", MEMORY_INDEX_SYNC_INTERVAL, traced_job("sync_memory_index", sync_memory_index))
+    scheduler.every("refresh_memory_index", MEMORY_INDEX_REBUILD_INTERVAL, traced_job("refresh_memory_index", refresh_memory_index))
+    try:
+        schedule_event_reminders()
+    except Exception as e:
+        print("載入行程提醒失敗: " + str(e))
+
+async def on_startup(application):
+    # 背景工作和對話共用 Application 的事件循環、Bot 和 HTTP 連線池
+    global telegram_app, model_refresh_task, memory_index_task
+    telegram_app = application
+    # 留著參照，避免背景 task 被回收
+    memory_index_task = asyncio.create_task(build_memory_index())
+    schedule_jobs()
+    scheduler.start()
+    if model_stale:
+        model_refresh_task = asyncio.create_task(refresh_model())
+    startup_phase("post_init")
+    print(startup_report())
+
+async def on_shutdown(application):
+    await scheduler.stop(SHUTDOWN_GRACE)
+    await http_client.aclose()
+    llm_executor.shutdown(wait=False, cancel_futures=True)
 
 def main():
-    threading.Thread(target=run_web, daemon=True).start()
-    threading.Thread(target=lambda: asyncio.run(background_tasks()), daemon=True).start()
-    app = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).build()
-    app.add_handler(CommandHandler("memory", cmd_memory))
-    app.add_handler(CommandHandler("forget", cmd_forget))
-    app.add_handler(CommandHandler("news", cmd_news))
-    app.add_handler(CommandHandler("calendar", cmd_calendar))
-    app.add_handler(CommandHandler("shopping", cmd_shopping))
-    app.add_handler(CommandHandler("expenses", cmd_expenses))
-    app.add_handler(CommandHandler("summary", cmd_summary))
-    app.add_handler(CommandHandler("models", cmd_models))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-    app.add_handler(MessageHandler(filters.VOICE, handle_message))
-    app.add_handler(MessageHandler(filters.PHOTO, handle_message))
+    web.start(int(os.environ.get("PORT", 8080)))
+    # 排隊等令牌的訊息不能擋住其他人的訊息，更新要並行處理
+    app = (ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).concurrent_updates(True)
+           .post_init(on_startup).post_stop(on_shutdown).build())
+    app.add_handler(CommandHandler("memory", instrument_handler("cmd_memory", cmd_memory)))
+    app.add_handler(CommandHandler("forget", instrument_handler("cmd_forget", cmd_forget)))
+    app.add_handler(CommandHandler("news", instrument_handler("cmd_news", cmd_news)))
+    app.add_handler(CommandHandler("calendar", instrument_handler("cmd_calendar", cmd_calendar)))
+    app.add_handler(CommandHandler("shopping", instrument_handler("cmd_shopping", cmd_shopping)))
+    app.add_handler(CommandHandler("expenses", instrument_handler("cmd_expenses", cmd_expenses)))
+    app.add_handler(CommandHandler("summary", instrument_handler("cmd_summary", cmd_summary)))
+    app.add_handler(CommandHandler("models", instrument_handler("cmd_models", cmd_models)))
+    app.add_handler(CommandHandler("watch", instrument_handler("cmd_watch", cmd_watch)))
+    app.add_handler(CommandHandler("watchlist", instrument_handler("cmd_watchlist", cmd_watchlist)))
+    app.add_handler(CommandHandler("unwatch", instrument_handler("cmd_unwatch", cmd_unwatch)))
+    message_handler = instrument_handler("handle_message:ignored", handle_message)
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler))
+    app.add_handler(MessageHandler(filters.VOICE, message_handler))
+    app.add_handler(MessageHandler(filters.PHOTO, message_handler))
+    startup_phase("app_build")
     print("安尼亞 Bot 已成功啟動！")
     app.run_polling()
 
@@ -1,19 +1,36 @@
 import os
+import time
+import threading
 from supabase import create_client
+from retrieval import MemoryIndex
 
 SUPABASE_URL = os.environ["SUPABASE_URL"]
 SUPABASE_KEY = os.environ["SUPABASE_KEY"]
+# in_() 的 id 會放進網址，分批刪除避免超過網址長度上限
+DELETE_BATCH_SIZE = 200
 
 class MemoryDB:
     def __init__(self):
         self.client = create_client(SUPABASE_URL, SUPABASE_KEY)
+        # 記憶檢索索引，啟動時在背景建立，之後隨寫入更新、定時讀入新資料；建好前查詢回傳空結果
+        self.index = None
+        self.index_built_at = 0.0
+        # 已從資料庫讀入索引的最大 id，下次同步只讀比它新的
+        self.index_synced_id = 0
+        # 重建或同步期間的寫入先記下，讀完資料庫後再套用，避免漏掉或加回已刪除的記憶
+        self.index_changes = None
+        # 背景重建、記憶整理和對話會同時用到索引
+        self.index_lock = threading.RLock()
 
     def add_memory(self, content, category="一般", sender_name="未知"):
-        self.client.table("memory_v2").insert({
+        response = self.client.table("memory_v2").insert({
             "category": category,
             "content": content,
             "sender_name": sender_name
         }).execute()
+        with self.index_lock:
+            for r in response.data:
+                self._index_change("add", r)
 
     def get_by_category(self, category):
         response = self.client.table("memory_v2").select("content, sender_name").eq("category", category).execute()
@@ -25,6 +42,123 @@ class MemoryDB:
 
     def forget_all(self):
         self.client.table("memory_v2").delete().neq("id", 0).execute()
+        with self.index_lock:
+            if self.index is not None:
+                self.index = MemoryIndex()
+            if self.index_changes is not None:
+                self.index_changes.append(("clear", None))
+
+    def delete_memories(self, ids):
+        if not ids:
+            return
+        ids = list(ids)
+        for i in range(0, len(ids), DELETE_BATCH_SIZE):
+            batch = ids[i:i + DELETE_BATCH_SIZE]
+            self.client.table("memory_v2").delete().in_("id", batch).execute()
+            with self.index_lock:
+                for memory_id in batch:
+                    self._index_change("remove", memory_id)
+
+    # 記憶檢索
+    def get_all_rows(self, category=None, page_size=1000, after_id=None):
+        """分頁讀出 memory_v2 全部資料（Supabase 每次最多回傳 1000 筆）；給 after_id 只讀 id 比它大的"""
+        rows = []
+        start = 0
+        while True:
+            query = self.client.table("memory_v2").select("id, category, content, sender_name")
+            if category is not None:
+                query = query.eq("category", category)
+            if after_id is not None:
+                query = query.gt("id", after_id)
+            response = query.order("id").range(start, start + page_size - 1).execute()
+            rows.extend(response.data)
+            if len(response.data) < page_size:
+                return rows
+            start += page_size
+
+    def _index_row(self, index, r):
+        index.add(r["id"], r["sender_name"] + " " + r["content"], r)
+
+    def _apply_change(self, index, kind, value):
+        if kind == "add":
+            self._index_row(index, value)
+        elif kind == "remove":
+            index.remove(value)
+
+    def _index_change(self, kind, value):
+        """呼叫時要持有 index_lock"""
+        if self.index is not None:
+            self._apply_change(self.index, kind, value)
+        if self.index_changes is not None:
+            self.index_changes.append((kind, value))
+
+    def _begin_index_job(self):
+        """同一時間只跑一個重建或同步；已有在跑的回傳 False"""
+        with self.index_lock:
+            if self.index_changes is not None:
+                return False
+            self.index_changes = []
+            return True
+
+    def _end_index_job(self):
+        with self.index_lock:
+            self.index_changes = None
+
+    def rebuild_index(self):
+        """從資料庫重建整個索引（包含其他進程的修改和刪除），會阻塞，要在背景線程執行；建好前繼續用舊索引"""
+        if not self._begin_index_job():
+            return
+        try:
+            rows = self.get_all_rows()
+            index = MemoryIndex()
+            for r in rows:
+                self._index_row(index, r)
+            with self.index_lock:
+                for kind, value in self.index_changes:
+                    if kind == "clear":
+                        index = MemoryIndex()
+                    else:
+                        self._apply_change(index, kind, value)
+                self.index = index
+                self.index_synced_id = max((r["id"] for r in rows), default=0)
+                self.index_built_at = time.monotonic()
+        finally:
+            self._end_index_job()
+
+    def sync_index(self):
+        """只讀出上次之後新增的記憶（其他進程的寫入）加進索引；還沒有索引就整個重建。會阻塞，要在背景線程執行"""
+        if self.index is None:
+            return self.rebuild_index()
+        if not self._begin_index_job():
+            return
+        try:
+            rows = self.get_all_rows(after_id=self.index_synced_id)
+            with self.index_lock:
+                # 讀取期間被刪除或清空的不要加回去
+                if any(kind == "clear" for kind, _ in self.index_changes):
+                    rows = []
+                removed = {value for kind, value in self.index_changes if kind == "remove"}
+                for r in rows:
+                    if r["id"] not in removed and r["id"] not in self.index.docs:
+                        self._index_row(self.index, r)
+                    self.index_synced_id = max(self.index_synced_id, r["id"])
+        finally:
+            self._end_index_job()
+
+    def search_memories(self, query, categories, k=8, budget=None):
+        """找和 query 最相關的記憶；只查記憶體內的索引，不會連資料庫"""
+        with self.index_lock:
+            if self.index is None:
+                return []
+            return self.index.search(query, k=k, budget=budget, accept=lambda r: r["category"] in categories)
+
+    def recent_memories(self, category, count):
+        """索引中某分類最新的幾筆"""
+        with self.index_lock:
+            if self.index is None:
+                return []
+            rows = [payload for payload, _ in self.index.docs.values() if payload["category"] == category]
+        return sorted(rows, key=lambda r: r["id"])[-count:]
 
     def set_preference(self, key, value):
         self.client.table("preferences").upsert({"key": key, "value": value}).execute()
@@ -37,13 +171,15 @@ class MemoryDB:
 
     # 行事曆
     def add_event(self, title, category, event_date, reminder_days=1, created_by="未知"):
-        self.client.table("calendar").insert({
+        """回傳新增的一行（含 id）"""
+        response = self.client.table("calendar").insert({
             "title": title,
             "category": category,
             "event_date": event_date,
             "reminder_days": reminder_days,
             "created_by": created_by
         }).execute()
+        return response.data[0] if response.data else None
 
     def get_upcoming_events(self, days=7):
         from datetime import date, timedelta
@@ -67,6 +203,16 @@ class MemoryDB:
             "added_by": added_by
         }).execute()
 
+    def add_shopping_many(self, items, added_by="未知"):
+        """items 是 [{"item", "quantity"}]，一次寫入"""
+        if not items:
+            return
+        self.client.table("shopping").insert([{
+            "item": i["item"],
+            "quantity": i.get("quantity", "1"),
+            "added_by": added_by
+        } for i in items]).execute()
+
     def get_shopping_list(self):
         response = self.client.table("shopping").select("*").eq("done", False).execute()
         return response.data
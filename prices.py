@@ -0,0 +1,238 @@
+import re
+import html
+import codecs
+import urllib.parse
+
+PRICE_CHUNK_SIZE = 64 * 1024
+PRICE_MAX_BYTES = 5 * 1024 * 1024
+# 每段新內容會連同上一段最後這麼多字一起搜尋，避免價格剛好被切開
+SCAN_OVERLAP = 512
+# 購買框裡的存貨、幣別通常在價格前後幾 KB 內
+META_NEAR_PRICE = 4096
+
+# 網址中只用來追蹤來源的參數，去掉後才比較是不是同一件商品
+TRACKING_PARAMS = {"ref", "ref_", "tag", "th", "psc", "smid", "linkcode", "linkid", "camp", "creative",
+                   "creativeasin", "ascsubtag", "sprefix", "crid", "qid", "sr", "keywords", "content-id",
+                   "pd_rd_i", "pd_rd_r", "pd_rd_w", "pd_rd_wg", "pf_rd_p", "pf_rd_r", "icid", "irclickid"}
+AMAZON_ASIN = re.compile(r"/(?:dp|gp/product|gp/aw/d)/([A-Z0-9]{10})")
+
+TITLE_PATTERN = re.compile(r"<title[^>]*>([^<]+)</title>", re.I)
+CANONICAL_PATTERN = re.compile(r"<link\b[^>]*\brel=[\"']canonical[\"'][^>]*>", re.I)
+HREF_PATTERN = re.compile(r"\bhref=[\"']([^\"']+)[\"']", re.I)
+CURRENCY_PATTERNS = [
+    re.compile(r'"priceCurrency"\s*:\s*"([A-Z]{3})"'),
+    re.compile(r'price:currency"\s+content="([A-Z]{3})"'),
+    re.compile(r'"currencyCode"\s*:\s*"([A-Z]{3})"'),
+]
+AVAILABILITY_PATTERNS = [
+    (re.compile(r"schema\.org/(InStock|OutOfStock|PreOrder|SoldOut|Discontinued|LimitedAvailability)"), None),
+    # 只認 Amazon 購買框裡的，推薦商品輪播裡也會出現這句
+    (re.compile(r'id="availability".{0,300}?Currently unavailable', re.S), "OutOfStock"),
+]
+TITLE_SUFFIXES = [" | Amazon.ca", " : Amazon.ca", " - Best Buy", " | Best Buy Canada", " | Canadian Tire", " - Canadian Tire"]
+
+def canonical_url(url):
+    """去掉追蹤參數和錨點；Amazon 統一成 /dp/ASIN"""
+    parts = urllib.parse.urlsplit(url.strip())
+    host = (parts.hostname or "").lower()
+    if "amazon." in host:
+        m = AMAZON_ASIN.search(parts.path)
+        if m:
+            return "https://" + host + "/dp/" + m.group(1)
+    query = [(k, v) for k, v in urllib.parse.parse_qsl(parts.query, keep_blank_values=True)
+             if k.lower() not in TRACKING_PARAMS and not k.lower().startswith("utm_")]
+    return urllib.parse.urlunsplit((parts.scheme.lower() or "https", parts.netloc.lower(), parts.path.rstrip("/") or "/",
+                                    urllib.parse.urlencode(query), ""))
+
+def clean_title(title):
+    title = html.unescape(title).strip()
+    for suffix in TITLE_SUFFIXES:
+        title = title.replace(suffix, "")
+    return title[:60]
+
+class PriceExtractor:
+    """一個零售商的價格規則，patterns 依優先次序排列"""
+
+    def __init__(self, name, hosts, patterns):
+        self.name = name
+        self.hosts = hosts
+        # 可信規則邊下載邊找，一找到就停止下載；其餘規則讀完整頁後依次序再找
+        self.confident = [re.compile(p) for p, confident in patterns if confident]
+        self.fallback = [re.compile(p) for p, confident in patterns if not confident]
+
+    def matches(self, host):
+        return any(host == h or host.endswith("." + h) for h in self.hosts)
+
+# 通用價格規則，所有零售商找不到時都會用
+GENERIC_PATTERNS = [
+    (r'\$([\d,]+\.\d{2})', False),
+    (r'"price":([\d.]+)', False),
+    (r'"currentPrice":([\d.]+)', False),
+    (r'"salePrice":([\d.]+)', False),
+]
+
+extractors = []
+generic_extractor = PriceExtractor("generic", [], GENERIC_PATTERNS)
+
+def register_extractor(name, hosts, patterns):
+    """登記零售商規則，通用規則會自動接在後面"""
+    extractor = PriceExtractor(name, hosts, list(patterns) + GENERIC_PATTERNS)
+    extractors.append(extractor)
+    return extractor
+
+register_extractor("amazon", ["amazon.ca", "amazon.com"], [
+    (r'class="a-price-whole">([\d,]+)', True),
+    (r'"priceAmount":([\d.]+)', True),
+    (r'id="priceblock_ourprice"[^>]*>\$?([\d,\.]+)', True),
+    (r'"price":\s*([\d.]+)', False),
+])
+register_extractor("bestbuy", ["bestbuy.ca"], [
+    (r'"salePrice":([\d.]+)', True),
+    (r'"regularPrice":([\d.]+)', False),
+    (r'data-automation="product-price"[^>]*>\$?([\d,\.]+)', False),
+])
+register_extractor("canadiantire", ["canadiantire.ca"], [
+    (r'"offering-price"[^>]*>\$?([\d,\.]+)', True),
+    (r'"price":{"value":([\d.]+)', True),
+    (r'data-price="([\d.]+)"', False),
+])
+
+def extractor_for(url):
+    host = (urllib.parse.urlsplit(url).hostname or "").lower()
+    for extractor in extractors:
+        if extractor.matches(host):
+            return extractor
+    return generic_extractor
+
+def parse_price(m):
+    try:
+        return float(m.group(1).replace(",", ""))
+    except ValueError:
+        return None
+
+class PriceScanner:
+    """逐段餵入網頁內容，同時收集標題、幣別、存貨和正規網址；可信價格規則即時搜尋，其餘留待 finish()"""
+
+    def __init__(self, extractor):
+        self.extractor = extractor
+        self.price = None
+        self.price_done = False
+        self.head_done = False
+        self.title = None
+        self.canonical = None
+        self.currency = None
+        self.availability = None
+        self.parts = []
+        self.tail = ""
+
+    @property
+    def done(self):
+        return self.price_done and self.head_done
+
+    def _scan_meta(self, window, price_at=None):
+        """標題和正規網址只在頁首找；幣別和存貨只在頁首和價格前後找，其餘內容不再逐段搜尋"""
+        regions = []
+        if not self.head_done:
+            end = window.find("</head>")
+            head = window if end == -1 else window[:end]
+            if self.title is None:
+                m = TITLE_PATTERN.search(head)
+                if m:
+                    self.title = clean_title(m.group(1))
+            if self.canonical is None:
+                m = CANONICAL_PATTERN.search(head)
+                if m:
+                    href = HREF_PATTERN.search(m.group(0))
+                    if href:
+                        self.canonical = html.unescape(href.group(1))
+            self.head_done = end != -1 or (self.title is not None and self.canonical is not None)
+            regions.append(head)
+        if price_at is not None:
+            regions.append(window[max(0, price_at - META_NEAR_PRICE):price_at + META_NEAR_PRICE])
+        for region in regions:
+            if self.currency is None:
+                for pattern in CURRENCY_PATTERNS:
+                    m = pattern.search(region)
+                    if m:
+                        self.currency = m.group(1)
+                        break
+            if self.availability is None:
+                for pattern, value in AVAILABILITY_PATTERNS:
+                    m = pattern.search(region)
+                    if m:
+                        self.availability = value or m.group(1)
+                        break
+
+    def feed(self, text):
+        """回傳 True 表示價格和頁首資料都找到了，不用再讀"""
+        window = self.tail + text
+        self.tail = window[-SCAN_OVERLAP:]
+        self.parts.append(text)
+        price_at = None
+        if not self.price_done:
+            for pattern in self.extractor.confident:
+                m = pattern.search(window)
+                if m:
+                    price = parse_price(m)
+                    if price is not None:
+                        self.price = price
+                        self.price_done = True
+                        price_at = m.start()
+                        break
+        self._scan_meta(window, price_at)
+        return self.done
+
+    def finish(self):
+        """沒有可信價格時，用其餘規則搜尋整頁"""
+        if self.price_done:
+            return self.price
+        page = "".join(self.parts)
+        for pattern in self.extractor.fallback:
+            for m in pattern.finditer(page):
+                price = parse_price(m)
+                if price is not None:
+                    self.price = price
+                    self._scan_meta(page, m.start())
+                    return price
+        return None
+
+    def snapshot(self, url):
+        price = self.finish()
+        host = (urllib.parse.urlsplit(url).hostname or "").lower()
+        canonical = urllib.parse.urljoin(url, self.canonical) if self.canonical else url
+        return {
+            "url": url,
+            "canonical_url": canonical_url(canonical),
+            "title": self.title,
+            "price": price,
+            "currency": self.currency or ("CAD" if host.endswith(".ca") else None),
+            "availability": self.availability,
+        }
+
+def incremental_decoder(encoding):
+    try:
+        return codecs.getincrementaldecoder(encoding or "utf-8")(errors="replace")
+    except LookupError:
+        return codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+def scan_stream(chunks, url, encoding=None, max_bytes=PRICE_MAX_BYTES):
+    """從 bytes 片段讀出商品快照，價格和頁首都找到或超過 max_bytes 就停，回傳 (快照, 已讀 bytes)"""
+    decoder = incremental_decoder(encoding)
+    scanner = PriceScanner(extractor_for(url))
+    bytes_read = 0
+    for chunk in chunks:
+        bytes_read += len(chunk)
+        if scanner.feed(decoder.decode(chunk)) or bytes_read >= max_bytes:
+            break
+    return scanner.snapshot(url), bytes_read
+
+async def scan_stream_async(chunks, url, encoding=None, max_bytes=PRICE_MAX_BYTES):
+    """scan_stream 的非同步版本，chunks 是 async iterator"""
+    decoder = incremental_decoder(encoding)
+    scanner = PriceScanner(extractor_for(url))
+    bytes_read = 0
+    async for chunk in chunks:
+        bytes_read += len(chunk)
+        if scanner.feed(decoder.decode(chunk)) or bytes_read >= max_bytes:
+            break
+    return scanner.snapshot(url), bytes_read
@@ -0,0 +1,93 @@
+import sys
+import time
+import threading
+import collections
+
+# 取樣間隔下限，太小或負數會讓取樣線程空轉吃滿 CPU
+MIN_INTERVAL = 0.001
+
+class SamplingProfiler:
+    """取樣式分析器：背景線程每隔 interval 秒記下所有線程的呼叫堆疊，開銷小，可以在正式環境隨時開關"""
+
+    def __init__(self, interval=0.01, max_depth=40):
+        self.interval = max(MIN_INTERVAL, interval)
+        self.max_depth = max_depth
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.stacks = collections.Counter()
+            self.self_counts = collections.Counter()
+            self.samples = 0
+            self.started_at = None
+            self.stopped_at = None
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, interval=None, duration=None):
+        """開始取樣；給 duration 秒就到時自動停止"""
+        if self.running:
+            return False
+        if interval is not None:
+            self.interval = max(MIN_INTERVAL, interval)
+        self.reset()
+        self.started_at = time.time()
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, args=(duration,), name="profiler", daemon=True)
+        self.thread.start()
+        return True
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout=2)
+        self.stopped_at = self.stopped_at or time.time()
+
+    def run(self, duration):
+        ends = time.monotonic() + duration if duration else None
+        own_id = threading.get_ident()
+        names = {}
+        while not self.stop_event.wait(self.interval):
+            if ends is not None and time.monotonic() >= ends:
+                break
+            if len(names) != threading.active_count():
+                names = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                f = frame
+                while f is not None and len(stack) < self.max_depth:
+                    code = f.f_code
+                    stack.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{f.f_lineno})")
+                    f = f.f_back
+                if not stack:
+                    continue
+                stack.reverse()
+                with self.lock:
+                    self.stacks[(names.get(thread_id, str(thread_id)),) + tuple(stack)] += 1
+                    self.self_counts[stack[-1]] += 1
+            with self.lock:
+                self.samples += 1
+        self.stopped_at = time.time()
+
+    def report(self, top=30):
+        """最常出現的葉節點函式，以及 collapsed 格式的堆疊（可以直接餵給 flamegraph.pl）"""
+        with self.lock:
+            stacks = self.stacks.most_common()
+            self_counts = self.self_counts.most_common(top)
+            samples = self.samples
+        state = "取樣中" if self.running else "已停止"
+        lines = [f"分析器{state}，每 {self.interval * 1000:.0f} ms 取樣一次，共 {samples} 次", "", "最常在執行的函式："]
+        total = sum(count for _, count in stacks) or 1
+        for name, count in self_counts:
+            lines.append(f"{count:>7} {count * 100 / total:5.1f}%  {name}")
+        lines += ["", "堆疊（collapsed）："]
+        for stack, count in stacks[:top * 3]:
+            lines.append(";".join(stack) + " " + str(count))
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,53 @@
+import re
+
+CJK_CHAR = re.compile(r"[\u3000-\u9fff\uf900-\ufaff\uff00-\uffef]")
+
+def estimate_tokens(text):
+    """粗略估算 token 數：中日韓文字約一字一 token，其餘約四個字元一 token"""
+    cjk = len(CJK_CHAR.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+def truncate_tokens(text, max_tokens):
+    """截到 max_tokens 以內，盡量在段落或換行處截斷"""
+    if max_tokens <= 0:
+        return ""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    # 先按比例估一個長度，再逐步縮短
+    end = max(1, len(text) * max_tokens // estimate_tokens(text))
+    while end > 0 and estimate_tokens(text[:end]) > max_tokens:
+        end = end * 9 // 10
+    cut = text[:end]
+    for sep in ("\n\n", "\n"):
+        pos = cut.rfind(sep)
+        if pos > end // 2:
+            return cut[:pos]
+    return cut
+
+class PromptBudget:
+    """按段落組合提示；每段可設上限，總數超出時按 trim_order 先後截短"""
+
+    def __init__(self, total, caps=None, trim_order=()):
+        self.total = total
+        self.caps = caps or {}
+        self.trim_order = list(trim_order)
+
+    def fit(self, sections):
+        """sections 是 [(名稱, 文字)]，回傳 ({名稱: 截短後文字}, {名稱: token 數})"""
+        texts = {}
+        for name, text in sections:
+            cap = self.caps.get(name)
+            texts[name] = truncate_tokens(text, cap) if cap is not None else text
+        sizes = {name: estimate_tokens(text) for name, text in texts.items()}
+        over = sum(sizes.values()) - self.total
+        for name in self.trim_order:
+            if over <= 0:
+                break
+            if name not in texts or not sizes[name]:
+                continue
+            keep = max(0, sizes[name] - over)
+            texts[name] = truncate_tokens(texts[name], keep)
+            new_size = estimate_tokens(texts[name])
+            over -= sizes[name] - new_size
+            sizes[name] = new_size
+        return texts, sizes
@@ -0,0 +1,102 @@
+import time
+import asyncio
+import collections
+
+class TokenBucket:
+    """令牌桶；reserve 可以預支令牌，回傳要等多久才輪到，後來的請求自然排在後面"""
+
+    def __init__(self, rate, capacity, now=None):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic() if now is None else now
+
+    def refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def wait_time(self, now):
+        """現在要一個令牌需要等多久，不扣令牌"""
+        self.refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def reserve(self, now):
+        wait = self.wait_time(now)
+        self.tokens -= 1
+        return wait
+
+class BucketTable:
+    """按 key 分的令牌桶；最多保留 max_entries 個，超出時丟掉最久沒用的"""
+
+    def __init__(self, rate, capacity, max_entries=10000):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_entries = max_entries
+        self.buckets = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.buckets)
+
+    def get(self, key, now):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(self.rate, self.capacity, now)
+            self.buckets[key] = bucket
+            while len(self.buckets) > self.max_entries:
+                # 最久沒用的桶通常早已回滿，丟掉再重建沒有分別
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+        return bucket
+
+class RateLimiter:
+    """每位用戶、每個群組各一個令牌桶，另有一個全域桶對應模型每分鐘請求配額。
+    收到配額錯誤時全域速率減半，之後每次成功慢慢加回去"""
+
+    def __init__(self, user_per_min, user_burst, chat_per_min, chat_burst, llm_per_min,
+                 max_entries=10000, max_wait=120, min_llm_per_min=1):
+        self.users = BucketTable(user_per_min / 60, user_burst, max_entries)
+        self.chats = BucketTable(chat_per_min / 60, chat_burst, max_entries)
+        self.llm_rate = llm_per_min / 60
+        self.min_llm_rate = min_llm_per_min / 60
+        self.llm = TokenBucket(self.llm_rate, max(1, llm_per_min // 4))
+        self.max_wait = max_wait
+        self.stats = {"admitted": 0, "queued": 0, "rejected": 0, "quota_errors": 0}
+
+    def admit(self, user_id, chat_id=None, now=None):
+        """為一則訊息預留用戶和群組令牌，回傳要等的秒數；要等超過 max_wait 就不預留，回傳 None。
+        全域模型令牌不在這裡等，很多訊息不用呼叫模型，要呼叫時由 acquire_llm 排隊"""
+        now = time.monotonic() if now is None else now
+        buckets = [self.users.get(user_id, now)]
+        if chat_id is not None:
+            buckets.append(self.chats.get(chat_id, now))
+        wait = max(b.wait_time(now) for b in buckets)
+        if wait > self.max_wait:
+            self.stats["rejected"] += 1
+            return None
+        for b in buckets:
+            b.reserve(now)
+        self.stats["queued" if wait > 0 else "admitted"] += 1
+        return wait
+
+    async def acquire_llm(self, max_wait=None):
+        """每次呼叫模型前取一個全域令牌，不夠就排隊等；要等超過 max_wait 拋 asyncio.TimeoutError"""
+        now = time.monotonic()
+        if max_wait is not None and self.llm.wait_time(now) > max_wait:
+            raise asyncio.TimeoutError()
+        wait = self.llm.reserve(now)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def on_quota_exceeded(self):
+        self.stats["quota_errors"] += 1
+        now = time.monotonic()
+        self.llm.refill(now)
+        self.llm.rate = max(self.min_llm_rate, self.llm.rate / 2)
+        self.llm.tokens = min(self.llm.tokens, 0)
+
+    def on_success(self):
+        if self.llm.rate < self.llm_rate:
+            self.llm.refill(time.monotonic())
+            self.llm.rate = min(self.llm_rate, self.llm.rate + self.llm_rate / 20)
@@ -0,0 +1,91 @@
+import re
+import math
+import heapq
+
+# 中文沒有空格分詞，用單字 + 相鄰兩字；英文和數字用整個詞
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+|[\u3400-\u9fff\uf900-\ufaff]+")
+CJK_START = "\u3400"
+
+def tokenize(text):
+    tokens = []
+    for run in TOKEN_PATTERN.findall(text.lower()):
+        if run[0] < CJK_START:
+            tokens.append(run)
+            continue
+        tokens.extend(run)
+        tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+class MemoryIndex:
+    """記憶的 BM25 檢索索引，可逐筆加入或刪除"""
+
+    def __init__(self, k1=1.2, b=0.75, max_df_ratio=0.5):
+        self.k1 = k1
+        self.b = b
+        # 出現在超過這個比例文件中的詞幾乎沒有區分度，查詢時跳過以節省時間
+        self.max_df_ratio = max_df_ratio
+        self.postings = {}
+        self.doc_len = {}
+        self.docs = {}
+        self.total_len = 0
+
+    def __len__(self):
+        return len(self.docs)
+
+    def add(self, doc_id, text, payload):
+        if doc_id in self.docs:
+            self.remove(doc_id)
+        tokens = tokenize(text)
+        counts = {}
+        for token in tokens:
+            counts[token] = counts.get(token, 0) + 1
+        for token, tf in counts.items():
+            self.postings.setdefault(token, {})[doc_id] = tf
+        self.doc_len[doc_id] = len(tokens)
+        self.total_len += len(tokens)
+        self.docs[doc_id] = (payload, list(counts))
+
+    def remove(self, doc_id):
+        entry = self.docs.pop(doc_id, None)
+        if entry is None:
+            return
+        for token in entry[1]:
+            posting = self.postings.get(token)
+            if posting is not None:
+                posting.pop(doc_id, None)
+                if not posting:
+                    del self.postings[token]
+        self.total_len -= self.doc_len.pop(doc_id)
+
+    def search(self, query, k=8, budget=None, accept=None):
+        """回傳分數最高的 payload；budget 是內容總字數上限，accept 用來過濾 payload"""
+        n = len(self.docs)
+        if n == 0:
+            return []
+        avgdl = self.total_len / n or 1
+        max_df = max(1, int(n * self.max_df_ratio))
+        scores = {}
+        for token in set(tokenize(query)):
+            posting = self.postings.get(token)
+            if not posting or len(posting) > max_df:
+                continue
+            df = len(posting)
+            idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+            for doc_id, tf in posting.items():
+                norm = tf + self.k1 * (1 - self.b + self.b * self.doc_len[doc_id] / avgdl)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (self.k1 + 1) / norm
+        results = []
+        used = 0
+        # 多取一些候選，過濾和字數限制後仍可湊夠 k 條
+        for doc_id, _ in heapq.nlargest(k * 4, scores.items(), key=lambda kv: kv[1]):
+            payload = self.docs[doc_id][0]
+            if accept is not None and not accept(payload):
+                continue
+            size = len(payload.get("content", ""))
+            if budget is not None and used + size > budget:
+                continue
+            results.append(payload)
+            used += size
+            if len(results) >= k:
+                break
+        return results
@@ -0,0 +1,185 @@
+import os
+import time
+import heapq
+import asyncio
+import datetime
+import itertools
+import sqlite3
+
+SCHEDULER_DB = os.environ.get("SCHEDULER_DB", "scheduler.db")
+# 睡眠上限，防止系統時間跳動後睡過頭
+MAX_SLEEP = 3600
+
+class Job:
+    def __init__(self, name, func, kind, interval=None, at=None, when=None, catch_up=0.0):
+        self.name = name
+        self.func = func
+        self.kind = kind
+        self.interval = interval
+        self.at = at
+        self.when = when
+        self.catch_up = catch_up
+        self.due = None
+
+    def next_due(self, last_run, now):
+        """下次執行的時間（epoch 秒）；錯過但仍在 catch_up 秒內的會馬上執行，沒有下次回傳 None"""
+        if self.kind == "every":
+            return (last_run if last_run is not None else now) + self.interval
+        if self.kind == "once":
+            if last_run is not None or self.when < now - self.catch_up:
+                return None
+            return self.when
+        # daily：找 ref 之後第一個 at 時刻，ref 不早於 now - catch_up，太久以前錯過的就不補了
+        ref = now - self.catch_up if last_run is None else max(last_run, now - self.catch_up)
+        ref_dt = datetime.datetime.fromtimestamp(ref)
+        due = datetime.datetime.combine(ref_dt.date(), self.at)
+        if due <= ref_dt:
+            due += datetime.timedelta(days=1)
+        return due.timestamp()
+
+class Scheduler:
+    """最小堆排程：睡到最早到期的工作才醒，不用每分鐘輪詢；
+    每個工作上次執行的時間存在 SQLite，重啟後錯過的會補跑。
+    只在 Application 的事件循環內使用"""
+
+    def __init__(self, path=None):
+        self.conn = sqlite3.connect(path or SCHEDULER_DB, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS jobs (name TEXT PRIMARY KEY, last_run REAL)")
+        self.last_runs = dict(self.conn.execute("SELECT name, last_run FROM jobs").fetchall())
+        self.jobs = {}
+        self.heap = []
+        self.seq = itertools.count()
+        self.running = set()
+        self.tasks = set()
+        self.wakeup = None
+        self.task = None
+        self.stats = {"runs": 0, "errors": 0, "caught_up": 0}
+
+    def every(self, name, interval, func):
+        """每 interval 秒執行一次；重啟後從上次執行時間起計"""
+        self.add(Job(name, func, "every", interval=interval))
+
+    def daily(self, name, at, func, catch_up=3600):
+        """每天 at（datetime.time）執行；錯過 catch_up 秒內的會補跑"""
+        self.add(Job(name, func, "daily", at=at, catch_up=catch_up))
+
+    def once(self, name, when, func, catch_up=86400):
+        """在 when（epoch 秒）執行一次；執行過的同名工作不會再執行"""
+        self.add(Job(name, func, "once", when=when, catch_up=catch_up))
+
+    def add(self, job):
+        now = time.time()
+        due = job.next_due(self.last_runs.get(job.name), now)
+        self.jobs[job.name] = job
+        job.due = due
+        if due is not None:
+            heapq.heappush(self.heap, (due, next(self.seq), job.name))
+        self._wake()
+
+    def cancel(self, name):
+        job = self.jobs.pop(name, None)
+        if job is not None:
+            job.due = None
+
+    def cancel_prefix(self, prefix, keep=()):
+        """取消名稱以 prefix 開頭的工作（keep 裡的除外），回傳取消了幾個"""
+        names = [name for name in self.jobs if name.startswith(prefix) and name not in keep]
+        for name in names:
+            self.cancel(name)
+        return len(names)
+
+    def next_run(self, name):
+        job = self.jobs.get(name)
+        return job.due if job is not None else None
+
+    def _wake(self):
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    def _record(self, name, ran_at):
+        self.last_runs[name] = ran_at
+        self.conn.execute("INSERT OR REPLACE INTO jobs (name, last_run) VALUES (?, ?)", (name, ran_at))
+
+    def prune(self, max_age=30 * 86400):
+        """刪掉很久沒執行、也不在排程內的記錄（主要是已發出的一次性提醒）"""
+        cutoff = time.time() - max_age
+        stale = [name for name, last_run in self.last_runs.items() if last_run < cutoff and name not in self.jobs]
+        for name in stale:
+            self.last_runs.pop(name, None)
+        self.conn.executemany("DELETE FROM jobs WHERE name = ?", [(name,) for name in stale])
+
+    def _pop_due(self, now):
+        """取出所有到期的工作，回傳 ([(工作, 到期時間)], 下一個到期時間)"""
+        due_jobs = []
+        while self.heap:
+            due, _, name = self.heap[0]
+            job = self.jobs.get(name)
+            if job is None or job.due != due:
+                # 已取消或已重新排程的舊項目
+                heapq.heappop(self.heap)
+                continue
+            if due > now:
+                return due_jobs, due
+            heapq.heappop(self.heap)
+            job.due = None
+            due_jobs.append((job, due))
+        return due_jobs, None
+
+    async def _run_job(self, job, due, now):
+        if now - due > 60:
+            self.stats["caught_up"] += 1
+            print("補跑錯過的工作: " + job.name)
+        self._record(job.name, now)
+        try:
+            await job.func()
+            self.stats["runs"] += 1
+        except Exception as e:
+            self.stats["errors"] += 1
+            print("排程工作 " + job.name + " 失敗: " + str(e))
+        finally:
+            self.running.discard(job.name)
+            if job.kind == "once":
+                if self.jobs.get(job.name) is job:
+                    del self.jobs[job.name]
+            elif self.jobs.get(job.name) is job:
+                self.add(job)
+
+    async def run(self):
+        self.wakeup = asyncio.Event()
+        self.prune()
+        while True:
+            now = time.time()
+            due_jobs, next_due = self._pop_due(now)
+            for job, due in due_jobs:
+                if job.name in self.running:
+                    # 上次還沒跑完，這次跳過，跑完後會自己重新排程
+                    continue
+                self.running.add(job.name)
+                task = asyncio.create_task(self._run_job(job, due, now))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+            self.wakeup.clear()
+            timeout = MAX_SLEEP if next_due is None else min(MAX_SLEEP, max(0.0, next_due - time.time()))
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        """在目前的事件循環啟動排程"""
+        self.task = asyncio.create_task(self.run())
+        return self.task
+
+    async def stop(self, grace=10.0):
+        """停止排程；正在執行的工作最多等 grace 秒，之後取消"""
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        if self.tasks:
+            _, pending = await asyncio.wait(set(self.tasks), timeout=grace)
+            for task in pending:
+                print("取消排程工作")
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
@@ -0,0 +1,77 @@
+import time
+import asyncio
+from telegram.error import BadRequest, RetryAfter
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+def split_at(text, limit):
+    """切出不超過 limit 的前段，盡量在換行處切；回傳 (前段, 餘下)"""
+    if len(text) <= limit:
+        return text, ""
+    cut = text.rfind("\n", 0, limit)
+    if cut < limit // 2:
+        cut = limit
+    return text[:cut], text[cut:].lstrip("\n")
+
+class StreamingReply:
+    """把逐塊生成的文字顯示在 Telegram 上：先發佔位訊息，之後節流地編輯；超過長度上限就接著發新訊息"""
+
+    def __init__(self, message, interval=1.0, placeholder="…", limit=TELEGRAM_MESSAGE_LIMIT):
+        self.message = message
+        self.interval = interval
+        self.placeholder = placeholder
+        self.limit = limit
+        self.done = []
+        self.text = ""
+        self.current = None
+        self.shown = ""
+        self.last_edit = 0.0
+        self.edits = 0
+
+    async def start(self):
+        await self._send()
+
+    async def append(self, chunk):
+        self.text += chunk
+        while len(self.text) > self.limit:
+            head, self.text = split_at(self.text, self.limit)
+            await self._edit(head, force=True)
+            self.done.append(head)
+            await self._send()
+        await self._edit(self.text)
+
+    async def finish(self, empty_text="（沒有回覆）"):
+        """顯示最後的全文，回傳所有訊息合起來的文字"""
+        if not self.text and not self.done:
+            self.text = empty_text
+        await self._edit(self.text, force=True)
+        return "\n".join(self.done + [self.text])
+
+    async def _send(self):
+        self.current = await self.message.reply_text(self.placeholder)
+        self.shown = self.placeholder
+        self.last_edit = time.monotonic()
+
+    async def _edit(self, text, force=False):
+        if not text or text == self.shown:
+            return
+        wait = self.last_edit + self.interval - time.monotonic()
+        if wait > 0:
+            if not force:
+                return
+            # 最後一次和換訊息前的編輯不能跳過，等到可以編輯為止
+            await asyncio.sleep(wait)
+        try:
+            await self.current.edit_text(text)
+        except RetryAfter as e:
+            if not force:
+                self.last_edit = time.monotonic() + e.retry_after
+                return
+            await asyncio.sleep(e.retry_after)
+            await self.current.edit_text(text)
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                raise
+        self.shown = text
+        self.edits += 1
+        self.last_edit = time.monotonic()
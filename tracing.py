@@ -0,0 +1,140 @@
+import time
+import uuid
+import asyncio
+import functools
+import contextlib
+import contextvars
+import collections
+
+# 最近的 trace 放在固定大小的環形緩衝區，舊的自動丟掉
+TRACE_BUFFER_SIZE = 500
+traces = collections.deque(maxlen=TRACE_BUFFER_SIZE)
+
+current_trace = contextvars.ContextVar("current_trace", default=None)
+current_depth = contextvars.ContextVar("current_depth", default=0)
+
+class Trace:
+    def __init__(self, name):
+        self.id = uuid.uuid4().hex[:12]
+        self.name = name
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        self.duration = None
+        self.error = None
+        # [名稱, 開始（相對 trace 開始的秒數）, 耗時, 層級, 錯誤]
+        self.spans = []
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "name": self.name,
+            "started_at": self.started_at,
+            "duration": self.duration,
+            "error": self.error,
+            "spans": [{"name": n, "start": s, "duration": d, "depth": depth, "error": e}
+                      for n, s, d, depth, e in self.spans],
+        }
+
+def rename(name):
+    """改目前 trace 的名稱，例如判斷出訊息分支之後"""
+    trace = current_trace.get()
+    if trace is not None:
+        trace.name = name
+
+@contextlib.contextmanager
+def trace(name):
+    """開始一個 trace，結束時放進緩衝區；已在 trace 內就當成一個 span"""
+    if current_trace.get() is not None:
+        with span(name):
+            yield current_trace.get()
+        return
+    t = Trace(name)
+    token = current_trace.set(t)
+    try:
+        yield t
+    except BaseException as e:
+        t.error = type(e).__name__
+        raise
+    finally:
+        t.duration = time.perf_counter() - t.started
+        current_trace.reset(token)
+        traces.append(t)
+
+@contextlib.contextmanager
+def span(name):
+    """記錄一段耗時；不在 trace 內時不做任何事"""
+    t = current_trace.get()
+    if t is None:
+        yield
+        return
+    depth = current_depth.get()
+    token = current_depth.set(depth + 1)
+    entry = [name, time.perf_counter() - t.started, None, depth, None]
+    t.spans.append(entry)
+    try:
+        yield
+    except BaseException as e:
+        entry[4] = type(e).__name__
+        raise
+    finally:
+        entry[2] = time.perf_counter() - t.started - entry[1]
+        current_depth.reset(token)
+
+def traced(name=None, root=False):
+    """函式裝飾器，同步和協程函式都可以；root=True 時不在 trace 內也會開一個新的"""
+    def decorator(func):
+        span_name = name or func.__name__
+        wrap = trace if root else span
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with wrap(span_name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with wrap(span_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))] if values else 0.0
+
+def slowest(n=20, name_prefix=None):
+    items = [t for t in list(traces) if t.duration is not None and (not name_prefix or t.name.startswith(name_prefix))]
+    return sorted(items, key=lambda t: t.duration, reverse=True)[:n]
+
+def stage_breakdown(name_prefix=None):
+    """按 span 名稱彙總：次數、p50、p95、最大值，以及佔 trace 總時間的比例"""
+    durations = collections.defaultdict(list)
+    total = 0.0
+    for t in list(traces):
+        if t.duration is None or (name_prefix and not t.name.startswith(name_prefix)):
+            continue
+        total += t.duration
+        for n, _, d, depth, _ in t.spans:
+            if d is not None:
+                durations[n].append(d)
+    rows = []
+    for n, values in durations.items():
+        rows.append({"stage": n, "count": len(values), "p50": percentile(values, 50), "p95": percentile(values, 95),
+                     "max": max(values), "share": sum(values) / total if total else 0.0})
+    return sorted(rows, key=lambda r: r["share"], reverse=True)
+
+def render_text(n=20, name_prefix=None):
+    lines = [f"最近 {len(traces)} 個 trace（上限 {traces.maxlen}）", "", "各階段："]
+    lines.append(f"{'stage':<32} {'count':>6} {'p50 ms':>9} {'p95 ms':>9} {'max ms':>9} {'share':>7}")
+    for r in stage_breakdown(name_prefix):
+        lines.append(f"{r['stage']:<32} {r['count']:>6} {r['p50'] * 1000:>9.1f} {r['p95'] * 1000:>9.1f} "
+                     f"{r['max'] * 1000:>9.1f} {r['share'] * 100:>6.1f}%")
+    lines += ["", f"最慢 {n} 個："]
+    for t in slowest(n, name_prefix):
+        started = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(t.started_at))
+        lines.append(f"{t.duration * 1000:9.1f} ms  {t.name}  {started}  {t.id}" + (f"  [{t.error}]" if t.error else ""))
+        for n_, s, d, depth, e in t.spans:
+            d_text = f"{d * 1000:.1f}" if d is not None else "…"
+            lines.append(f"{'':13}{'  ' * depth}{n_}  +{s * 1000:.1f} ms  {d_text} ms" + (f"  [{e}]" if e else ""))
+    return "\n".join(lines) + "\n"
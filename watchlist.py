@@ -0,0 +1,56 @@
+import os
+import json
+import sqlite3
+import threading
+
+class WatchlistStore:
+    """監控清單存儲：SQLite，每件商品一行，寫入只動有變的商品"""
+
+    def __init__(self, path="watchlist.db", legacy_json="watchlist.json"):
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS items (url TEXT PRIMARY KEY, data TEXT NOT NULL)")
+        self._migrate_json(legacy_json)
+
+    def _migrate_json(self, legacy_json):
+        """舊版 watchlist.json 匯入一次，之後改名避免重複匯入"""
+        if not legacy_json or not os.path.exists(legacy_json):
+            return
+        try:
+            with open(legacy_json, "r", encoding="utf-8") as f:
+                items = json.load(f)
+            if not self.load():
+                self.save(items, items.keys())
+            os.replace(legacy_json, legacy_json + ".migrated")
+            print("已匯入舊監控清單：" + str(len(items)) + " 件")
+        except Exception as e:
+            print("匯入舊監控清單失敗: " + str(e))
+
+    def load(self):
+        with self.lock:
+            rows = self.conn.execute("SELECT url, data FROM items ORDER BY rowid").fetchall()
+        return {url: json.loads(data) for url, data in rows}
+
+    def save(self, items, urls):
+        """在一個交易內寫入 urls 這幾件；不在 items 裡的當作已刪除"""
+        upserts = []
+        deletes = []
+        for url in urls:
+            if url in items:
+                upserts.append((url, json.dumps(items[url], ensure_ascii=False)))
+            else:
+                deletes.append((url,))
+        with self.lock:
+            try:
+                self.conn.execute("BEGIN")
+                self.conn.executemany(
+                    "INSERT INTO items (url, data) VALUES (?, ?) ON CONFLICT(url) DO UPDATE SET data = excluded.data",
+                    upserts)
+                self.conn.executemany("DELETE FROM items WHERE url = ?", deletes)
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
@@ -0,0 +1,40 @@
+import threading
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# 健康檢查伺服器只用標準庫，進程一開始就能監聽，不用等 SDK 載入
+server = None
+# 路徑 -> 函式(查詢參數 dict)，回傳 (狀態碼, Content-Type, bytes)；其他路徑一律回健康檢查
+routes = {}
+
+def health(query):
+    return 200, "text/plain", b"Anya Bot is running"
+
+class Handler(BaseHTTPRequestHandler):
+    def respond(self, with_body):
+        url = urllib.parse.urlsplit(self.path)
+        route = routes.get(url.path, health)
+        try:
+            status, content_type, body = route(dict(urllib.parse.parse_qsl(url.query)))
+        except Exception as e:
+            status, content_type, body = 500, "text/plain", ("錯誤：" + str(e)).encode()
+        self.send_response(status)
+        self.send_header("Content-type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if with_body:
+            self.wfile.write(body)
+    def do_GET(self):
+        self.respond(True)
+    def do_HEAD(self):
+        self.respond(False)
+    def log_message(self, format, *args):
+        pass
+
+def start(port):
+    """在背景線程開始監聽；已經開了就直接回傳"""
+    global server
+    if server is None:
+        server = ThreadingHTTPServer(("0.0.0.0", port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server